@@ -0,0 +1,60 @@
+"""Compare html_fragments_to_string against the original lxml ->
+BeautifulSoup round trip it replaced.
+
+Usage: python benchmarks/bench_html_serializer.py [repeat]
+"""
+import sys
+import timeit
+from pathlib import Path
+from bs4 import BeautifulSoup
+from lxml import etree
+from mbtools.models import MoodleHtmlElement, html_fragments_to_string
+
+DATA_PATH = Path(__file__).parent.parent / "tests" / "data"
+
+
+def bs4_html_fragments_to_string(fragments):
+    html_content = b''.join(
+        [etree.tostring(fragment) for fragment in fragments])
+    return BeautifulSoup(
+        html_content,
+        "html.parser"
+    ).encode(formatter="html5").decode('utf-8')
+
+
+def load_fragments():
+    fragment_lists = []
+    for path in sorted(DATA_PATH.rglob("*.html")):
+        parent = etree.Element("content")
+        parent.text = path.read_text()
+        fragment_lists.append(MoodleHtmlElement(parent, "").etree_fragments)
+    return fragment_lists
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    fragment_lists = load_fragments()
+
+    for fragments in fragment_lists:
+        assert html_fragments_to_string(fragments) == \
+            bs4_html_fragments_to_string(fragments)
+
+    def run(serializer):
+        for fragments in fragment_lists:
+            serializer(fragments)
+
+    bs4_time = timeit.timeit(
+        lambda: run(bs4_html_fragments_to_string), number=repeat
+    )
+    native_time = timeit.timeit(
+        lambda: run(html_fragments_to_string), number=repeat
+    )
+    documents = len(fragment_lists) * repeat
+    print(f"Serialized {documents} documents")
+    print(f"bs4 round trip: {bs4_time:.3f}s")
+    print(f"native:         {native_time:.3f}s")
+    print(f"speedup:        {bs4_time / native_time:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""Measure the memory used by the model objects validation keeps alive for a
+synthetic large course.
+
+Usage: python benchmarks/bench_model_memory.py [pages] [questions]
+"""
+import sys
+import tempfile
+import tracemalloc
+from html import escape
+from pathlib import Path
+from mbtools import validate_mbz_html
+from mbtools.models import MoodleCourseSession
+from mbtools.validate_mbz_html import Violation
+
+PAGE_CONTENT = escape(
+    '<p style="color: red">Paragraph one</p>'
+    '<div class="os-raise-ib-cta" data-schema-version="1.0">'
+    '<p>Interactive block</p></div>'
+    '<p>Paragraph two</p>'
+)
+
+QUESTION_CONTENT = escape('<p style="color: blue">What is 1 + 1?</p>')
+
+ANSWER_CONTENT = escape('<p>Answer</p>')
+
+
+def write_course(mbz_path, page_count, question_count):
+    activities = []
+    for page_id in range(page_count):
+        activity_dir = mbz_path / f"activities/page_{page_id}"
+        activity_dir.mkdir(parents=True)
+        (activity_dir / "page.xml").write_text(
+            f'<?xml version="1.0" encoding="UTF-8"?>'
+            f'<activity id="{page_id}" modulename="page">'
+            f'<page id="{page_id}"><name>Page {page_id}</name>'
+            f'<content>{PAGE_CONTENT}</content></page></activity>'
+        )
+        (activity_dir / "module.xml").write_text(
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<module><visible>1</visible></module>'
+        )
+        activities.append(
+            '<activity><sectionid>1</sectionid>'
+            '<modulename>page</modulename>'
+            f'<directory>activities/page_{page_id}</directory></activity>'
+        )
+    (mbz_path / "moodle_backup.xml").write_text(
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<moodle_backup><contents>'
+        f'<activities>{"".join(activities)}</activities>'
+        '<sections><section><sectionid>1</sectionid>'
+        '<title>Section</title></section></sections>'
+        '</contents></moodle_backup>'
+    )
+
+    answer_data = "".join(
+        f'<answer id="{answer_id}"><answertext>{ANSWER_CONTENT}</answertext>'
+        f'<fraction>{answer_id % 2}</fraction><feedback></feedback></answer>'
+        for answer_id in range(4)
+    )
+    entries = "".join(
+        f'<question_bank_entry id="{entry_id}">'
+        f'<idnumber>not-a-uuid-{entry_id}</idnumber>'
+        '<question_version><question_versions><version>1</version>'
+        f'<questions><question id="{entry_id}">'
+        f'<questiontext>{QUESTION_CONTENT}</questiontext>'
+        '<qtype>multichoice</qtype>'
+        '<plugin_qtype_multichoice_question>'
+        f'<answers>{answer_data}</answers>'
+        '</plugin_qtype_multichoice_question>'
+        '</question></questions>'
+        '</question_versions></question_version></question_bank_entry>'
+        for entry_id in range(question_count)
+    )
+    (mbz_path / "questions.xml").write_text(
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<question_categories><question_category><question_bank_entries>'
+        f'{entries}'
+        '</question_bank_entries></question_category></question_categories>'
+    )
+
+
+def measure(label, build):
+    """Build a list of objects under tracemalloc and report the memory they
+    retain along with the peak while building them
+    """
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    start, _ = tracemalloc.get_traced_memory()
+    objects = build()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    retained = current - start
+    per_object = retained / len(objects) if objects else 0
+    print(
+        f"{label:<20} {len(objects):>8} objects "
+        f"{per_object:>10.1f} bytes/object "
+        f"{retained / 2**20:>8.2f} MiB retained "
+        f"{(peak - start) / 2**20:>8.2f} MiB peak"
+    )
+    return objects
+
+
+def main():
+    page_count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    question_count = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        mbz_path = Path(tmp_dir)
+        write_course(mbz_path, page_count, question_count)
+
+        session = MoodleCourseSession()
+        question_bank = session.question_bank(mbz_path)
+        # Parse the trees up front so only the model objects are measured
+        question_bank.etree
+        session.moodle_backup(mbz_path)
+
+        questions = measure("MoodleQuestion", lambda: question_bank.questions)
+        elements = measure(
+            "MoodleHtmlElement",
+            lambda: [
+                element for question in questions
+                for element in question.html_elements()
+            ]
+        )
+        measure(
+            "Violation",
+            lambda: [
+                Violation(validate_mbz_html.STYLE_VIOLATION, element.location)
+                for element in elements
+            ]
+        )
+        measure(
+            "validate_mbz",
+            lambda: validate_mbz_html.validate_mbz(
+                mbz_path, include_questionbank=True
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,25 +1,59 @@
+import functools
 import hashlib
+import json
 import os
-import io
 import magic
 import boto3
 import argparse
 import botocore
 import jinja2
+import threading
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from datetime import datetime, timezone
 
 IGNORED_FILES = [".DS_Store"]
 
+MANIFEST_VERSION = 1
 
-def upload_resources(resource_dir, bucket, s3_dir):
-    """Uploads resources to s3 if they dont already exist there"""
+# Files are hashed in large blocks after the start of the file, which is
+# read in one go so libmagic can sniff the mime type from it
+HASH_BUFFER_SIZE = 1024 * 1024
 
-    hash_to_filedata_map, duplicates = resource_hashes(resource_dir)
-    hashes_to_update = list(hash_to_filedata_map.keys())
+# How much of a file libmagic looks at if it can't tell us, which is the
+# default since libmagic 5.22
+DEFAULT_MAGIC_BYTES_MAX = 7 * 1024 * 1024
+
+# hashlib and libmagic release the GIL, so files are hashed with a thread
+# pool. This matches the ThreadPoolExecutor default.
+DEFAULT_HASH_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+
+# botocore keeps 10 connections per client by default, which is enough for
+# a single upload_file call but not for several running at once
+DEFAULT_MAX_POOL_CONNECTIONS = 10
+
+# How many files may wait for each upload worker before hashing is paused
+UPLOAD_QUEUE_PER_WORKER = 2
+
+
+def upload_resources(resource_dir, bucket, s3_dir, concurrency=1,
+                     list_existing=False, manifest_path=None, verify=False,
+                     hash_workers=DEFAULT_HASH_WORKERS):
+    """Uploads resources to s3 if they dont already exist there. Each new
+    hash is handed to the upload workers as soon as it is found, so
+    uploading overlaps with hashing the rest of the directory."""
+
+    hash_to_filedata_map = {}
+    duplicates = []
+    hashes_to_update = iter_resource_hashes(
+        resource_dir, hash_to_filedata_map, duplicates, manifest_path,
+        verify, hash_workers
+    )
 
     existing_timestamps = add_new_resources_to_s3(
-        bucket, s3_dir, hashes_to_update, hash_to_filedata_map
+        bucket, s3_dir, hashes_to_update, hash_to_filedata_map, concurrency,
+        list_existing
     )
 
     for hash_key in hash_to_filedata_map:
@@ -74,12 +108,29 @@ def output_index_file(resource_path, hash_to_filedata_map, duplicates,
             workflow_file.write(template.render(data=data))
 
 
-def resource_hashes(resource_dir):
-    """Generates sha1 hashes for all the resources in a local directory"""
+def resource_hashes(resource_dir, manifest_path=None, verify=False,
+                    workers=DEFAULT_HASH_WORKERS):
+    """Generates sha1 hashes for all the resources in a local directory. If
+    a manifest is given, files whose size, mtime and inode match it reuse
+    its sha1 and mime type instead of being read again, unless verify is
+    set. The manifest is then updated to match the directory. Files are
+    hashed by a pool of worker threads."""
 
     sha1_map = {}
     duplicates = []
-    buff_size = io.DEFAULT_BUFFER_SIZE
+    for _ in iter_resource_hashes(resource_dir, sha1_map, duplicates,
+                                  manifest_path, verify, workers):
+        pass
+    return sha1_map, duplicates
+
+
+def iter_resource_hashes(resource_dir, sha1_map, duplicates,
+                         manifest_path=None, verify=False,
+                         workers=DEFAULT_HASH_WORKERS):
+    """Add the resources in a local directory to sha1_map and duplicates
+    as in resource_hashes, yielding each new sha1 key once it has been
+    added to sha1_map"""
+
     path_to_files = []
     for (dir_path, dir_names, file_names) in os.walk(resource_dir):
         for file in file_names:
@@ -90,16 +141,34 @@ def resource_hashes(resource_dir):
         path_to_files
     )
 
+    manifest = {}
+    if manifest_path is not None and not verify:
+        manifest = load_hash_manifest(manifest_path)
+    new_manifest = {}
+    stale_files = []
+
     for full_path in resource_files:
-        mime_type = get_mime_type(full_path)
-        sha1 = hashlib.sha1()
-        with open(full_path, 'rb') as f:
-            while True:
-                data = f.read(buff_size)
-                if not data:
-                    break
-                sha1.update(data)
-            sha1_key = sha1.hexdigest()
+        relpath = os.path.relpath(full_path, resource_dir)
+        file_stat = os.stat(full_path)
+        stat_key = [file_stat.st_size, file_stat.st_mtime_ns,
+                    file_stat.st_ino]
+        entry = manifest.get(relpath)
+        if entry is None or entry['stat'] != stat_key:
+            entry = {'stat': stat_key}
+            stale_files.append((full_path, entry))
+        new_manifest[relpath] = (full_path, entry)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        hashes = executor.map(hash_resource,
+                              [full_path for full_path, _ in stale_files])
+        # Duplicates are found in walk order, as if the files were hashed
+        # one after another
+        for relpath, (full_path, entry) in new_manifest.items():
+            if 'sha1' not in entry:
+                entry['sha1'], entry['mime_type'] = next(hashes)
+            new_manifest[relpath] = entry
+            sha1_key = entry['sha1']
+            mime_type = entry['mime_type']
             if sha1_key in sha1_map:
                 duplicates.append({
                     'path': full_path,
@@ -113,8 +182,66 @@ def resource_hashes(resource_dir):
                     'mime_type': mime_type,
                     'timestamp': datetime.now(timezone.utc).isoformat()
                 }
+                yield sha1_key
+
+    if manifest_path is not None:
+        save_hash_manifest(manifest_path, new_manifest)
+
+
+def hash_resource(full_path):
+    """Return the sha1 and mime type of a file, reading it once"""
+
+    sha1 = hashlib.sha1()
+    with open(full_path, 'rb') as f:
+        # Give libmagic as much of the file as it would read itself, so
+        # the mime type matches magic.from_file
+        head = f.read(magic_bytes_max())
+        if not head:
+            # libmagic names empty files differently when given a buffer
+            return sha1.hexdigest(), get_mime_type(full_path)
+        mime_type = get_buffer_mime_type(head)
+        sha1.update(head)
+        del head
+
+        buffer = bytearray(HASH_BUFFER_SIZE)
+        view = memoryview(buffer)
+        size = f.readinto(buffer)
+        while size:
+            sha1.update(view[:size])
+            size = f.readinto(buffer)
+    return sha1.hexdigest(), mime_type
+
+
+@functools.lru_cache(maxsize=None)
+def magic_bytes_max():
+    """The number of bytes at the start of a file libmagic looks at"""
+    try:
+        return magic.Magic().getparam(magic.MAGIC_PARAM_BYTES_MAX)
+    except (AttributeError, NotImplementedError, magic.MagicException):
+        # Older versions of python-magic or libmagic can't say
+        return DEFAULT_MAGIC_BYTES_MAX
 
-    return sha1_map, duplicates
+
+def load_hash_manifest(manifest_path):
+    """Load a manifest mapping each file path, relative to the resource
+    directory, to its [size, mtime_ns, inode] stat, sha1 and mime type"""
+
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    if manifest.get('version') != MANIFEST_VERSION:
+        return {}
+    return manifest['files']
+
+
+def save_hash_manifest(manifest_path, files):
+    # Write to a temporary file first so an interrupted run can't leave a
+    # truncated manifest behind
+    tmp_path = f'{manifest_path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'version': MANIFEST_VERSION, 'files': files}, f)
+    os.replace(tmp_path, manifest_path)
 
 
 def get_mime_type(filepath):
@@ -126,50 +253,134 @@ def get_mime_type(filepath):
         return mime_type
 
 
+def get_buffer_mime_type(data):
+    """Get the MIME type of the start of a file with libmagic """
+    mime_type = ''
+    try:
+        mime_type = magic.from_buffer(bytes(data), mime=True)
+    finally:
+        return mime_type
+
+
 def add_new_resources_to_s3(bucket, s3_dir, hashes_to_update,
-                            hash_to_filedata_map):
+                            hash_to_filedata_map, concurrency=1,
+                            list_existing=False):
     """Add the files specified in hashes_to_update to s3 if they their
-    corresponding sha1 key exists in hashes"""
-
-    s3_client = boto3.client("s3")
+    corresponding sha1 key exists in hashes. Up to concurrency files are
+    checked and uploaded at once using one shared client. With
+    list_existing the objects under s3_dir are listed once up front instead
+    of checking each file with head_object.
+
+    hashes_to_update may be a generator that fills in hash_to_filedata_map
+    as it goes. Files are uploaded while it is still running, and it is
+    paused while the upload queue is full."""
+
+    s3_client = boto3.client("s3", config=Config(
+        max_pool_connections=max(DEFAULT_MAX_POOL_CONNECTIONS, concurrency)
+    ))
     existing_timestamps = {}
     metadata = []
-    for hash_key in hashes_to_update:
-        full_keypath = s3_dir + '/' + hash_key
+    listed_timestamps = None
+    if list_existing:
+        listed_timestamps = list_s3_timestamps(s3_client, bucket, s3_dir)
+
+    def sync_resource(hash_key):
+        return add_resource_to_s3(s3_client, bucket, s3_dir, hash_key,
+                                  hash_to_filedata_map[hash_key],
+                                  listed_timestamps)
+
+    concurrency = max(1, concurrency)
+    queue_slots = threading.BoundedSemaphore(
+        concurrency * UPLOAD_QUEUE_PER_WORKER
+    )
 
-        try:
-            s3_response = s3_client.head_object(Bucket=bucket,
-                                                Key=full_keypath)
-            filename = os.path.basename(hash_to_filedata_map[hash_key]['path'])
-            existing_timestamps[hash_key] = s3_response['LastModified']
-            print(f"File {filename} with sha {hash_key} already exists in S3!")
-        except botocore.exceptions.ClientError:
-            mime_type = hash_to_filedata_map[hash_key]['mime_type']
-            s3_client.upload_file(hash_to_filedata_map[hash_key]['path'],
-                                  Bucket=bucket,
-                                  Key=full_keypath,
-                                  ExtraArgs={
-                                    "ContentType": mime_type
-                                    }
-                                  )
-
-        # This timestamp in metadata will be slightly off because the time
-        # at which s3 will upload will be different than the time here
-            metadata.append({
-                "mime_type": mime_type,
-                "sha1": hash_key,
-                "original_filename": os.path.basename(
+    def release_slot(future):
+        queue_slots.release()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = []
+        for hash_key in hashes_to_update:
+            queue_slots.acquire()
+            future = executor.submit(sync_resource, hash_key)
+            future.add_done_callback(release_slot)
+            futures.append(future)
+
+        # Results are handled here in the order of hashes_to_update rather
+        # than in the worker threads, so the output is the same for any
+        # concurrency
+        for future in futures:
+            hash_key, last_modified, upload_metadata = future.result()
+            if upload_metadata is None:
+                filename = os.path.basename(
                     hash_to_filedata_map[hash_key]['path']
-                ),
-                "s3_key": full_keypath,
-                "timestamp": datetime.now(timezone.utc).isoformat()
-            })
+                )
+                existing_timestamps[hash_key] = last_modified
+                print(f"File {filename} with sha {hash_key} "
+                      "already exists in S3!")
+            else:
+                metadata.append(upload_metadata)
 
     print("Uploaded " + str(len(metadata)) + " files to " +
           bucket)
     return existing_timestamps
 
 
+def list_s3_timestamps(s3_client, bucket, s3_dir):
+    """Map the name of each object directly under s3_dir to its
+    LastModified timestamp, listing up to 1000 objects per request"""
+
+    prefix = s3_dir + '/'
+    timestamps = {}
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for s3_object in page.get('Contents', []):
+            name = s3_object['Key'][len(prefix):]
+            timestamps[name] = s3_object['LastModified']
+    return timestamps
+
+
+def add_resource_to_s3(s3_client, bucket, s3_dir, hash_key, filedata,
+                       listed_timestamps=None):
+    """Upload a file to s3 unless its sha1 key already exists there, either
+    in listed_timestamps if given or according to head_object. Returns
+    (hash_key, last_modified, metadata) where last_modified is set if the
+    file already existed and metadata describes the upload otherwise."""
+
+    full_keypath = s3_dir + '/' + hash_key
+    mime_type = filedata['mime_type']
+    if listed_timestamps is not None:
+        if hash_key in listed_timestamps:
+            return hash_key, listed_timestamps[hash_key], None
+        upload_resource_to_s3(s3_client, bucket, full_keypath, filedata)
+    else:
+        try:
+            s3_response = s3_client.head_object(Bucket=bucket,
+                                                Key=full_keypath)
+            return hash_key, s3_response['LastModified'], None
+        except botocore.exceptions.ClientError:
+            upload_resource_to_s3(s3_client, bucket, full_keypath, filedata)
+
+    # This timestamp in metadata will be slightly off because the time
+    # at which s3 will upload will be different than the time here
+    return hash_key, None, {
+        "mime_type": mime_type,
+        "sha1": hash_key,
+        "original_filename": os.path.basename(filedata['path']),
+        "s3_key": full_keypath,
+        "timestamp": datetime.now(timezone.utc).isoformat()
+    }
+
+
+def upload_resource_to_s3(s3_client, bucket, full_keypath, filedata):
+    s3_client.upload_file(filedata['path'],
+                          Bucket=bucket,
+                          Key=full_keypath,
+                          ExtraArgs={
+                            "ContentType": filedata['mime_type']
+                            }
+                          )
+
+
 def main():
     parser = argparse.ArgumentParser(description='Upload Resources to S3')
     parser.add_argument('resource_path', type=str,
@@ -182,14 +393,34 @@ def main():
                         help='url prefix for s3 files')
     parser.add_argument('index_path', type=str,
                         help='file path to index file')
+    parser.add_argument('--concurrency', type=int, default=1,
+                        help='number of files to check and upload at once')
+    parser.add_argument('--list-existing', action='store_true',
+                        help='list the objects under s3_prefix once instead '
+                             'of checking each file with a HEAD request')
+    parser.add_argument('--manifest', type=str,
+                        help='file path to a manifest of file hashes used '
+                             'to skip rehashing unchanged files')
+    parser.add_argument('--verify', action='store_true',
+                        help='rehash every file and rewrite the manifest')
+    parser.add_argument('--hash-workers', type=int,
+                        default=DEFAULT_HASH_WORKERS,
+                        help='number of files to hash at once')
 
     args = parser.parse_args()
+    if args.verify and args.manifest is None:
+        parser.error('--verify requires --manifest')
 
     resource_dir = Path(args.resource_path).resolve(strict=True)
 
     hash_to_filedata_map, duplicates = upload_resources(resource_dir,
                                                         args.bucket_name,
-                                                        args.s3_prefix)
+                                                        args.s3_prefix,
+                                                        args.concurrency,
+                                                        args.list_existing,
+                                                        args.manifest,
+                                                        args.verify,
+                                                        args.hash_workers)
 
     output_index_file(resource_dir, hash_to_filedata_map, duplicates,
                       args.url_prefix, args.index_path)
@@ -7,18 +7,18 @@ from mbtools.models import MoodleLesson, MoodlePage
 def replace_content_tags(mbz_path, output_file_path,
                          filter=["page", "lesson"]):
 
-    activities = utils.parse_backup_activities(mbz_path)
+    backup = utils.parse_moodle_backup(mbz_path)
     output_html_files = []
 
-    for act in activities:
+    for act in backup.activities():
         if isinstance(act, MoodleLesson) and "lesson" in filter \
                 or isinstance(act, MoodlePage) and "page" in filter:
             for html_elem in act.html_elements():
                 html_file = html_elem.replace_content_tag()
                 if html_file:
                     output_html_files.append(html_file)
-                    utils.write_etree(act.activity_filename, act.etree)
 
+    backup.save()
     write_html_files(output_html_files, output_file_path)
     return output_html_files
 
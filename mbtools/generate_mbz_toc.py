@@ -16,11 +16,11 @@ def make_title():
     return "# Table of Contents  \n"
 
 
-def parse_toc(mbz_path):
+def parse_toc(mbz_path, session=None):
     md_string = ''
     activity_list = []
 
-    moodle_backup = MoodleBackup(mbz_path)
+    moodle_backup = MoodleBackup(mbz_path, session)
     md_string += make_title()
     for section in moodle_backup.sections():
         md_string += make_nested_bullet(1, section.title)
@@ -88,7 +88,7 @@ def create_toc_csv(output_path, activity_list):
 def main():
     parser = argparse.ArgumentParser(description='')
     parser.add_argument('mbz_path', type=str,
-                        help='relative path to the mbz directory')
+                        help='relative path to the mbz directory or .mbz file')
     parser.add_argument('output_path', type=str,
                         help='Path/name of the output file to be generated')
     parser.add_argument('--csv', action='store_true',
@@ -43,14 +43,21 @@ def generate_quiz_data(mbz_path, output_path):
     quiz_question_contents_csv = []
     quiz_multichoice_answers_csv = []
 
+    quiz_question_refs = [
+        (quiz, quiz.quiz_questions) for quiz in quizzes
+    ]
+    q_bank_questions = question_bank.question_records_by_entry(
+        (moodle_question.qbank_entry_id, moodle_question.version)
+        for _, quiz_questions in quiz_question_refs
+        for moodle_question in quiz_questions
+    )
+
     moodle_questions = []
-    for quiz in quizzes:
-        for moodle_question in quiz.quiz_questions:
-            q_bank_question = \
-                question_bank.get_question_by_entry(
-                    question_bank_entry_id=moodle_question.qbank_entry_id,
-                    version=moodle_question.version
-                )
+    for quiz, quiz_questions in quiz_question_refs:
+        for moodle_question in quiz_questions:
+            q_bank_question = q_bank_questions[
+                (moodle_question.qbank_entry_id, moodle_question.version)
+            ]
 
             id_number = q_bank_question.id_number
             text = q_bank_question.text
@@ -102,7 +109,7 @@ def generate_quiz_data(mbz_path, output_path):
 def main():
     parser = argparse.ArgumentParser(description='')
     parser.add_argument('mbz_path', type=str,
-                        help='relative path to unzipped mbz')
+                        help='relative path to unzipped mbz or .mbz file')
     parser.add_argument('output_dir', type=str,
                         help='relative path output dir')
     args = parser.parse_args()
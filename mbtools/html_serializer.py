@@ -0,0 +1,141 @@
+import re
+from lxml import etree
+from bs4.dammit import EntitySubstitution
+
+# The serializer below walks lxml trees directly and produces the same output
+# as serializing with lxml, re-parsing with BeautifulSoup's html.parser and
+# encoding with the html5 formatter, which is what html_fragments_to_string
+# historically did. The constants mirror the html.parser tree builder.
+
+VOID_ELEMENTS = frozenset([
+    'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'keygen',
+    'link', 'menuitem', 'meta', 'param', 'source', 'track', 'wbr',
+    'basefont', 'bgsound', 'command', 'frame', 'image', 'isindex',
+    'nextid', 'spacer'
+])
+
+CDATA_ELEMENTS = frozenset(['script', 'style'])
+
+PRESERVE_WHITESPACE_ELEMENTS = frozenset(['pre', 'textarea'])
+
+MULTI_VALUED_ATTRIBUTES = {
+    "*": frozenset(['class', 'accesskey', 'dropzone']),
+    "a": frozenset(['rel', 'rev']),
+    "link": frozenset(['rel', 'rev']),
+    "td": frozenset(['headers']),
+    "th": frozenset(['headers']),
+    "form": frozenset(['accept-charset']),
+    "object": frozenset(['archive']),
+    "area": frozenset(['rel']),
+    "icon": frozenset(['sizes']),
+    "iframe": frozenset(['sandbox']),
+    "output": frozenset(['for'])
+}
+
+ASCII_SPACES = '\x20\x0a\x09\x0c\x0d'
+
+NON_WHITESPACE_RE = re.compile(r"\S+")
+
+# Character references in the C1 range are read as Windows-1252 by the
+# html.parser round trip
+C1_TRANSLATION = {}
+for codepoint in range(0x80, 0xa0):
+    try:
+        C1_TRANSLATION[codepoint] = bytes([codepoint]).decode('cp1252')
+    except UnicodeDecodeError:
+        pass
+
+
+def serialize_fragments(fragments):
+    """Serialize a list of lxml HTML fragments (including their tails) to
+    an html5-formatted string
+    """
+    output = []
+    for fragment in fragments:
+        _serialize_node(fragment, output, False, False)
+    return ''.join(output)
+
+
+def _serialize_node(node, output, in_cdata, preserve_whitespace):
+    tag = node.tag
+    if tag is etree.Comment:
+        output.append(f'<!--{node.text or ""}-->')
+    elif tag is etree.PI:
+        if node.text:
+            output.append(f'<?{node.target} {node.text}?>')
+        else:
+            output.append(f'<?{node.target}?>')
+    else:
+        _serialize_element(node, output, preserve_whitespace)
+
+    if node.tail:
+        _serialize_text(node.tail, output, in_cdata, preserve_whitespace)
+
+
+def _serialize_element(elem, output, preserve_whitespace):
+    name = elem.tag.lower()
+    in_cdata = name in CDATA_ELEMENTS
+    preserve_whitespace = \
+        preserve_whitespace or name in PRESERVE_WHITESPACE_ELEMENTS
+
+    output.append('<' + name)
+    output.append(_serialize_attributes(name, elem.attrib))
+
+    output.append('>')
+
+    if elem.text:
+        _serialize_text(elem.text, output, in_cdata, preserve_whitespace)
+    for child in elem:
+        _serialize_node(child, output, in_cdata, preserve_whitespace)
+
+    # Void elements are never closed. If lxml placed content inside one (it
+    # doesn't know about some HTML5 void elements) that content simply
+    # follows the start tag.
+    if name not in VOID_ELEMENTS:
+        output.append(f'</{name}>')
+
+
+def _serialize_attributes(tag_name, attrib):
+    if not attrib:
+        return ''
+    multi_valued = MULTI_VALUED_ATTRIBUTES["*"] | \
+        MULTI_VALUED_ATTRIBUTES.get(tag_name, frozenset())
+
+    attrs = []
+    for key, value in sorted(
+        (key.lower(), value) for key, value in attrib.items()
+    ):
+        value = value.translate(C1_TRANSLATION)
+        if key in multi_valued:
+            value = ' '.join(NON_WHITESPACE_RE.findall(value))
+        elif value == '':
+            attrs.append(key)
+            continue
+        value = EntitySubstitution.substitute_html(value)
+        attrs.append(
+            key + '=' + EntitySubstitution.quoted_attribute_value(value)
+        )
+    return ' ' + ' '.join(attrs)
+
+
+def _serialize_text(text, output, in_cdata, preserve_whitespace):
+    if in_cdata:
+        # Text in these elements is emitted exactly as lxml escaped it
+        text = text.replace('&', '&amp;') \
+            .replace('<', '&lt;') \
+            .replace('>', '&gt;') \
+            .replace('\r', '&#13;') \
+            .encode('ascii', 'xmlcharrefreplace') \
+            .decode('ascii')
+    else:
+        text = text.translate(C1_TRANSLATION)
+
+    # Strings made up entirely of ASCII whitespace collapse to a single
+    # newline or space
+    if not preserve_whitespace and not text.strip(ASCII_SPACES):
+        text = '\n' if '\n' in text else ' '
+
+    if in_cdata:
+        output.append(text)
+    else:
+        output.append(EntitySubstitution.substitute_html(text))
@@ -1,4 +1,4 @@
-from mbtools import models, utils
+from mbtools import models
 from pathlib import Path
 import argparse
 
@@ -13,7 +13,7 @@ def main():
     question_bank = models.MoodleQuestionBank(mbz_path)
     question_bank.inject_question_uuids()
 
-    utils.write_etree(question_bank.questionbank_path, question_bank.etree)
+    question_bank.save()
 
 
 if __name__ == "__main__":  # pragma: no cover
@@ -0,0 +1,140 @@
+import functools
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import zipfile
+from pathlib import Path, PurePosixPath
+from lxml import etree
+
+# Uploaded course files live under this prefix. They make up the bulk of an
+# archive and are never parsed, so their contents are not kept in the index.
+FILES_PREFIX = "files/"
+
+
+class MbzArchive:
+    """An index of the members in a Moodle backup archive (a .mbz file),
+    which is either a gzipped tarball or a zip file. XML members can be read
+    without extracting the archive to disk.
+    """
+    def __init__(self, archive_path):
+        self.archive_path = Path(archive_path)
+        # Normalized member names mapped to their names in the archive
+        self.members = {}
+        self._zip_file = None
+        # XML members of tarballs, which can't be read randomly without
+        # decompressing everything that precedes a member, are spooled to a
+        # temporary directory that is removed along with the index
+        self._spool_dir = None
+        self._spooled = {}
+        if zipfile.is_zipfile(self.archive_path):
+            self._index_zip()
+        else:
+            self._index_tar()
+
+    def _index_zip(self):
+        self._zip_file = zipfile.ZipFile(self.archive_path)
+        for info in self._zip_file.infolist():
+            if not info.is_dir():
+                name = normalize_member_name(info.filename)
+                self.members[name] = info.filename
+
+    def _index_tar(self):
+        # Read the tarball as a stream in a single pass, spooling only the
+        # XML members outside of the files/ payload. Spool files are
+        # numbered so that member names never become paths.
+        self._spool_dir = tempfile.TemporaryDirectory(prefix="mbz-")
+        with tarfile.open(self.archive_path, "r|*") as tar:
+            for info in tar:
+                if not info.isfile():
+                    continue
+                name = normalize_member_name(info.name)
+                self.members[name] = info.name
+                if name.startswith(FILES_PREFIX) or \
+                        not name.endswith(".xml"):
+                    continue
+                spool_path = \
+                    Path(self._spool_dir.name) / f"{len(self._spooled)}.xml"
+                with tar.extractfile(info) as member_file, \
+                        open(spool_path, "wb") as spool_file:
+                    shutil.copyfileobj(member_file, spool_file)
+                self._spooled[name] = spool_path
+
+    def __contains__(self, member):
+        return member in self.members
+
+    def open(self, member):
+        """Return a binary file object for an archive member"""
+        if member not in self.members:
+            raise FileNotFoundError(
+                f"{member} not found in archive {self.archive_path}"
+            )
+        if self._zip_file is not None:
+            return self._zip_file.open(self.members[member])
+        if member not in self._spooled:
+            raise Exception(
+                f"Contents of {member} in archive {self.archive_path} "
+                "are not indexed"
+            )
+        return SpooledMemberFile(io.FileIO(self._spooled[member]))
+
+
+class SpooledMemberFile(io.BufferedReader):
+    """A tarball member read from its spool file. The file's name is hidden
+    so that trees parsed from it don't get the spool file as their URL,
+    which they would be saved back to.
+    """
+    name = None
+
+
+def normalize_member_name(name):
+    return PurePosixPath(name.lstrip("/")).as_posix().removeprefix("./")
+
+
+def open_archive(archive_path):
+    """Return the (cached) index for an archive. The cache is invalidated if
+    the archive file changes.
+    """
+    archive_path = Path(archive_path).resolve()
+    stat = archive_path.stat()
+    return _open_archive(str(archive_path), stat.st_mtime_ns, stat.st_size)
+
+
+@functools.lru_cache(maxsize=4)
+def _open_archive(archive_path, mtime_ns, size):
+    return MbzArchive(archive_path)
+
+
+def find_archive_member(file_path):
+    """Given a path to a file inside an archive (e.g. course.mbz/questions.xml)
+    return the archive and the member name. Returns None if the path exists
+    on disk or isn't inside an archive.
+    """
+    file_path = Path(file_path)
+    if os.path.exists(file_path):
+        return None
+    for parent in file_path.parents:
+        if parent.is_file():
+            member = file_path.relative_to(parent).as_posix()
+            return open_archive(parent), member
+    return None
+
+
+def open_file(file_path):
+    """Open a binary file from disk or from inside an archive"""
+    archive_member = find_archive_member(file_path)
+    if archive_member is None:
+        return open(file_path, "rb")
+    archive, member = archive_member
+    return archive.open(member)
+
+
+def parse(file_path):
+    """Parse an XML file from disk or from inside an archive"""
+    archive_member = find_archive_member(file_path)
+    if archive_member is None:
+        return etree.parse(str(file_path))
+    archive, member = archive_member
+    with archive.open(member) as f:
+        return etree.parse(f)
@@ -1,8 +1,12 @@
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from uuid import uuid4
 from pathlib import Path
 from lxml import etree, html
-from bs4 import BeautifulSoup
-from mbtools import utils
+from mbtools import html_serializer, mbz_archive, utils
+from mbtools.xpath_queries import xpath
 QUESTION_TEXT_IGNORE_TYPES = [
     "shortanswer"
 ]
@@ -12,52 +16,243 @@ QUESTION_ANSWER_TEXT_IGNORE_TYPES = [
     "shortanswer"
 ]
 
+# lxml releases the GIL while parsing so activity files can be loaded with a
+# thread pool. This matches the ThreadPoolExecutor default.
+DEFAULT_ACTIVITY_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+
+
+def intern_text(value):
+    """Intern a string that is repeated across many model objects (e.g.
+    question types, versions and locations) so they share one copy. Values
+    that aren't strings are returned as is.
+    """
+    if type(value) is not str:
+        return value
+    return sys.intern(value)
+
+
+class MoodleCourseSession:
+    """Caches parsed XML trees and model objects for a course by file path
+    so that each backup file is parsed at most once per run. Requesting the
+    same path again returns the same object. The caches are safe to use
+    from the threads MoodleBackup uses to load activities. Changes made
+    through the session's models are tracked in its modified_trees.
+    """
+    __slots__ = ("workers", "modified_trees", "_etrees", "_models")
+
+    def __init__(self, workers=None):
+        self.workers = workers
+        self.modified_trees = ModifiedTrees()
+        self._etrees = {}
+        self._models = {}
+
+    def parse(self, file_path):
+        key = str(file_path)
+        tree = self._etrees.get(key)
+        if tree is None:
+            # If another thread raced us here keep whichever tree was stored
+            # first so callers always see the same object
+            tree = self._etrees.setdefault(key, mbz_archive.parse(key))
+        return tree
+
+    def get_model(self, key, factory):
+        model = self._models.get(key)
+        if model is None:
+            model = self._models.setdefault(key, factory())
+        return model
+
+    def moodle_backup(self, mbz_path):
+        mbz_path = Path(mbz_path).resolve()
+        return self.get_model(
+            ("backup", str(mbz_path)),
+            lambda: MoodleBackup(mbz_path, self, self.workers)
+        )
+
+    def question_bank(self, mbz_path):
+        mbz_path = Path(mbz_path).resolve()
+        return self.get_model(
+            ("question_bank", str(mbz_path)),
+            lambda: MoodleQuestionBank(mbz_path, self)
+        )
+
+
+class ModifiedTrees:
+    """Tracks which parsed files have been modified through the models so
+    that only those files are written back when a backup is saved. Each
+    backup or session has its own, which it passes to the models it
+    creates. Trees are tracked by their root element, which keeps the tree
+    alive until it is saved or the tracker is freed.
+    """
+    __slots__ = ("_roots", "_lock")
+
+    def __init__(self):
+        self._roots = set()
+        self._lock = threading.Lock()
+
+    def mark(self, elem):
+        root = elem.getroottree().getroot()
+        # Elements which don't belong to a parsed file have nowhere to be
+        # written back to
+        if root.getroottree().docinfo.URL is None:
+            return
+        with self._lock:
+            self._roots.add(root)
+
+    def is_modified(self, elem):
+        return elem.getroottree().getroot() in self._roots
+
+    def save(self, base_path):
+        """Write each modified file under base_path exactly once and return
+        the paths that were written
+        """
+        base_path = Path(base_path)
+        with self._lock:
+            roots = [
+                root for root in self._roots
+                if base_path in Path(root.getroottree().docinfo.URL).parents
+            ]
+            self._roots.difference_update(roots)
+        return self._write(roots)
+
+    def save_tree(self, elem):
+        """Write the file containing elem if it has been modified"""
+        root = elem.getroottree().getroot()
+        with self._lock:
+            if root not in self._roots:
+                return []
+            self._roots.remove(root)
+        return self._write([root])
+
+    def _write(self, roots):
+        saved_paths = []
+        for root in roots:
+            tree = root.getroottree()
+            utils.write_etree(tree.docinfo.URL, tree)
+            saved_paths.append(Path(tree.docinfo.URL))
+        return sorted(saved_paths)
+
+
+def resolve_modified_trees(session, modified_trees=None):
+    """Return the ModifiedTrees a model should record its changes in: the
+    one it was given, its session's or otherwise a new one of its own
+    """
+    if modified_trees is not None:
+        return modified_trees
+    if session is not None:
+        return session.modified_trees
+    return ModifiedTrees()
+
+
+def parse_xml(file_path, session=None):
+    if session is None:
+        return mbz_archive.parse(file_path)
+    return session.parse(file_path)
+
 
 class MoodleBackup:
-    def __init__(self, mbz_path):
+    __slots__ = (
+        "mbz_path", "session", "workers", "modified_trees", "etree", "q_bank"
+    )
+
+    def __init__(self, mbz_path, session=None, workers=None):
         self.mbz_path = Path(mbz_path)
+        self.session = session
+        self.workers = \
+            DEFAULT_ACTIVITY_WORKERS if workers is None else workers
+        self.modified_trees = resolve_modified_trees(session)
         backup_xml_path = self.mbz_path / "moodle_backup.xml"
-        self.etree = etree.parse(str(backup_xml_path))
-        self.q_bank = MoodleQuestionBank(self.mbz_path)
+        self.etree = parse_xml(backup_xml_path, session)
+        if session is None:
+            self.q_bank = MoodleQuestionBank(
+                self.mbz_path, modified_trees=self.modified_trees
+            )
+        else:
+            self.q_bank = session.question_bank(self.mbz_path)
+
+    def save(self):
+        """Write back each file in the backup which has been modified through
+        its models, leaving unchanged files alone. Returns the paths written.
+        """
+        if self.mbz_path.is_file():
+            raise Exception(
+                f"Cannot save changes to archive {self.mbz_path}, "
+                "extract it first"
+            )
+        return self.modified_trees.save(self.mbz_path)
 
     def activities(self, section_id=None):
+        return self._load_activities(self._activity_elems(section_id))
+
+    def iter_activities(self, section_id=None):
+        """Yield activity model objects in moodle_backup.xml order, loading
+        each one only when it is reached
+        """
+        for activity_elem in self._activity_elems(section_id):
+            loader = self._activity_loader(activity_elem)
+            if loader is not None:
+                yield loader()
+
+    def _activity_elems(self, section_id):
         if section_id is None:
-            activity_elems = self.etree.xpath("//contents/activities/activity")
-        else:
-            activity_elems = self.etree.xpath(
-                f"//contents/activities/activity[sectionid='{section_id}']"
-            )
-        activities = []
-        for activity_elem in activity_elems:
-            activity_type = activity_elem.find("modulename").text
-            activity_path = \
-                self.mbz_path / activity_elem.find("directory").text
-            if activity_type == 'lesson':
-                activities.append(
-                    MoodleLesson(activity_path, self.mbz_path))
-            elif activity_type == 'page':
-                activities.append(
-                    MoodlePage(activity_path, self.mbz_path))
-            elif activity_type == 'quiz':
-                activities.append(
-                    MoodleQuiz(activity_path, self.mbz_path, self.q_bank))
-        return activities
+            return xpath(self.etree, "//contents/activities/activity")
+        return xpath(
+            self.etree,
+            "//contents/activities/activity[sectionid=$section_id]",
+            section_id=str(section_id)
+        )
 
     def quizzes(self):
-        activity_elems = self.etree.xpath("//contents/activities/activity")
-        activities = []
+        activity_elems = [
+            activity_elem for activity_elem in
+            xpath(self.etree, "//contents/activities/activity")
+            if activity_elem.find("modulename").text == 'quiz'
+        ]
+        return self._load_activities(activity_elems)
+
+    def _load_activities(self, activity_elems):
+        """Load activity model objects, in parallel if there are multiple
+        workers, returning them in moodle_backup.xml order
+        """
+        loaders = []
         for activity_elem in activity_elems:
-            activity_type = activity_elem.find("modulename").text
-            if activity_type != 'quiz':
-                continue
-            activity_path = \
-                self.mbz_path / activity_elem.find("directory").text
-            activities.append(
-                MoodleQuiz(activity_path, self.mbz_path, self.q_bank))
-        return activities
+            loader = self._activity_loader(activity_elem)
+            if loader is not None:
+                loaders.append(loader)
+
+        if self.workers <= 1 or len(loaders) <= 1:
+            return [loader() for loader in loaders]
+        with ThreadPoolExecutor(
+            max_workers=min(self.workers, len(loaders))
+        ) as executor:
+            return list(executor.map(lambda loader: loader(), loaders))
+
+    def _activity_loader(self, activity_elem):
+        activity_type = activity_elem.find("modulename").text
+        activity_path = \
+            self.mbz_path / activity_elem.find("directory").text
+        if activity_type == 'lesson':
+            def factory():
+                return MoodleLesson(activity_path, self.mbz_path,
+                                    self.session, self.modified_trees)
+        elif activity_type == 'page':
+            def factory():
+                return MoodlePage(activity_path, self.mbz_path, self.session,
+                                  self.modified_trees)
+        elif activity_type == 'quiz':
+            def factory():
+                return MoodleQuiz(activity_path, self.mbz_path, self.q_bank,
+                                  self.session)
+        else:
+            return None
+
+        if self.session is None:
+            return factory
+        return lambda: self.session.get_model(
+            (activity_type, str(activity_path)), factory
+        )
 
     def sections(self):
-        section_elements = self.etree.xpath("//contents/sections/section")
+        section_elements = xpath(self.etree, "//contents/sections/section")
         sections = []
         for s in section_elements:
             sections.append(MoodleSection(s))
@@ -65,35 +260,54 @@ class MoodleBackup:
 
 
 class MoodleSection:
+    __slots__ = ("etree", "id", "title")
+
     def __init__(self, section_elem):
         self.etree = section_elem
-        self.id = self.etree.xpath("./sectionid")[0].text
-        self.title = self.etree.xpath("./title")[0].text
+        self.id = xpath(self.etree, "./sectionid")[0].text
+        self.title = xpath(self.etree, "./title")[0].text
 
 
 class MoodleQuestionBank:
+    __slots__ = (
+        "mbz_path", "questionbank_path", "session", "modified_trees",
+        "_etree", "_index"
+    )
+
     LATEST_VERSION_MARKER = "$@NULL@$"
 
-    def __init__(self, mbz_path):
+    def __init__(self, mbz_path, session=None, modified_trees=None):
         self.mbz_path = Path(mbz_path)
         self.questionbank_path = self.mbz_path / "questions.xml"
-        self.etree = etree.parse(str(self.questionbank_path))
+        self.session = session
+        self.modified_trees = resolve_modified_trees(session, modified_trees)
+        self._etree = None
+        self._index = None
+
+    @property
+    def etree(self):
+        # The full tree is only parsed when it's needed so read-only callers
+        # can use the streaming record methods below instead
+        if self._etree is None:
+            self._etree = parse_xml(self.questionbank_path, self.session)
+        return self._etree
 
     @property
     def questions(self):
         return [
-            MoodleQuestion(q) for q in self.etree.xpath(
-                "//questions/question"
+            MoodleQuestion(q, self.modified_trees) for q in xpath(
+                self.etree, "//questions/question"
             )
         ]
 
     @property
     def latest_questions(self):
+        index = self._get_index()
         questions = []
 
-        for qbe in self.etree.xpath("//question_bank_entry"):
+        for question_bank_entry_id in index.entry_ids:
             latest_question = self.get_question_by_entry(
-                qbe.attrib["id"],
+                question_bank_entry_id,
                 self.LATEST_VERSION_MARKER
             )
             questions.append(latest_question)
@@ -101,93 +315,249 @@ class MoodleQuestionBank:
         return questions
 
     def get_question_by_entry(self, question_bank_entry_id, version):
-        question_bank_entry = self.etree.xpath(
-            f'//question_bank_entry[@id="{question_bank_entry_id}"]'
-        )[0]
+        index = self._get_index()
 
         # The reference may have a specific ID or a marker to indicate latest
-        maybe_result = None
-        latest_version = 0
-        question_versions = question_bank_entry.xpath(".//question_versions")
-
-        for question_version in question_versions:
-            curr_version = question_version.xpath("./version")[0].text
-            curr_version_int = int(curr_version)
-            question = question_version.xpath(".//question")[0]
-            if (version == curr_version):
-                maybe_result = MoodleQuestion(question)
-                break
-            if (version == self.LATEST_VERSION_MARKER) and \
-               (curr_version_int > latest_version):
-                latest_version = curr_version_int
-                maybe_result = MoodleQuestion(question)
+        if version == self.LATEST_VERSION_MARKER:
+            maybe_result = index.entry_to_latest.get(question_bank_entry_id)
+        else:
+            maybe_result = index.entry_to_versions.get(
+                question_bank_entry_id, {}
+            ).get(version)
 
         if maybe_result is None:
             raise Exception(
                 f"Could not find question entry {question_bank_entry_id} "
                 f"version {version} in bank"
             )
-        return maybe_result
+        return MoodleQuestion(maybe_result, self.modified_trees)
 
     def get_entry_id_by_question_id(self, question_id):
-        question_from_question_id = self.etree.xpath(
-            f'//question[@id="{question_id}"]'
-        )[0]
-        return question_from_question_id.xpath(
-            "../../../.."
-        )[0].attrib["id"]
+        return self._get_index().question_to_entry[question_id]
+
+    def iter_question_records(self):
+        """Stream every question version in questions.xml as a
+        MoodleQuestionRecord. Unless the tree has already been parsed or is
+        shared through a session, this reads the file on disk without
+        building the full tree.
+        """
+        for entry_records in self._iter_entry_records():
+            yield from entry_records
+
+    def latest_question_records(self):
+        """Stream the latest version of each question bank entry as a
+        MoodleQuestionRecord
+        """
+        for entry_records in self._iter_entry_records():
+            yield self._latest_record(entry_records)
+
+    def iter_entry_versions(self):
+        """Stream every question bank entry as a list of its versions, as
+        MoodleQuestionRecords, along with the latest version
+        """
+        for entry_records in self._iter_entry_records():
+            yield entry_records, self._latest_record(entry_records)
+
+    def question_records_by_entry(self, entry_versions):
+        """Given an iterable of (question bank entry ID, version) pairs,
+        stream questions.xml once and return a dict mapping each pair to its
+        MoodleQuestionRecord. The version may be the latest version marker.
+        """
+        wanted = {}
+        for entry_id, version in entry_versions:
+            wanted.setdefault(entry_id, set()).add(version)
+
+        results = {}
+        for entry_records in self._iter_entry_records(wanted.keys()):
+            entry_id = entry_records[0].question_bank_entry_id
+            for version in wanted[entry_id]:
+                if (entry_id, version) in results:
+                    continue
+                if version == self.LATEST_VERSION_MARKER:
+                    results[(entry_id, version)] = \
+                        self._latest_record(entry_records)
+                    continue
+                for record in entry_records:
+                    if record.version == version:
+                        results[(entry_id, version)] = record
+                        break
+
+        for entry_id, versions in wanted.items():
+            for version in versions:
+                if (entry_id, version) not in results:
+                    raise Exception(
+                        f"Could not find question entry {entry_id} "
+                        f"version {version} in bank"
+                    )
+        return results
+
+    def _latest_record(self, entry_records):
+        latest_record = None
+        latest_version = 0
+        for record in entry_records:
+            if int(record.version) > latest_version:
+                latest_version = int(record.version)
+                latest_record = record
+        if latest_record is None:
+            raise Exception(
+                "Could not find question entry "
+                f"{entry_records[0].question_bank_entry_id} "
+                f"version {self.LATEST_VERSION_MARKER} in bank"
+            )
+        return latest_record
+
+    def _iter_entry_records(self, entry_ids=None):
+        if self._etree is not None or self.session is not None:
+            for qbe in self.etree.iter("question_bank_entry"):
+                entry_records = self._entry_records(qbe, entry_ids)
+                if entry_records:
+                    yield entry_records
+            return
+
+        with mbz_archive.open_file(self.questionbank_path) as f:
+            context = etree.iterparse(
+                f,
+                events=("end",),
+                tag="question_bank_entry"
+            )
+            for _, qbe in context:
+                entry_records = self._entry_records(qbe, entry_ids)
+                if entry_records:
+                    yield entry_records
+
+                # Release the processed entry along with any earlier siblings
+                qbe.clear(keep_tail=True)
+                while qbe.getprevious() is not None:
+                    del qbe.getparent()[0]
+
+    def _entry_records(self, qbe, entry_ids):
+        entry_id = qbe.attrib["id"]
+        if entry_ids is not None and entry_id not in entry_ids:
+            return []
+        id_number = qbe.find("idnumber").text
+        entry_records = []
+        for question_version in qbe.iter("question_versions"):
+            entry_records.append(MoodleQuestionRecord(
+                next(question_version.iter("question")),
+                entry_id,
+                id_number,
+                question_version.find("version").text
+            ))
+        return entry_records
+
+    def _get_index(self):
+        if self._index is None:
+            self._index = MoodleQuestionBankIndex(self.etree)
+        return self._index
+
+    def save(self):
+        """Write questions.xml back if it has been modified. Returns the paths
+        written.
+        """
+        if self._etree is None:
+            return []
+        return self.modified_trees.save_tree(self._etree.getroot())
 
     def delete_unused_question_bank_entries(self, used_question_entry_ids):
-        query = \
-            '//question_bank_entry'
-        elems = self.etree.xpath(query)
+        elems = xpath(self.etree, '//question_bank_entry')
         for elem in elems:
             question_bank_entry_id = elem.attrib["id"]
             if question_bank_entry_id not in used_question_entry_ids:
                 elem.getparent().remove(elem)
+                self.modified_trees.mark(self.etree.getroot())
+        self._index = None
 
     def delete_empty_categories(self):
-        elems = self.etree.xpath('//question_categories/question_category')
+        elems = xpath(self.etree, '//question_categories/question_category')
         for elem in elems:
-            questions = elem.xpath(
-                './question_bank_entries/question_bank_entry'
+            questions = xpath(
+                elem, './question_bank_entries/question_bank_entry'
             )
             if (len(questions)) == 0:
                 elem.getparent().remove(elem)
+                self.modified_trees.mark(self.etree.getroot())
 
     def inject_question_uuids(self):
-        elems = self.etree.xpath('//question_categories/question_category')
+        elems = xpath(self.etree, '//question_categories/question_category')
         for elem in elems:
-            questions = elem.xpath(
-                './question_bank_entries/question_bank_entry'
+            questions = xpath(
+                elem, './question_bank_entries/question_bank_entry'
             )
 
             for question in questions:
-                id_number = question.findall('.//idnumber')
+                id_number = xpath(question, './/idnumber')
                 if not utils.validate_uuid4(id_number[0].text):
                     id_number[0].text = str(uuid4())
+                    self.modified_trees.mark(self.etree.getroot())
+
+
+class MoodleQuestionBankIndex:
+    """Lookup tables for a question bank etree built in a single pass over
+    the document. Where an ID appears more than once the first element in
+    document order wins, matching what the equivalent XPath queries return.
+    """
+    __slots__ = (
+        "entry_ids", "entry_to_versions", "entry_to_latest",
+        "question_to_entry"
+    )
+
+    def __init__(self, questionbank_etree):
+        self.entry_ids = []
+        self.entry_to_versions = {}
+        self.entry_to_latest = {}
+        self.question_to_entry = {}
+
+        for qbe in questionbank_etree.iter("question_bank_entry"):
+            entry_id = qbe.attrib["id"]
+            self.entry_ids.append(entry_id)
+            if entry_id in self.entry_to_versions:
+                continue
+
+            versions = {}
+            latest_question = None
+            latest_version = 0
+            for question_version in qbe.iter("question_versions"):
+                curr_version = question_version.find("version").text
+                question = next(question_version.iter("question"))
+                versions.setdefault(curr_version, question)
+                if int(curr_version) > latest_version:
+                    latest_version = int(curr_version)
+                    latest_question = question
+
+            self.entry_to_versions[entry_id] = versions
+            if latest_question is not None:
+                self.entry_to_latest[entry_id] = latest_question
+
+            for question in qbe.iter("question"):
+                question_id = question.get("id")
+                if question_id is not None:
+                    self.question_to_entry.setdefault(question_id, entry_id)
 
 
 class MoodleLessonAnswer:
+    __slots__ = ("etree", "lesson_page", "answer_format")
+
     def __init__(self, etree, lesson_page):
         self.etree = etree
         self.lesson_page = lesson_page
-        self.answer_format = etree.xpath("answerformat")[0].text
+        self.answer_format = xpath(etree, "answerformat")[0].text
 
     @property
     def location(self):
         return f"{self.lesson_page.location}: Answer Value"
 
     def answer_text_html(self):
-        answer_text = self.etree.xpath("answer_text")[0]
-        return MoodleHtmlElement(answer_text, self.location)
+        answer_text = xpath(self.etree, "answer_text")[0]
+        return MoodleHtmlElement(answer_text, self.location,
+                                 self.lesson_page.modified_trees)
 
     def response_html(self):
-        if self.etree.xpath("responseformat")[0].text == "1":
-            response = self.etree.xpath("response")[0]
+        if xpath(self.etree, "responseformat")[0].text == "1":
+            response = xpath(self.etree, "response")[0]
             if response.text is not None:
                 response_location = self.location + " Response"
-                return MoodleHtmlElement(response, response_location)
+                return MoodleHtmlElement(response, response_location,
+                                         self.lesson_page.modified_trees)
             else:
                 return None
         else:
@@ -202,20 +572,23 @@ class MoodleLessonAnswer:
 
 
 class MoodleLessonPage:
-    def __init__(self, etree):
+    __slots__ = ("etree", "modified_trees", "id", "name", "next", "prev")
+
+    def __init__(self, etree, modified_trees=None):
         self.etree = etree
+        self.modified_trees = modified_trees
         self.id = self.etree.attrib['id']
-        self.name = self.etree.xpath("title")[0].text
-        self.next = self.etree.xpath("nextpageid")[0].text
-        self.prev = self.etree.xpath("prevpageid")[0].text
+        self.name = xpath(self.etree, "title")[0].text
+        self.next = xpath(self.etree, "nextpageid")[0].text
+        self.prev = xpath(self.etree, "prevpageid")[0].text
 
     @property
     def location(self):
-        lesson_name = self.etree.xpath("../../name")[0].text
+        lesson_name = xpath(self.etree, "../../name")[0].text
         return f"{lesson_name} (page: {self.name})"
 
     def page_type(self):
-        qtype = self.etree.xpath("qtype")[0].text
+        qtype = xpath(self.etree, "qtype")[0].text
         if qtype == '3':
             return 'multichoice'
         if qtype == '20':
@@ -225,8 +598,8 @@ class MoodleLessonPage:
 
     def answers(self):
         answer_objs = []
-        for answer in self.etree.xpath("answers/answer"):
-            answer_format = answer.xpath("answerformat")[0]
+        for answer in xpath(self.etree, "answers/answer"):
+            answer_format = xpath(answer, "answerformat")[0]
             # We need to check the answer format to filter out things
             # like buttons which are also serialized as answers but are
             # not HTML
@@ -238,8 +611,9 @@ class MoodleLessonPage:
 
     def html_element(self):
         return MoodleHtmlElement(
-            self.etree.xpath("contents")[0],
-            self.location
+            xpath(self.etree, "contents")[0],
+            self.location,
+            self.modified_trees
         )
 
     def html_elements(self):
@@ -251,19 +625,26 @@ class MoodleLessonPage:
 
 
 class MoodleLesson:
-    def __init__(self, activity_path, mbz_path):
+    __slots__ = (
+        "mbz_path", "activity_path", "activity_filename", "module_filename",
+        "modified_trees", "etree", "name", "module_etree"
+    )
+
+    def __init__(self, activity_path, mbz_path, session=None,
+                 modified_trees=None):
         self.mbz_path = Path(mbz_path)
+        self.modified_trees = resolve_modified_trees(session, modified_trees)
         self.activity_path = activity_path
         self.activity_filename = str(self.activity_path / "lesson.xml")
         self.module_filename = str(self.activity_path / "module.xml")
-        self.etree = etree.parse(self.activity_filename)
-        self.name = self.etree.xpath("//name")[0].text
-        self.module_etree = etree.parse(self.module_filename)
+        self.etree = parse_xml(self.activity_filename, session)
+        self.name = xpath(self.etree, "//name")[0].text
+        self.module_etree = parse_xml(self.module_filename, session)
 
     def lesson_pages(self):
         page_objs = []
-        for page in self.etree.xpath("//pages/page"):
-            page_objs.append(MoodleLessonPage(page))
+        for page in xpath(self.etree, "//pages/page"):
+            page_objs.append(MoodleLessonPage(page, self.modified_trees))
         return page_objs
 
     def html_elements(self):
@@ -273,53 +654,67 @@ class MoodleLesson:
         return elems
 
     def is_visible(self):
-        if self.module_etree.xpath("//visible")[0].text == '1':
+        if xpath(self.module_etree, "//visible")[0].text == '1':
             return '1'
-        if self.module_etree.xpath("//visible")[0].text == '0':
+        if xpath(self.module_etree, "//visible")[0].text == '0':
             return '0'
         raise Exception("Visible attribute value error in lesson "
                         f"{self.name}")  # pragma: no cover
 
 
 class MoodlePage:
-    def __init__(self, activity_path, mbz_path):
+    __slots__ = (
+        "mbz_path", "activity_path", "activity_filename", "module_filename",
+        "modified_trees", "etree", "name", "module_etree"
+    )
+
+    def __init__(self, activity_path, mbz_path, session=None,
+                 modified_trees=None):
         self.mbz_path = Path(mbz_path)
+        self.modified_trees = resolve_modified_trees(session, modified_trees)
         self.activity_path = activity_path
         self.activity_filename = str(self.activity_path / "page.xml")
         self.module_filename = str(self.activity_path / "module.xml")
-        self.etree = etree.parse(self.activity_filename)
-        self.name = self.etree.xpath("//page/name")[0].text
-        self.module_etree = etree.parse(self.module_filename)
+        self.etree = parse_xml(self.activity_filename, session)
+        self.name = xpath(self.etree, "//page/name")[0].text
+        self.module_etree = parse_xml(self.module_filename, session)
 
     def html_elements(self):
-        xpath_query = "//page/content"
-        elements = self.etree.xpath(xpath_query)
-        return [MoodleHtmlElement(el, self.name) for el in elements]
+        elements = xpath(self.etree, "//page/content")
+        return [
+            MoodleHtmlElement(el, self.name, self.modified_trees)
+            for el in elements
+        ]
 
     def is_visible(self):
-        if self.module_etree.xpath("//visible")[0].text == '1':
+        if xpath(self.module_etree, "//visible")[0].text == '1':
             return '1'
-        if self.module_etree.xpath("//visible")[0].text == '0':
+        if xpath(self.module_etree, "//visible")[0].text == '0':
             return '0'
         raise Exception("Visible attribute value error in page "
                         f"{self.name}")  # pragma: no cover
 
 
 class MoodleQuiz:
-    def __init__(self, activity_path, mbz_path, question_bank):
+    __slots__ = (
+        "mbz_path", "activity_path", "activity_filename", "etree",
+        "question_bank", "name"
+    )
+
+    def __init__(self, activity_path, mbz_path, question_bank, session=None):
         self.mbz_path = Path(mbz_path)
         self.activity_path = activity_path
         self.activity_filename = str(self.activity_path / "quiz.xml")
-        self.etree = etree.parse(self.activity_filename)
+        self.etree = parse_xml(self.activity_filename, session)
         self.question_bank = question_bank
-        self.name = self.etree.xpath("//activity/quiz/name")[0].text
+        self.name = xpath(self.etree, "//activity/quiz/name")[0].text
 
     @property
     def quiz_questions(self):
         results = []
-        quizzes = self.etree.xpath("//quiz")
+        quizzes = xpath(self.etree, "//quiz")
         for quiz in quizzes:
-            questions = quiz.xpath("./question_instances/question_instance")
+            questions = xpath(quiz, "./question_instances/question_instance")
             for question in questions:
                 results.append(MoodleQuizQuestion(question))
         return results
@@ -340,10 +735,11 @@ class MoodleQuiz:
         return elements
 
     def used_qbank_entry_ids(self):
+        quiz_questions = self.quiz_questions
         entry_ids = [
-            question.qbank_entry_id for question in self.quiz_questions
+            question.qbank_entry_id for question in quiz_questions
         ]
-        for question in self.quiz_questions:
+        for question in quiz_questions:
             entry_id = question.qbank_entry_id
             version = question.version
             moodle_question = self.question_bank\
@@ -361,32 +757,46 @@ class MoodleQuiz:
 
 class MoodleQuizQuestion:
     """This class models a <question_instance> inside of quiz.xml"""
+    __slots__ = ("etree", "qbank_entry_id", "version", "slot")
+
     def __init__(self, question_elem):
         self.etree = question_elem
         self.qbank_entry_id = \
-            self.etree.xpath(
-                "./question_reference/questionbankentryid"
+            xpath(
+                self.etree, "./question_reference/questionbankentryid"
             )[0].text
-        self.version = self.etree.xpath("./question_reference/version")[0].text
-        self.slot = self.etree.xpath("./slot")[0].text
+        self.version = intern_text(
+            xpath(self.etree, "./question_reference/version")[0].text
+        )
+        self.slot = xpath(self.etree, "./slot")[0].text
 
 
 class MoodleQuestion:
     """This class models a <question> from a <question_bank_entry> in
     questions.xml
     """
-    def __init__(self, question_elm):
+    __slots__ = (
+        "etree", "modified_trees", "id", "version", "id_number",
+        "question_type", "question_bank_entry_id"
+    )
+
+    def __init__(self, question_elm, modified_trees=None):
         self.etree = question_elm
+        self.modified_trees = modified_trees
         self.id = self.etree.attrib['id']
-        self.version = self.etree.xpath("../../version")[0].text
-        self.id_number = self.etree.xpath('../../../../idnumber')[0].text
-        self.question_type = self.etree.xpath('./qtype')[0].text
+        self.version = intern_text(
+            xpath(self.etree, "../../version")[0].text
+        )
+        self.id_number = xpath(self.etree, '../../../../idnumber')[0].text
+        self.question_type = intern_text(
+            xpath(self.etree, './qtype')[0].text
+        )
         self.question_bank_entry_id =\
-            self.etree.xpath("../../../..")[0].attrib["id"]
+            xpath(self.etree, "../../../..")[0].attrib["id"]
 
     @property
     def text(self):
-        return self.etree.xpath('./questiontext')[0].text
+        return xpath(self.etree, './questiontext')[0].text
 
     @property
     def location(self):
@@ -394,20 +804,23 @@ class MoodleQuestion:
 
     def html_elements(self):
         elements = []
-        question_texts = self.etree.xpath('.//questiontext')
+        question_texts = xpath(self.etree, './/questiontext')
         for question_html in question_texts:
             if self.question_type not in QUESTION_TEXT_IGNORE_TYPES:
-                elements.append(
-                    MoodleHtmlElement(question_html, self.location))
-        answer_texts = self.etree.xpath('.//answers/answer/answertext')
+                elements.append(MoodleHtmlElement(
+                    question_html, self.location, self.modified_trees
+                ))
+        answer_texts = xpath(self.etree, './/answers/answer/answertext')
         for answer_html in answer_texts:
             if self.question_type not in QUESTION_ANSWER_TEXT_IGNORE_TYPES:
-                elements.append(
-                    MoodleHtmlElement(answer_html, self.location))
+                elements.append(MoodleHtmlElement(
+                    answer_html, self.location, self.modified_trees
+                ))
         return elements
 
     def child_question_ids(self):
-        maybe_child_ids = self.etree.xpath(
+        maybe_child_ids = xpath(
+            self.etree,
             "./plugin_qtype_multianswer_question/multianswer/sequence"
         )
         if maybe_child_ids:
@@ -415,54 +828,161 @@ class MoodleQuestion:
         return []
 
     def multichoice_answers(self):
-        answers = self.etree.xpath(
-            './/plugin_qtype_multichoice_question/answers/answer')
+        answers = xpath(
+            self.etree, './/plugin_qtype_multichoice_question/answers/answer')
         answer_objs = []
         for answer in answers:
             answer_objs.append(MoodleMultichoiceAnswer(answer))
         return answer_objs
 
 
+class MoodleQuestionRecord:
+    """This class is a compact, tree-free copy of the data in a <question>
+    which is produced when streaming questions.xml
+    """
+    __slots__ = (
+        "id", "version", "id_number", "question_type",
+        "question_bank_entry_id", "text", "question_texts", "answer_texts",
+        "answers"
+    )
+
+    def __init__(self, question_elm, question_bank_entry_id, id_number,
+                 version):
+        self.id = question_elm.attrib['id']
+        self.version = intern_text(version)
+        self.id_number = id_number
+        self.question_type = intern_text(question_elm.find('qtype').text)
+        self.question_bank_entry_id = question_bank_entry_id
+        maybe_text = question_elm.find('questiontext')
+        self.text = maybe_text.text if maybe_text is not None else None
+        self.question_texts = [
+            elem.text for elem in question_elm.iter('questiontext')
+        ]
+        self.answer_texts = [
+            elem.text for elem in
+            xpath(question_elm, './/answers/answer/answertext')
+        ]
+        self.answers = [
+            MoodleMultichoiceAnswerRecord(answer) for answer in
+            xpath(
+                question_elm,
+                './/plugin_qtype_multichoice_question/answers/answer'
+            )
+        ]
+
+    @property
+    def location(self):
+        return f"Question bank ID {self.id} version {self.version}"
+
+    def html_elements(self):
+        elements = []
+        if self.question_type not in QUESTION_TEXT_IGNORE_TYPES:
+            for text in self.question_texts:
+                elements.append(
+                    self._html_element("questiontext", text))
+        if self.question_type not in QUESTION_ANSWER_TEXT_IGNORE_TYPES:
+            for text in self.answer_texts:
+                elements.append(
+                    self._html_element("answertext", text))
+        return elements
+
+    def multichoice_answers(self):
+        return self.answers
+
+    def _html_element(self, tag, text):
+        parent = etree.Element(tag)
+        parent.text = text
+        return MoodleHtmlElement(parent, self.location)
+
+
 class MoodleMultichoiceAnswer:
     """This class models an <answer> from the <answers> under a
     MoodleQuestion"""
+    __slots__ = ("etree", "grade", "text", "feedback")
+
     def __init__(self, answer):
         self.etree = answer
-        self.grade = float(self.etree.xpath('./fraction')[0].text)
-        self.text = self.etree.xpath('./answertext')[0].text
-        self.feedback = self.etree.xpath('./feedback')[0].text
+        self.grade = float(xpath(self.etree, './fraction')[0].text)
+        self.text = xpath(self.etree, './answertext')[0].text
+        self.feedback = xpath(self.etree, './feedback')[0].text
+
+
+class MoodleMultichoiceAnswerRecord:
+    """This class is a compact, tree-free copy of a MoodleMultichoiceAnswer
+    used by MoodleQuestionRecord"""
+    __slots__ = ("grade", "text", "feedback")
+
+    def __init__(self, answer):
+        self.grade = float(answer.find('fraction').text)
+        self.text = answer.find('answertext').text
+        self.feedback = answer.find('feedback').text
 
 
 class MoodleHtmlElement:
-    def __init__(self, parent, location):
+    """The html content of an XML element. If modified_trees is given,
+    changes to the content mark the element's file as modified there.
+    """
+    __slots__ = (
+        "parent", "location", "modified_trees", "_etree_fragments",
+        "_unnested_content"
+    )
+
+    def __init__(self, parent, location, modified_trees=None):
         self.parent = parent
-        self.location = location
-        self.etree_fragments = []
-        self.unnested_content = []
+        self.location = intern_text(location)
+        self.modified_trees = modified_trees
+        # The parent text remains the source of truth until the DOM is
+        # accessed, at which point the fragments are parsed
+        self._etree_fragments = None
+        self._unnested_content = None
+
+    @property
+    def etree_fragments(self):
+        if self._etree_fragments is None:
+            self._parse_fragments()
+        return self._etree_fragments
+
+    @property
+    def unnested_content(self):
+        if self._unnested_content is None:
+            self._parse_fragments()
+        return self._unnested_content
+
+    def _parse_fragments(self):
+        self._etree_fragments = []
+        self._unnested_content = []
         # Catch strings that exist without html tags
         temp = html.fragments_fromstring(self.parent.text)
         for fragment in temp:
             if type(fragment) not in [html.HtmlElement, html.HtmlComment]:
-                self.unnested_content.append(fragment)
+                self._unnested_content.append(fragment)
             elif (fragment.tail is not None and fragment.tail.strip()):
-                self.unnested_content.append(fragment.tail)
+                self._unnested_content.append(fragment.tail)
                 fragment.tail = None
-                self.etree_fragments.append(fragment)
+                self._etree_fragments.append(fragment)
             else:
-                self.etree_fragments.append(fragment)
+                self._etree_fragments.append(fragment)
+
+    def _reset_fragments(self):
+        self._etree_fragments = None
+        self._unnested_content = None
 
     def replace_content_tag(self):
         if self.parent.tag in ["content", "contents"]:
-            attrib_dict = self.etree_fragments[0].attrib
-            if "class" in attrib_dict.keys() and \
-                    attrib_dict["class"] == "os-raise-content":
-                return None
+            # Only content which mentions the class can already be an
+            # extracted placeholder, so avoid parsing anything else
+            if "os-raise-content" in self.parent.text:
+                attrib_dict = self.etree_fragments[0].attrib
+                if "class" in attrib_dict.keys() and \
+                        attrib_dict["class"] == "os-raise-content":
+                    return None
             content_uuid = str(uuid4())
             content = self.parent.text
             tag = f'<div class="os-raise-content" ' \
                   f'data-content-id="{content_uuid}"></div>'
 
-            self.parent.text = tag
+            self._set_text(tag)
+            self._reset_fragments()
             return {"uuid": content_uuid,
                     "content": content}
         return None
@@ -471,36 +991,46 @@ class MoodleHtmlElement:
         return html_fragments_to_string(self.etree_fragments)
 
     def remove_attr(self, attr):
-        for elem in self.etree_fragments[0].xpath(f'//*[@{attr}]'):
+        elems = xpath(self.etree_fragments[0], '//*[@*[name()=$attr]]',
+                      attr=attr)
+        for elem in elems:
             elem.attrib.pop(attr)
-        self.update_html()
+        if elems:
+            self.update_html()
 
     def get_attribute_values(self, attr, exception=None):
         values = []
-        for elem in self.etree_fragments[0].xpath(f'//*[@{attr}]'):
+        for elem in xpath(self.etree_fragments[0], '//*[@*[name()=$attr]]',
+                          attr=attr):
             if elem.tag != exception or exception is None:
                 values.append(elem.attrib[attr])
         return values
 
     def get_elements_by_name(self, element_name):
         elems = []
-        for child in self.etree_fragments[0].xpath(f'//{element_name}'):
+        for child in xpath(self.etree_fragments[0], '//*[name()=$name]',
+                           name=element_name):
             elems.append(child)
         return elems
 
     def get_elements_with_string_in_class(self, class_string):
         # NOTE: This method is only checking if the class string is included
         #  in the attribute string versus if the specific class is defined
-        xpath_query = f"//*[contains(@class, '{class_string}')]"
-        return self.etree_fragments[0].xpath(xpath_query)
+        return xpath(
+            self.etree_fragments[0],
+            "//*[contains(@class, $class_string)]",
+            class_string=class_string
+        )
 
     def get_elements_with_exact_class(self, classes):
         # NOTE This method returns a serites of elements whose classes match
         #   exactly one of the classes provided
         elems = []
         for item in classes:
-            xpath_query = f"//div[@class='{item}']"
-            elems.extend(self.etree_fragments[0].xpath(xpath_query))
+            elems.extend(xpath(
+                self.etree_fragments[0], "//div[@class=$class_name]",
+                class_name=item
+            ))
         return elems
 
     def element_is_fragment(self, elem):
@@ -508,15 +1038,20 @@ class MoodleHtmlElement:
         return elem in self.etree_fragments
 
     def update_html(self):
-        self.parent.text = self.tostring()
+        self._set_text(self.tostring())
+
+    def _set_text(self, text):
+        """Update the parent text, marking its file as modified if the text
+        changed
+        """
+        if text != self.parent.text:
+            self.parent.text = text
+            if self.modified_trees is not None:
+                self.modified_trees.mark(self.parent)
 
 
 def html_fragments_to_string(fragments):
-    # Pass things through bs4 so we can avoid adding closing tags and
-    # closing slashes that lxml may otherwise emit on void elements
-    html_content = b''.join(
-        [etree.tostring(fragment) for fragment in fragments])
-    return BeautifulSoup(
-        html_content,
-        "html.parser"
-    ).encode(formatter="html5").decode('utf-8')
+    # Serialize directly from the lxml tree with html5 formatting so we avoid
+    # adding closing tags and closing slashes that lxml may otherwise emit on
+    # void elements
+    return html_serializer.serialize_fragments(fragments)
@@ -3,12 +3,13 @@ from pathlib import Path
 from mbtools import utils
 from bs4 import BeautifulSoup
 from mbtools.generate_mbz_toc import parse_toc
+from mbtools.models import MoodleCourseSession
 import os
 import json
 
 
-def get_lesson_practice_pages(mbz_path):
-    (md_string, activity_list) = parse_toc(mbz_path)
+def get_lesson_practice_pages(mbz_path, session=None):
+    (md_string, activity_list) = parse_toc(mbz_path, session)
     filename_set = set()
 
     for activity in activity_list:
@@ -61,7 +62,9 @@ def main():
     args = parser.parse_args()
     html_directory = Path(args.html_directory).resolve(strict=True)
     mbz_path = Path(args.mbz_path).resolve(strict=True)
-    practice_lesson_set = get_lesson_practice_pages(mbz_path)
+    practice_lesson_set = get_lesson_practice_pages(
+        mbz_path, MoodleCourseSession()
+    )
     patch_pset(html_directory, practice_lesson_set)
 
 
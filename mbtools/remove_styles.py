@@ -1,6 +1,5 @@
 from pathlib import Path
 from . import models
-from mbtools.utils import write_etree
 import argparse
 
 
@@ -11,7 +10,9 @@ def remove_styles(mbz_dir):
     for activity in activities:
         for elem in activity.html_elements():
             elem.remove_attr("style")
-        write_etree(activity.activity_filename, activity.etree)
+        # Quiz elements come from the question bank, which this tool has
+        # never written, so only the activity files are saved
+        moodle_backup.modified_trees.save_tree(activity.etree.getroot())
 
 
 def main():
@@ -45,12 +45,8 @@ def replace_im_links(content_path, media_path, s3_prefix, mode):
         parse_media_file(media_path, s3_prefix)
     if (mode == 'mbz'):
         backup = utils.parse_moodle_backup(content_path)
-        activities = backup.activities()
-        q_bank = backup.q_bank
-        act_updates = 0
-        for act in activities:
-            elems = act.html_elements()
-            for elem in elems:
+        for act in backup.activities():
+            for elem in act.html_elements():
                 num_changes = replace_src_values_tree(
                     elem.etree_fragments[0],
                     IM_PREFIX,
@@ -59,10 +55,7 @@ def replace_im_links(content_path, media_path, s3_prefix, mode):
                     )
                 if (num_changes > 0):
                     elem.update_html()
-                    act_updates += 1
-            if act_updates > 0:
-                utils.write_etree(act.activity_filename, act.etree)
-        utils.write_etree(q_bank.questionbank_path, q_bank.etree)
+        backup.save()
     elif (mode == 'html'):
         for item in content_path.rglob('*.html'):
             num_changes = 0
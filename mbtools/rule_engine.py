@@ -0,0 +1,120 @@
+from time import perf_counter
+from lxml import etree
+
+
+class HtmlRule:
+    """A validation rule run by HtmlRuleEngine. Rules declare the DOM
+    elements they are interested in by tag, attribute name and class
+    substring. For each MoodleHtmlElement the engine calls start(), then
+    visit() for each matching DOM element in document order and finally
+    finish(), which returns the violations found for that element.
+    """
+    name = None
+    tags = ()
+    attributes = ()
+    class_substrings = ()
+
+    def start(self, html_elem):
+        pass
+
+    def visit(self, html_elem, node):
+        raise NotImplementedError
+
+    def finish(self, html_elem):
+        return []
+
+
+class HtmlRuleEngine:
+    """Runs a list of rules over MoodleHtmlElements, walking the DOM of each
+    element once and dispatching nodes to the rules that match them.
+    Violations are returned grouped by rule in the order the rules were
+    given, and in element order within each rule.
+
+    If a RuleProfiler is given the time spent in each rule is recorded,
+    which adds a timer call around every rule callback.
+    """
+    def __init__(self, rules, profiler=None):
+        self.rules = rules
+        self.profiler = profiler
+        self._rules_by_tag = {}
+        self._rules_by_attribute = {}
+        self._rules_by_class = []
+        for rule in rules:
+            for tag in rule.tags:
+                self._rules_by_tag.setdefault(tag, []).append(rule)
+            for attribute in rule.attributes:
+                self._rules_by_attribute.setdefault(attribute, []).append(rule)
+            for class_substring in rule.class_substrings:
+                self._rules_by_class.append((class_substring, rule))
+
+    def run(self, html_elements):
+        return [
+            violation for violations in self.run_by_rule(html_elements)
+            for violation in violations
+        ]
+
+    def run_by_rule(self, html_elements):
+        """Run the rules and return a list of violations for each rule"""
+        if self.profiler is not None:
+            return self._run_by_rule_profiled(html_elements)
+        rule_violations = [[] for _ in self.rules]
+        for html_elem in html_elements:
+            for rule in self.rules:
+                rule.start(html_elem)
+
+            # Fragments share a document, so walking from its root visits
+            # the same elements as a // query from any fragment
+            root = html_elem.etree_fragments[0].getroottree().getroot()
+            for node in root.iter(etree.Element):
+                for rule in self._matching_rules(node):
+                    rule.visit(html_elem, node)
+
+            for violations, rule in zip(rule_violations, self.rules):
+                violations.extend(rule.finish(html_elem))
+        return rule_violations
+
+    def _run_by_rule_profiled(self, html_elements):
+        rule_violations = [[] for _ in self.rules]
+        rule_indexes = {rule: idx for idx, rule in enumerate(self.rules)}
+        for html_elem in html_elements:
+            seconds = [0.0] * len(self.rules)
+            nodes = [0] * len(self.rules)
+            for idx, rule in enumerate(self.rules):
+                start = perf_counter()
+                rule.start(html_elem)
+                seconds[idx] += perf_counter() - start
+
+            root = html_elem.etree_fragments[0].getroottree().getroot()
+            for node in root.iter(etree.Element):
+                for rule in self._matching_rules(node):
+                    idx = rule_indexes[rule]
+                    start = perf_counter()
+                    rule.visit(html_elem, node)
+                    seconds[idx] += perf_counter() - start
+                    nodes[idx] += 1
+
+            for idx, rule in enumerate(self.rules):
+                start = perf_counter()
+                violations = rule.finish(html_elem)
+                seconds[idx] += perf_counter() - start
+                rule_violations[idx].extend(violations)
+                self.profiler.record(
+                    rule.name or type(rule).__name__, html_elem.location,
+                    seconds[idx], len(violations), nodes[idx]
+                )
+        return rule_violations
+
+    def _matching_rules(self, node):
+        matches = list(self._rules_by_tag.get(node.tag, ()))
+        for attribute in node.attrib:
+            for rule in self._rules_by_attribute.get(attribute, ()):
+                if rule not in matches:
+                    matches.append(rule)
+        if self._rules_by_class:
+            class_string = node.get("class")
+            if class_string is not None:
+                for class_substring, rule in self._rules_by_class:
+                    if class_substring in class_string and \
+                            rule not in matches:
+                        matches.append(rule)
+        return matches
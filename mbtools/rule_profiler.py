@@ -0,0 +1,108 @@
+import heapq
+import json
+from time import perf_counter
+
+
+class RuleStats:
+    __slots__ = ("seconds", "elements", "nodes", "violations", "slowest")
+
+    def __init__(self):
+        self.seconds = 0.0
+        self.elements = 0
+        self.nodes = 0
+        self.violations = 0
+        # A min-heap of (seconds, location) for the slowest locations
+        self.slowest = []
+
+
+class RuleProfiler:
+    """Collects the time spent in each validation rule along with the
+    number of html elements and DOM nodes it visited, the violations it
+    found and its slowest locations
+    """
+    def __init__(self, slowest=10):
+        self.max_slowest = slowest
+        self.rules = {}
+        self._started = perf_counter()
+
+    def record(self, rule, location, seconds, violations=0, nodes=0,
+               elements=1):
+        stats = self.rules.get(rule)
+        if stats is None:
+            stats = self.rules[rule] = RuleStats()
+        stats.seconds += seconds
+        stats.elements += elements
+        stats.nodes += nodes
+        stats.violations += violations
+        self._add_slowest(stats, seconds, str(location))
+
+    def _add_slowest(self, stats, seconds, location):
+        if len(stats.slowest) < self.max_slowest:
+            heapq.heappush(stats.slowest, (seconds, location))
+        elif stats.slowest and seconds > stats.slowest[0][0]:
+            heapq.heapreplace(stats.slowest, (seconds, location))
+
+    def call(self, rule, location, func, *args):
+        """Call func, which returns a list of violations, and record it"""
+        start = perf_counter()
+        violations = func(*args)
+        self.record(rule, location, perf_counter() - start, len(violations))
+        return violations
+
+    def iter_profiled(self, rule, location, violations):
+        """Yield from an iterable of violations, recording the time spent
+        producing them but not the time spent by the consumer
+        """
+        iterator = iter(violations)
+        seconds = 0.0
+        count = 0
+        while True:
+            start = perf_counter()
+            try:
+                violation = next(iterator)
+            except StopIteration:
+                seconds += perf_counter() - start
+                break
+            seconds += perf_counter() - start
+            count += 1
+            yield violation
+        self.record(rule, location, seconds, count)
+
+    def merge(self, other):
+        """Add the stats collected by another profiler, e.g. in a worker
+        process
+        """
+        for rule, other_stats in other.rules.items():
+            stats = self.rules.get(rule)
+            if stats is None:
+                stats = self.rules[rule] = RuleStats()
+            stats.seconds += other_stats.seconds
+            stats.elements += other_stats.elements
+            stats.nodes += other_stats.nodes
+            stats.violations += other_stats.violations
+            for seconds, location in other_stats.slowest:
+                self._add_slowest(stats, seconds, location)
+
+    def report(self):
+        return {
+            "wall_seconds": perf_counter() - self._started,
+            "rules": {
+                rule: {
+                    "seconds": stats.seconds,
+                    "elements": stats.elements,
+                    "nodes": stats.nodes,
+                    "violations": stats.violations,
+                    "slowest": [
+                        {"location": location, "seconds": seconds}
+                        for seconds, location in sorted(
+                            stats.slowest, reverse=True
+                        )
+                    ]
+                }
+                for rule, stats in self.rules.items()
+            }
+        }
+
+    def save(self, report_path):
+        with open(report_path, "w") as f:
+            json.dump(self.report(), f, indent=2)
@@ -0,0 +1,104 @@
+import json
+import re
+
+
+def trie_pattern(strings):
+    """Compile strings into a regular expression which matches any of them.
+    The strings are arranged in a trie so shared prefixes (e.g. https://) are
+    only matched once rather than once per string.
+    """
+    trie = {}
+    for string in strings:
+        node = trie
+        for char in string:
+            node = node.setdefault(char, {})
+        node[""] = {}
+    return _node_pattern(trie)
+
+
+def _node_pattern(node):
+    branches = [
+        re.escape(char) + _node_pattern(child)
+        for char, child in sorted(node.items()) if char != ""
+    ]
+    if not branches:
+        return ""
+    if len(branches) == 1 and "" not in node:
+        return branches[0]
+    pattern = "(?:" + "|".join(branches) + ")"
+    if "" in node:
+        # A string ends here, so the rest is optional
+        pattern += "?"
+    return pattern
+
+
+class UrlAllowlist:
+    """Checks URLs against a list of allowed prefixes and exact values. By
+    default a URL is allowed if any prefix appears anywhere in it, matching
+    how the lists have always been applied. In strict mode the URL has to
+    start with one of the prefixes.
+    """
+    def __init__(self, prefixes, values=(), strict=False):
+        self.prefixes = list(prefixes)
+        self.values = frozenset(values)
+        self.strict = strict
+        if self.prefixes:
+            compiled = re.compile(trie_pattern(self.prefixes))
+            self._match = compiled.match if strict else compiled.search
+        else:
+            self._match = None
+
+    def allows(self, url):
+        if url in self.values:
+            return True
+        return self._match is not None and self._match(url) is not None
+
+    def config(self):
+        return {
+            "prefixes": self.prefixes,
+            "values": sorted(self.values),
+            "strict": self.strict
+        }
+
+
+class UrlAllowlists:
+    """The allowlists used to validate resource sources, iframe targets and
+    link hrefs
+    """
+    KEYS = {
+        "source_prefixes", "iframe_prefixes", "href_prefixes", "href_values"
+    }
+
+    def __init__(self, source_prefixes, iframe_prefixes, href_prefixes,
+                 href_values, strict=False):
+        self.source = UrlAllowlist(source_prefixes, strict=strict)
+        self.iframe = UrlAllowlist(iframe_prefixes, strict=strict)
+        self.href = UrlAllowlist(href_prefixes, href_values, strict=strict)
+
+    def config(self):
+        return {
+            "source": self.source.config(),
+            "iframe": self.iframe.config(),
+            "href": self.href.config()
+        }
+
+    @classmethod
+    def from_file(cls, config_path, defaults, strict=False):
+        """Load allowlists from a JSON file. Lists in the file replace the
+        corresponding lists in defaults, a dict with the same keys as the
+        constructor arguments. The file may also set "strict", which can
+        turn strict mode on but not off if strict is given.
+        """
+        with open(config_path) as f:
+            config = json.load(f)
+        unknown = set(config) - cls.KEYS - {"strict"}
+        if unknown:
+            raise Exception(
+                f"Unknown allowlist keys in {config_path}: "
+                f"{', '.join(sorted(unknown))}"
+            )
+        lists = dict(defaults)
+        lists.update(
+            (key, value) for key, value in config.items() if key in cls.KEYS
+        )
+        return cls(strict=strict or config.get("strict", False), **lists)
@@ -1,5 +1,6 @@
 from pathlib import Path
 from . import models
+from .xpath_queries import xpath
 from uuid import UUID
 
 
@@ -15,53 +16,63 @@ def write_html_soup(file_path, soup):
         f.write(soup.encode(formatter="html5").decode('utf-8'))
 
 
-def parse_moodle_backup(mbz_dir):
+def parse_moodle_backup(mbz_dir, session=None):
     """
-    Given a string with a path to an extracted moodle backup directory,
-    return a moodle backup object
+    Given a string with a path to an extracted moodle backup directory or a
+    .mbz archive, return a moodle backup object. If a course session is
+    provided, parsed files and model objects are shared with other users of
+    the session.
     """
     mbz_path = Path(mbz_dir).resolve(strict=True)
+    if session is not None:
+        return session.moodle_backup(mbz_path)
     return models.MoodleBackup(mbz_path)
 
 
-def parse_backup_activities(mbz_path):
+def parse_backup_activities(mbz_path, session=None):
     """
     Given a string with path to an extracted moodle backup directory return
     model objects for course activities
     """
-    moodle_backup = parse_moodle_backup(mbz_path)
+    moodle_backup = parse_moodle_backup(mbz_path, session)
     return moodle_backup.activities()
 
 
-def parse_backup_quizzes(mbz_path):
+def parse_backup_quizzes(mbz_path, session=None):
     """
     Given a string with path to an extracted moodle backup directory return
     model objects for course quizzes
     """
-    moodle_backup = parse_moodle_backup(mbz_path)
+    moodle_backup = parse_moodle_backup(mbz_path, session)
     return moodle_backup.quizzes()
 
 
-def parse_backup_elements(mbz_dir):
+def parse_backup_elements(mbz_dir, session=None):
     """
     Given a string with path to an extracted moodle backup directory return
     model objects for course html elements
     """
     html_elements = []
-    activities = parse_backup_activities(mbz_dir)
+    activities = parse_backup_activities(mbz_dir, session)
     for activity in activities:
         html_elements.extend(activity.html_elements())
     return html_elements
 
 
-def parse_question_bank_latest_for_html(mbz_dir):
+def parse_question_bank_latest_for_html(mbz_dir, session=None):
     """
     Given a string with path to a question_bank directory from an extracted
-    moodle backup, return a list of the html elements for each question
+    moodle backup, return a list of the html elements for each question.
+    The elements are backed by the question bank tree, so changes made
+    through them are written when the question bank is saved.
     """
 
     mbz_path = Path(mbz_dir).resolve(strict=True)
-    latest_questions = models.MoodleQuestionBank(mbz_path).latest_questions
+    if session is not None:
+        question_bank = session.question_bank(mbz_path)
+    else:
+        question_bank = models.MoodleQuestionBank(mbz_path)
+    latest_questions = question_bank.latest_questions
     html = []
     for question in latest_questions:
         for item in question.html_elements():
@@ -83,8 +94,10 @@ def find_elements_containing(content_etree, src_content):
     Given a etree object and a prefix for a resource, this function will
     return the elementss from the etree that contain the src_content prefix
     """
-    return content_etree.xpath(
-        f'//*[contains(@src, "{src_content}")]'
+    return xpath(
+        content_etree,
+        '//*[contains(@src, $src_content)]',
+        src_content=src_content
     )
 
 
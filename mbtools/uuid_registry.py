@@ -0,0 +1,74 @@
+import sqlite3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS uuids (
+    uuid TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    course TEXT NOT NULL,
+    location TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS uuids_uuid ON uuids (uuid);
+CREATE INDEX IF NOT EXISTS uuids_course ON uuids (course);
+"""
+
+
+class UuidRegistry:
+    """A SQLite database of the UUIDs used by each course, so duplicates can
+    be found across courses. Records are (uuid, kind, location) tuples where
+    kind says what the UUID identifies (e.g. an interactive block or a
+    question) and location is where it was found in the course.
+    """
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._conn = sqlite3.connect(db_path)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+
+    def find_duplicates(self, course, records):
+        """Return (index, other_course, other_kind, other_location) for each
+        record whose UUID is registered by another course, where index is
+        the position of the record in records
+        """
+        with self._conn:
+            self._conn.execute(
+                "CREATE TEMP TABLE IF NOT EXISTS new_uuids "
+                "(idx INTEGER, uuid TEXT)"
+            )
+            self._conn.execute("DELETE FROM new_uuids")
+            self._conn.executemany(
+                "INSERT INTO new_uuids VALUES (?, ?)",
+                ((idx, record[0]) for idx, record in enumerate(records))
+            )
+            return self._conn.execute(
+                "SELECT n.idx, u.course, u.kind, u.location FROM new_uuids n "
+                "JOIN uuids u ON u.uuid = n.uuid AND u.course != ? "
+                "ORDER BY n.idx, u.course, u.location",
+                (course,)
+            ).fetchall()
+
+    def replace_course(self, course, records):
+        """Replace the records registered for a course"""
+        with self._conn:
+            self._conn.execute("DELETE FROM uuids WHERE course = ?", (course,))
+            self._conn.executemany(
+                "INSERT INTO uuids VALUES (?, ?, ?, ?)",
+                ((uuid, kind, course, location)
+                 for uuid, kind, location in records)
+            )
+
+    def courses(self):
+        return [
+            course for (course,) in self._conn.execute(
+                "SELECT DISTINCT course FROM uuids ORDER BY course"
+            )
+        ]
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
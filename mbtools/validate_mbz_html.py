@@ -1,11 +1,23 @@
 import argparse
+import hashlib
+import json
+import math
+import sys
+import time
+from time import perf_counter
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 from lxml import etree
-from csv import DictWriter
 from pathlib import Path
 
-from mbtools.models import MoodleHtmlElement, MoodleQuestionBank, \
-    MoodleLesson, MoodlePage
+from mbtools.models import MoodleHtmlElement, MoodleLesson, MoodleQuiz
 from . import utils
+from mbtools.rule_engine import HtmlRule, HtmlRuleEngine
+from mbtools.rule_profiler import RuleProfiler
+from mbtools.validation_cache import ValidationCache
+from mbtools.url_allowlist import UrlAllowlists
+from mbtools.violation_writers import VIOLATION_WRITERS, write_violations
+from mbtools.uuid_registry import UuidRegistry
 
 STYLE_VIOLATION = "ERROR: Uses In-Line Styles"
 SOURCE_VIOLATION = "ERROR: Uses External Resource with Invalid Prefix"
@@ -24,6 +36,30 @@ INVALID_QBANK_UUID_VIOLATION = "ERROR: Invalid question bank UUID"
 TABLE_VIOLATION = "ERROR: Table violation: "
 DUPLICATE_CONTENT_UUID_VIOLATION = "ERROR: Duplicate content UUID"
 EXTRACTED_HTML_CORRUPTION_VIOLATION = "ERROR: Extracted HTML corruption"
+CROSS_COURSE_UUID_VIOLATION = "ERROR: UUID used in another course"
+
+# The rule reporting each issue, for per-rule violation caps. Table issues
+# start with TABLE_VIOLATION followed by the details.
+ISSUE_RULES = {
+    UNNESTED_VIOLATION: "unnested",
+    STYLE_VIOLATION: "style",
+    SOURCE_VIOLATION: "source",
+    MOODLE_VIOLATION: "source",
+    SCRIPT_VIOLATION: "tag",
+    IFRAME_VIOLATION: "tag",
+    HREF_VIOLATION: "tag",
+    LINK_TARGET_VIOLATION: "tag",
+    NESTED_IB_VIOLATION: "nested_ib",
+    DUPLICATE_IB_UUID_VIOLATION: "ib_uuid",
+    MISSING_IB_UUID_VIOLATION: "ib_uuid",
+    INVALID_IB_UUID_VIOLATION: "ib_uuid",
+    DUPLICATE_QBANK_UUID_VIOLATION: "qbank_uuid",
+    INVALID_QBANK_UUID_VIOLATION: "qbank_uuid",
+    DUPLICATE_CONTENT_UUID_VIOLATION: "extracted_uuid",
+    EXTRACTED_HTML_CORRUPTION_VIOLATION: "extracted_corruption",
+    CROSS_COURSE_UUID_VIOLATION: "uuid_registry"
+}
+RULE_NAMES = sorted(set(ISSUE_RULES.values()) | {"table"})
 
 VALID_PREFIXES = [
     "https://k12.openstax.org/contents/raise",
@@ -83,8 +119,18 @@ VALID_STYLES = []
 IB_CLASS_PREFIX = "os-raise-ib-"
 IB_ALLOWED_NESTING = ["os-raise-ib-tooltip"]
 
+# Bump this when the html rules change so that cached validation results are
+# discarded
+HTML_RULES_VERSION = 1
+
+# Elements are split into this many chunks per worker process to balance the
+# load when validating in parallel
+CHUNKS_PER_JOB = 4
+
 
 class Violation:
+    __slots__ = ("issue", "location", "link")
+
     def __init__(self, issue, location, link=None):
         self.issue = issue
         self.location = location
@@ -97,86 +143,882 @@ class Violation:
         return dict
 
 
+def issue_rule(issue):
+    if issue.startswith(TABLE_VIOLATION):
+        return "table"
+    return ISSUE_RULES[issue]
+
+
+class ViolationBudget:
+    """Limits the number of violations reported, in total and per rule, so
+    that validation can stop as soon as the total is reached
+    """
+    def __init__(self, max_violations=None, rule_caps=None):
+        self.max_violations = max_violations
+        self.rule_caps = rule_caps or {}
+        self.count = 0
+        self.rule_counts = {}
+
+    @property
+    def exhausted(self):
+        return self.max_violations is not None and \
+            self.count >= self.max_violations
+
+    def accept(self, violation):
+        """Count a violation and return whether it should be reported"""
+        if self.exhausted:
+            return False
+        rule = issue_rule(violation.issue)
+        rule_count = self.rule_counts.get(rule, 0)
+        cap = self.rule_caps.get(rule)
+        if cap is not None and rule_count >= cap:
+            return False
+        self.rule_counts[rule] = rule_count + 1
+        self.count += 1
+        return True
+
+    def filter(self, violations):
+        """Yield the violations which are accepted, stopping once the budget
+        is exhausted so that nothing more is computed
+        """
+        if self.exhausted:
+            return
+        for violation in violations:
+            if self.accept(violation):
+                yield violation
+            if self.exhausted:
+                return
+
+
 def validate_mbz(mbz_path, include_styles=True, include_questionbank=False,
-                 uuids_populated=False):
-    question_bank = MoodleQuestionBank(mbz_path)
-
-    html_elements = utils.parse_backup_elements(mbz_path)
-    if include_questionbank:
-        html_elements += utils.parse_question_bank_latest_for_html(mbz_path)
-    html_validations = run_html_validations(html_elements, include_styles,
-                                            uuids_populated)
-    qbank_validations = run_qbank_validations(question_bank)
-    activities = utils.parse_backup_activities(mbz_path)
-    extracted_html_validations = run_extracted_html_validations(activities)
-
-    return html_validations + qbank_validations + extracted_html_validations
-
-
-def validate_html(html_dir, include_styles=True, uuids_populated=False):
-    all_files = []
-    for path in Path(html_dir).rglob('*.html'):
-        all_files.append(path)
-    html_elements = []
+                 uuids_populated=False, jobs=1, allowlists=None,
+                 profiler=None, uuid_registry=None, course=None,
+                 budget=None):
+    return list(iter_mbz_violations(
+        mbz_path, include_styles, include_questionbank, uuids_populated, jobs,
+        allowlists, profiler, uuid_registry, course, budget
+    ))
+
+
+def iter_mbz_violations(mbz_path, include_styles=True,
+                        include_questionbank=False, uuids_populated=False,
+                        jobs=1, allowlists=None, profiler=None,
+                        uuid_registry=None, course=None, budget=None):
+    """Yield the violations validate_mbz returns, in the same order, as each
+    group of checks completes. If a UuidRegistry is given the course's UUIDs
+    are checked against the other courses in it and then registered under
+    course, which defaults to the name of mbz_path.
+
+    If a ViolationBudget is given only the violations that fit in it are
+    yielded, which are always the first of those an unbudgeted run yields.
+    With a single job validation stops once it is exhausted, without
+    loading the remaining activities or the question bank. As html
+    violations other than unnested content are only reported if no element
+    has unnested content, this can only happen once unnested content has
+    been found or all the html has been checked. With a UuidRegistry the
+    whole course is always read, so that all of its UUIDs are registered
+    however much of the budget was used.
+    """
+    # The models are created without a session so that each activity's
+    # trees can be released once it has been checked. Only the per-element
+    # results and UUIDs are kept until the end, when the cross-element
+    # checks are made and the violations are reported in the usual order.
+    backup = utils.parse_moodle_backup(mbz_path)
+    question_bank = backup.q_bank
+    engine = None
+    if jobs <= 1:
+        engine = element_rule_engine(include_styles, allowlists, profiler)
+    uuid_records = []
+    unnested_found = False
+
+    def element_items(html_elements):
+        """Validate the elements, or with multiple jobs keep only their html
+        text for the worker processes
+        """
+        nonlocal unnested_found
+        if uuid_registry is not None:
+            uuid_records.extend(html_uuid_records(html_elements))
+        if engine is None:
+            return [
+                (elem.parent.tag, elem.parent.text, elem.location)
+                for elem in html_elements
+            ]
+        items = []
+        for elem in html_elements:
+            if unnested_found:
+                # Only unnested content is reported once any is found, so
+                # the other rules aren't run
+                items.append(ElementResult(
+                    elem.location,
+                    find_unnested_violations([elem], profiler), None, None
+                ))
+            else:
+                items.append(validate_element(elem, engine))
+                unnested_found = bool(items[-1].unnested)
+        return items
+
+    # The element items of each activity in order. Quizzes are None until
+    # their questions have been read from the question bank.
+    activity_items = []
+    quiz_refs = []
+
+    # With a budget and a single job, unnested content violations are
+    # counted against it in element order as soon as every element before
+    # them has been checked, so validation can stop early. A quiz holds this
+    # up until the question bank has been read.
+    accepted_unnested = []
+    settled = 0
+
+    def stop_early():
+        return budget is not None and budget.exhausted and \
+            uuid_registry is None
+
+    def accept_unnested(items):
+        if budget is not None and engine is not None:
+            accepted_unnested.extend(
+                violation for result in items for violation in result.unnested
+                if budget.accept(violation)
+            )
+
+    def settle_activities():
+        nonlocal settled
+        while settled < len(activity_items) and \
+                activity_items[settled] is not None:
+            accept_unnested(activity_items[settled])
+            settled += 1
+
+    def extracted_elements():
+        # The extracted html checks pull activities one at a time, so each
+        # activity is validated and then dropped before the next is loaded.
+        # They are given the same elements, so that each element's html is
+        # only parsed once.
+        for activity in backup.iter_activities():
+            if isinstance(activity, MoodleQuiz):
+                quiz_refs.append((len(activity_items), [
+                    (question.qbank_entry_id, question.version)
+                    for question in activity.quiz_questions
+                ]))
+                activity_items.append(None)
+                continue
+            if isinstance(activity, MoodleLesson):
+                html_elements = []
+                checked_elements = []
+                for page in activity.lesson_pages():
+                    page_elements = page.html_elements()
+                    # The page content comes before its answers, which
+                    # aren't checked for extracted html
+                    checked_elements.append(page_elements[0])
+                    html_elements.extend(page_elements)
+            else:
+                html_elements = activity.html_elements()
+                checked_elements = html_elements
+            activity_items.append(element_items(html_elements))
+            settle_activities()
+            yield from checked_elements
+            if stop_early():
+                return
+
+    extracted_violations = list(
+        run_extracted_html_validations(extracted_elements(), profiler)
+    )
+    if stop_early():
+        yield from accepted_unnested
+        return
+
+    # Stream the question bank once, one entry at a time
+    wanted_versions = {}
+    for _, refs in quiz_refs:
+        for entry_id, version in refs:
+            wanted_versions.setdefault(entry_id, set()).add(version)
+    quiz_records = {}
+    question_items = []
+    qbe_to_uuid = {}
+    for entry_records, latest in question_bank.iter_entry_versions():
+        entry_id = latest.question_bank_entry_id
+        qbe_to_uuid[entry_id] = latest.id_number
+        if include_questionbank:
+            question_items.extend(element_items(latest.html_elements()))
+        for version in wanted_versions.get(entry_id, ()):
+            if version == question_bank.LATEST_VERSION_MARKER:
+                quiz_records[(entry_id, version)] = latest
+                continue
+            for record in entry_records:
+                if record.version == version:
+                    quiz_records[(entry_id, version)] = record
+
+    for idx, refs in quiz_refs:
+        items = []
+        for entry_id, version in refs:
+            record = quiz_records.get((entry_id, version))
+            if record is None:
+                raise Exception(
+                    f"Could not find question entry {entry_id} "
+                    f"version {version} in bank"
+                )
+            items.extend(element_items(record.html_elements()))
+        activity_items[idx] = items
+    settle_activities()
+    accept_unnested(question_items)
+
+    # The course is registered before any violations are yielded, so that
+    # it doesn't depend on how many of them are consumed
+    registry_violations = []
+    if uuid_registry is not None:
+        if course is None:
+            course = Path(mbz_path).name
+        registry_violations = run_uuid_registry(
+            mbz_path, uuid_registry, course,
+            uuid_records + question_uuid_records(question_bank, qbe_to_uuid)
+        )
+
+    items = [item for items in activity_items for item in items] + \
+        question_items
+    if engine is None:
+        results = validate_element_data(
+            items, include_styles, jobs, allowlists, profiler
+        )
+    else:
+        results = items
+    html_violations = reduce_element_results(
+        results, include_styles, uuids_populated, profiler
+    )
+
+    def budgeted(violations):
+        if budget is None:
+            return violations
+        return budget.filter(violations)
+
+    if budget is not None and engine is not None and unnested_found:
+        # These were already counted against the budget
+        yield from accepted_unnested
+    else:
+        yield from budgeted(html_violations)
+    yield from budgeted(
+        run_qbank_validations(question_bank, profiler, qbe_to_uuid)
+    )
+    yield from budgeted(extracted_violations)
+    yield from budgeted(registry_violations)
+
+
+def run_uuid_registry(mbz_path, uuid_registry, course, records):
+    """Check the UUID records against the other courses in the registry,
+    then register them under course. Returns the violations found.
+    """
+    violations = list(
+        run_uuid_registry_validations(uuid_registry, course, records)
+    )
+    # Locations in the registry are relative to the backup so they are the
+    # same wherever the course was validated from
+    uuid_registry.replace_course(course, [
+        (uuid, kind, course_location(location, mbz_path))
+        for uuid, kind, location in records
+    ])
+    return violations
+
+
+def html_uuid_records(html_elements):
+    """Return (uuid, kind, location) for the interactive block and extracted
+    content UUIDs in html elements
+    """
+    records = []
+    for elem in html_elements:
+        if elem.unnested_content:
+            continue
+        location = str(elem.location)
+        for kind, classes in [("ib", IbUuidRule.NEED_IDS),
+                              ("content", ["os-raise-content"])]:
+            for block in elem.get_elements_with_exact_class(classes):
+                uuid = block.get("data-content-id")
+                if uuid:
+                    records.append((uuid, kind, location))
+    return records
+
+
+def question_uuid_records(question_bank, qbe_to_uuid):
+    location = str(question_bank.questionbank_path)
+    return [
+        (id_number, "question", location)
+        for id_number in qbe_to_uuid.values() if id_number
+    ]
+
+
+def course_location(location, mbz_path):
+    path = Path(location)
+    if path.is_relative_to(mbz_path):
+        return path.relative_to(mbz_path).as_posix()
+    return location
+
+
+def run_uuid_registry_validations(uuid_registry, course, records):
+    duplicates = uuid_registry.find_duplicates(course, records)
+    for idx, other_course, other_kind, other_location in duplicates:
+        uuid, kind, location = records[idx]
+        yield Violation(
+            CROSS_COURSE_UUID_VIOLATION,
+            location,
+            f"{kind} uuid: {uuid} also used by {other_kind} in "
+            f"{other_course}: {other_location}"
+        )
+
+
+def validate_html(html_dir, include_styles=True, uuids_populated=False,
+                  jobs=1, cache_path=None, allowlists=None, profiler=None,
+                  budget=None):
+    return list(iter_html_violations(
+        html_dir, include_styles, uuids_populated, jobs, cache_path,
+        allowlists, profiler, budget
+    ))
+
+
+def iter_html_violations(html_dir, include_styles=True,
+                         uuids_populated=False, jobs=1, cache_path=None,
+                         allowlists=None, profiler=None, budget=None):
+    """Yield the violations validate_html returns, in the same order. The
+    files are read and validated one at a time and only their
+    ElementResults are kept, so the parsed html of a large directory isn't
+    held in memory. As the rule violations are reported grouped by rule
+    they are only yielded once every file has been checked.
+    """
+    all_files = list(Path(html_dir).rglob('*.html'))
+    if budget is not None and cache_path is None and jobs <= 1:
+        yield from run_budgeted_html_validations(
+            (read_html_file(file_path) for file_path in all_files),
+            include_styles, uuids_populated, budget, allowlists, profiler
+        )
+        return
+
+    cache = None
+    if cache_path is not None:
+        cache = ValidationCache(
+            cache_path, html_rules_fingerprint(include_styles, allowlists)
+        )
+    engine = None
+    if jobs <= 1:
+        engine = element_rule_engine(include_styles, allowlists, profiler)
+    unnested_found = False
+    results = []
+    # The index, cache key and (tag, text, location) of each file left for
+    # the worker processes
+    changed = []
     for file_path in all_files:
-        with open(file_path, 'r') as f:
-            parent_string = '<content></content>'
-            parent_element = etree.fromstring(parent_string)
-            parent_element.text = f.read()
-            html_elements.append(
-                MoodleHtmlElement(parent_element, str(file_path))
+        html_elem = read_html_file(file_path)
+        key = None
+        if cache is not None:
+            # Cache entries are keyed by path relative to html_dir so the
+            # cache can be reused from another checkout
+            key = file_path.relative_to(html_dir).as_posix()
+            cached = cache.get(key, html_elem.parent.text)
+            if cached is not None:
+                results.append(
+                    ElementResult.fromDict(html_elem.location, cached)
+                )
+                continue
+        if engine is None:
+            changed.append((len(results), key, (
+                html_elem.parent.tag, html_elem.parent.text,
+                html_elem.location
+            )))
+            results.append(None)
+        elif unnested_found and cache is None:
+            # Only unnested content is reported once any is found, so the
+            # other rules aren't run. Cached results have to be complete.
+            results.append(ElementResult(
+                html_elem.location,
+                find_unnested_violations([html_elem], profiler), None, None
+            ))
+        else:
+            results.append(validate_element(html_elem, engine))
+            unnested_found = unnested_found or bool(results[-1].unnested)
+            if cache is not None:
+                cache.set(key, html_elem.parent.text, results[-1].toDict())
+
+    if changed:
+        changed_results = validate_element_data(
+            [element_data for _, _, element_data in changed],
+            include_styles, jobs, allowlists, profiler
+        )
+        for (idx, key, element_data), result in zip(changed, changed_results):
+            results[idx] = result
+            if cache is not None:
+                cache.set(key, element_data[1], result.toDict())
+    if cache is not None:
+        cache.save()
+    violations = reduce_element_results(
+        results, include_styles, uuids_populated, profiler
+    )
+    if budget is not None:
+        # With worker processes or cached results every element is
+        # checked, so the budget only limits what is reported
+        violations = budget.filter(violations)
+    yield from violations
+
+
+def read_html_file(file_path):
+    with open(file_path, 'r') as f:
+        parent_string = '<content></content>'
+        parent_element = etree.fromstring(parent_string)
+        parent_element.text = f.read()
+        return MoodleHtmlElement(parent_element, str(file_path))
+
+
+# Errors from reading or parsing a single html file, e.g. one which is
+# being saved, which shouldn't stop a watch session
+WATCH_FILE_ERRORS = (OSError, ValueError, IndexError, etree.LxmlError)
+
+
+class HtmlWatcher:
+    """Keeps the per-file results of validating a directory of html files in
+    memory, so the directory can be revalidated after edits by parsing only
+    the files that were added or changed. Cross-file interactive block UUID
+    checks are rerun from the stored UUIDs of every file, which gives the
+    same violations as validate_html.
+
+    Files which can't be read or parsed, e.g. because an editor is part way
+    through saving them, are left out of the results and listed in errors.
+    They are tried again on every poll.
+    """
+    def __init__(self, html_dir, include_styles=True, uuids_populated=False,
+                 jobs=1, allowlists=None):
+        self.html_dir = Path(html_dir)
+        self.include_styles = include_styles
+        self.uuids_populated = uuids_populated
+        self.jobs = jobs
+        self.allowlists = allowlists
+        # Maps each file to its (mtime_ns, size) and ElementResult
+        self._files = {}
+        # Maps each file which failed to its error message and the
+        # (mtime_ns, size) it failed with
+        self.errors = {}
+        self._error_keys = {}
+
+    def validate(self):
+        """Return the violations for the directory and the files which were
+        added, changed, removed or newly failed since the previous call
+        """
+        all_files = []
+        changed = []
+        for file_path in self.html_dir.rglob('*.html'):
+            try:
+                stat = file_path.stat()
+            except FileNotFoundError:
+                # Removed since the directory was listed
+                continue
+            all_files.append(file_path)
+            file_key = (stat.st_mtime_ns, stat.st_size)
+            entry = self._files.get(file_path)
+            if entry is None or entry[0] != file_key:
+                changed.append((file_path, file_key))
+        removed = set(self._files) - set(all_files)
+        for file_path in removed:
+            del self._files[file_path]
+        for file_path in set(self.errors) - set(all_files):
+            del self.errors[file_path]
+            del self._error_keys[file_path]
+
+        results = self._validate_files(
+            [file_path for file_path, _ in changed]
+        )
+        reported = []
+        for (file_path, file_key), result in zip(changed, results):
+            if isinstance(result, str):
+                self._files.pop(file_path, None)
+                if self.errors.get(file_path) == result and \
+                        self._error_keys[file_path] == file_key:
+                    continue
+                self.errors[file_path] = result
+                self._error_keys[file_path] = file_key
+            else:
+                self._files[file_path] = (file_key, result)
+                self.errors.pop(file_path, None)
+                self._error_keys.pop(file_path, None)
+            reported.append(file_path)
+
+        violations = list(reduce_element_results(
+            [self._files[file_path][1] for file_path in all_files
+             if file_path in self._files],
+            self.include_styles, self.uuids_populated
+        ))
+        return violations, reported + sorted(removed)
+
+    def _validate_files(self, file_paths):
+        """Return an ElementResult for each file, or a message saying why it
+        couldn't be validated
+        """
+        try:
+            return validate_elements(
+                [read_html_file(file_path) for file_path in file_paths],
+                self.include_styles, self.jobs, self.allowlists
             )
-    return run_html_validations(html_elements, include_styles, uuids_populated)
+        except WATCH_FILE_ERRORS:
+            pass
+        # Validate the files one at a time to find the ones which failed
+        results = []
+        for file_path in file_paths:
+            try:
+                results.extend(validate_elements(
+                    [read_html_file(file_path)], self.include_styles, 1,
+                    self.allowlists
+                ))
+            except WATCH_FILE_ERRORS as error:
+                results.append(f"{type(error).__name__}: {error}")
+        return results
+
+    def watch(self, interval=0.5):
+        """Poll the directory every interval seconds and yield the
+        violations and changed files whenever a file changes, starting with
+        the initial results
+        """
+        first = True
+        while True:
+            violations, changed = self.validate()
+            if first or changed:
+                first = False
+                yield violations, changed
+            time.sleep(interval)
+
+
+def html_rules_fingerprint(include_styles, allowlists=None):
+    """Return a hash of everything that determines the per-element
+    validation results, so cached results are discarded when it changes
+    """
+    if allowlists is None:
+        allowlists = default_allowlists()
+    rule_set = [
+        HTML_RULES_VERSION,
+        include_styles,
+        allowlists.config(),
+        VALID_STYLES,
+        IB_CLASS_PREFIX,
+        IB_ALLOWED_NESTING
+    ]
+    return hashlib.sha256(json.dumps(rule_set).encode("utf-8")).hexdigest()
+
+
+def default_allowlists(strict=False):
+    """Return the url allowlists built from the VALID_* lists"""
+    return UrlAllowlists(**default_allowlist_lists(), strict=strict)
+
+
+def default_allowlist_lists():
+    return {
+        "source_prefixes": VALID_PREFIXES,
+        "iframe_prefixes": VALID_IFRAME_PREFIXES,
+        "href_prefixes": VALID_HREF_PREFIXES,
+        "href_values": VALID_HREF_VALUES
+    }
+
+
+def load_allowlists(config_path=None, strict=False):
+    """Return the url allowlists, with any lists given in the JSON file at
+    config_path replacing the defaults
+    """
+    if config_path is None:
+        return default_allowlists(strict)
+    return UrlAllowlists.from_file(
+        config_path, default_allowlist_lists(), strict
+    )
 
 
-def run_html_validations(html_elements, include_styles, uuids_populated):
+def element_html_rules(include_styles, allowlists=None):
+    """Return the rules which only depend on a single html element, in the
+    order their violations are reported
+    """
+    if allowlists is None:
+        allowlists = default_allowlists()
+    rules = []
+    if include_styles:
+        rules.append(StyleRule())
+    rules.extend([
+        TableRule(),
+        SourceRule(allowlists),
+        TagRule(allowlists),
+        NestedIbRule()
+    ])
+    return rules
+
+
+def html_rules(include_styles, uuids_populated, allowlists=None):
+    """Return the rules run on html elements, in the order their violations
+    are reported
+    """
+    return element_html_rules(include_styles, allowlists) + \
+        [IbUuidRule(uuids_populated)]
+
+
+def run_budgeted_html_validations(html_elements, include_styles,
+                                  uuids_populated, budget, allowlists=None,
+                                  profiler=None):
+    """Validate html elements one at a time, returning the violations
+    run_html_validations would return that fit in the budget. As there, the
+    other rules are only reported if no element has unnested content, so
+    their violations are held back until every element has been checked.
+    Once unnested content is found only the unnested check is run, and
+    validation stops as soon as the budget is exhausted so the remaining
+    elements are never parsed.
+    """
+    engine = HtmlRuleEngine(
+        html_rules(include_styles, uuids_populated, allowlists), profiler
+    )
+    unnested_violations = []
+    rule_violations = [[] for _ in engine.rules]
+    for html_elem in html_elements:
+        unnested = find_unnested_violations([html_elem], profiler)
+        if len(unnested) > 0:
+            rule_violations = None
+            unnested_violations.extend(
+                violation for violation in unnested
+                if budget.accept(violation)
+            )
+            if budget.exhausted:
+                break
+        elif rule_violations is not None:
+            for violations, found in zip(
+                rule_violations, engine.run_by_rule([html_elem])
+            ):
+                violations.extend(found)
+    if rule_violations is None:
+        return unnested_violations
+    return list(budget.filter(
+        violation for violations in rule_violations
+        for violation in violations
+    ))
+
+
+def run_html_validations(html_elements, include_styles, uuids_populated,
+                         jobs=1, allowlists=None, profiler=None):
+    if jobs > 1 and len(html_elements) > 1:
+        return run_html_validations_parallel(
+            html_elements, include_styles, uuids_populated, jobs, allowlists,
+            profiler
+        )
     violations = []
-    violations.extend(find_unnested_violations(html_elements))
+    violations.extend(find_unnested_violations(html_elements, profiler))
     if len(violations) > 0:
         return violations
-    if include_styles:
-        violations.extend(find_style_violations(html_elements))
-    violations.extend(find_table_violations(html_elements))
-    violations.extend(find_source_violations(html_elements))
-    violations.extend(find_tag_violations(html_elements))
-    violations.extend(find_nested_ib_violations(html_elements))
-    violations.extend(find_ib_uuid_violations(html_elements, uuids_populated))
-    return violations
+    engine = HtmlRuleEngine(
+        html_rules(include_styles, uuids_populated, allowlists), profiler
+    )
+    return engine.run(html_elements)
+
+
+def run_html_validations_parallel(html_elements, include_styles,
+                                  uuids_populated, jobs, allowlists=None,
+                                  profiler=None):
+    """Validate html elements in a pool of worker processes. The element
+    rules run in the workers, while interactive block UUIDs are collected
+    there and checked here in element order. The violations match a serial
+    run exactly.
+    """
+    results = validate_elements(
+        html_elements, include_styles, jobs, allowlists, profiler
+    )
+    return list(reduce_element_results(
+        results, include_styles, uuids_populated, profiler
+    ))
 
 
-def find_qbank_uuid_violations(question_bank):
-    questions = question_bank.latest_questions
-    qbe_to_uuid = {}
-    observed_ids = set()
-    violations_list = []
-    for question in questions:
-        qbe_to_uuid[question.question_bank_entry_id] = question.id_number
+class ElementResult:
+    """The violations from rules which only depend on a single html element
+    along with the interactive block UUIDs it contains. These can be
+    computed in worker processes or cached, and are then reduced in element
+    order by reduce_element_results.
+    """
+    __slots__ = ("location", "unnested", "rule_violations", "content_ids")
+
+    def __init__(self, location, unnested, rule_violations, content_ids):
+        self.location = location
+        self.unnested = unnested
+        self.rule_violations = rule_violations
+        self.content_ids = content_ids
+
+    def toDict(self):
+        def violation_rows(violations):
+            return [[violation.issue, violation.link]
+                    for violation in violations]
+
+        return {
+            "unnested": violation_rows(self.unnested),
+            "rule_violations": None if self.rule_violations is None else [
+                violation_rows(violations)
+                for violations in self.rule_violations
+            ],
+            "content_ids": self.content_ids
+        }
+
+    @classmethod
+    def fromDict(cls, location, data):
+        def violations(rows):
+            return [Violation(issue, location, link) for issue, link in rows]
+
+        rule_violations = data["rule_violations"]
+        if rule_violations is not None:
+            rule_violations = [violations(rows) for rows in rule_violations]
+        return cls(
+            location,
+            violations(data["unnested"]),
+            rule_violations,
+            data["content_ids"]
+        )
+
+
+def validate_element(html_elem, engine):
+    unnested_violations = find_unnested_violations(
+        [html_elem], engine.profiler
+    )
+    if len(unnested_violations) > 0:
+        return ElementResult(
+            html_elem.location, unnested_violations, None, None
+        )
+
+    rule_violations = engine.run_by_rule([html_elem])
+    # The last rule is IbContentIdRule, which only collects UUIDs
+    rule_violations.pop()
+    content_ids = engine.rules[-1].content_ids()
+    # Most elements have no violations, so an empty tuple stands in for
+    # their per-rule lists to keep the results of a large course small
+    if not any(rule_violations):
+        rule_violations = ()
+    return ElementResult(
+        html_elem.location, (), rule_violations, tuple(content_ids)
+    )
+
+
+def element_rule_engine(include_styles, allowlists=None, profiler=None):
+    return HtmlRuleEngine(
+        element_html_rules(include_styles, allowlists) + [IbContentIdRule()],
+        profiler
+    )
+
+
+def validate_elements(html_elements, include_styles, jobs=1,
+                      allowlists=None, profiler=None):
+    """Return an ElementResult for each html element, using a pool of worker
+    processes if there are multiple jobs
+    """
+    if jobs <= 1 or len(html_elements) <= 1:
+        engine = element_rule_engine(include_styles, allowlists, profiler)
+        return [validate_element(elem, engine) for elem in html_elements]
+
+    element_data = [
+        (elem.parent.tag, elem.parent.text, elem.location)
+        for elem in html_elements
+    ]
+    return validate_element_data(
+        element_data, include_styles, jobs, allowlists, profiler
+    )
+
+
+def validate_element_data(element_data, include_styles, jobs,
+                          allowlists=None, profiler=None):
+    """Return an ElementResult for each (tag, text, location) tuple, using a
+    pool of worker processes
+    """
+    chunk_size = max(
+        1, math.ceil(len(element_data) / (jobs * CHUNKS_PER_JOB))
+    )
+    chunks = [
+        element_data[idx:idx + chunk_size]
+        for idx in range(0, len(element_data), chunk_size)
+    ]
+    results = []
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        for chunk_results, chunk_profiler in executor.map(
+            validate_element_chunk, chunks, repeat(include_styles),
+            repeat(allowlists), repeat(profiler is not None)
+        ):
+            results.extend(chunk_results)
+            if profiler is not None:
+                profiler.merge(chunk_profiler)
+    return results
+
+
+def validate_element_chunk(element_data, include_styles, allowlists=None,
+                           profile=False):
+    """Validate a chunk of (tag, text, location) tuples in a worker process.
+    Returns the results and, if profiling, the worker's RuleProfiler.
+    """
+    profiler = RuleProfiler() if profile else None
+    engine = element_rule_engine(include_styles, allowlists, profiler)
+    results = []
+    for tag, text, location in element_data:
+        parent = etree.Element(tag)
+        parent.text = text
+        results.append(
+            validate_element(MoodleHtmlElement(parent, location), engine)
+        )
+    return results, profiler
+
+
+def reduce_element_results(results, include_styles, uuids_populated,
+                           profiler=None):
+    """Yield the violations a serial run of run_html_validations would
+    return from the per-element results
+    """
+    unnested_violations = [
+        violation for result in results for violation in result.unnested
+    ]
+    if len(unnested_violations) > 0:
+        yield from unnested_violations
+        return
+
+    for rule_idx in range(len(element_html_rules(include_styles))):
+        for result in results:
+            if result.rule_violations:
+                yield from result.rule_violations[rule_idx]
+
+    ib_uuid_rule = IbUuidRule(uuids_populated)
+    for result in results:
+        if profiler is None:
+            yield from ib_uuid_rule.check_content_ids(
+                result.location, result.content_ids
+            )
+        else:
+            # The elements were already counted when the UUIDs were
+            # collected
+            start = perf_counter()
+            uuid_violations = ib_uuid_rule.check_content_ids(
+                result.location, result.content_ids
+            )
+            profiler.record(
+                ib_uuid_rule.name, result.location, perf_counter() - start,
+                len(uuid_violations), elements=0
+            )
+            yield from uuid_violations
+
+
+def find_qbank_uuid_violations(question_bank, qbe_to_uuid=None):
+    if qbe_to_uuid is None:
+        qbe_to_uuid = {}
+        for question in question_bank.latest_question_records():
+            qbe_to_uuid[question.question_bank_entry_id] = \
+                question.id_number
 
+    observed_ids = set()
     for qbe_id, id_number in qbe_to_uuid.items():
         if not utils.validate_uuid4(id_number):
-            violations_list.append(Violation(INVALID_QBANK_UUID_VIOLATION,
-                                             question_bank.questionbank_path,
-                                             f'question id: {qbe_id} uuid: '
-                                             f'{id_number}'))
+            yield Violation(INVALID_QBANK_UUID_VIOLATION,
+                            question_bank.questionbank_path,
+                            f'question id: {qbe_id} uuid: {id_number}')
         if id_number in observed_ids:
-            violations_list.append(Violation(DUPLICATE_QBANK_UUID_VIOLATION,
-                                             question_bank.questionbank_path,
-                                             f'question id: {qbe_id} uuid: '
-                                             f'{id_number}'))
+            yield Violation(DUPLICATE_QBANK_UUID_VIOLATION,
+                            question_bank.questionbank_path,
+                            f'question id: {qbe_id} uuid: {id_number}')
         observed_ids.add(id_number)
-    return violations_list
-
 
-def run_qbank_validations(question_bank):
-
-    violations = []
-    violations.extend(find_qbank_uuid_violations(question_bank))
 
-    return violations
+def run_qbank_validations(question_bank, profiler=None, qbe_to_uuid=None):
+    violations = find_qbank_uuid_violations(question_bank, qbe_to_uuid)
+    if profiler is not None:
+        violations = profiler.iter_profiled(
+            "qbank_uuid", question_bank.questionbank_path, violations
+        )
+    yield from violations
 
 
-def run_extracted_html_validations(activities):
-    violations = []
+def run_extracted_html_validations(html_elements, profiler=None):
+    """Check the extracted content in the html elements of pages and lesson
+    pages for duplicate UUIDs and corruption
+    """
     observed_uuids = set()
 
     def get_extracted_elem_uuids(html_elem):
@@ -191,12 +1033,10 @@ def run_extracted_html_validations(activities):
             return
         uuid_value = maybe_uuid[0]
         if uuid_value in observed_uuids:
-            violations.append(
-                Violation(
-                    DUPLICATE_CONTENT_UUID_VIOLATION,
-                    html_elem.location,
-                    uuid_value
-                )
+            yield Violation(
+                DUPLICATE_CONTENT_UUID_VIOLATION,
+                html_elem.location,
+                uuid_value
             )
         observed_uuids.add(uuid_value)
 
@@ -217,28 +1057,37 @@ def run_extracted_html_validations(activities):
         inner_elements = len(html_elem.etree_fragments[0].getchildren()) > 0
 
         if multiple_fragments or inner_text or inner_elements:
-            violations.append(
-                Violation(
-                    EXTRACTED_HTML_CORRUPTION_VIOLATION,
-                    html_elem.location,
-                    maybe_uuid[0]
-                )
+            yield Violation(
+                EXTRACTED_HTML_CORRUPTION_VIOLATION,
+                html_elem.location,
+                maybe_uuid[0]
             )
 
-    for act in activities:
-        if isinstance(act, MoodlePage):
-            for html_elem in act.html_elements():
-                check_duplicate_uuid(html_elem)
-                check_extracted_corruption(html_elem)
-        elif isinstance(act, MoodleLesson):
-            for page in act.lesson_pages():
-                check_duplicate_uuid(page.html_element())
-                check_extracted_corruption(page.html_element())
+    def check(html_elem):
+        duplicates = check_duplicate_uuid(html_elem)
+        corruption = check_extracted_corruption(html_elem)
+        if profiler is not None:
+            duplicates = profiler.iter_profiled(
+                "extracted_uuid", html_elem.location, duplicates
+            )
+            corruption = profiler.iter_profiled(
+                "extracted_corruption", html_elem.location, corruption
+            )
+        yield from duplicates
+        yield from corruption
 
-    return violations
+    for html_elem in html_elements:
+        yield from check(html_elem)
 
 
-def find_unnested_violations(html_elements):
+def find_unnested_violations(html_elements, profiler=None):
+    if profiler is not None:
+        return [
+            violation for elem in html_elements
+            for violation in profiler.call(
+                "unnested", elem.location, find_unnested_violations, [elem]
+            )
+        ]
     violations = []
     for elem in html_elements:
         if len(elem.unnested_content) > 0:
@@ -250,73 +1099,141 @@ def find_unnested_violations(html_elements):
 
 
 def find_style_violations(html_elements):
-    violations = []
-    for elem in html_elements:
-        attributes = elem.get_attribute_values("style")
-        for attr in attributes:
-            if attr not in VALID_STYLES and attr != "":
-                violations.append(Violation(STYLE_VIOLATION,
-                                            elem.location,
-                                            attr))
-    return violations
+    return HtmlRuleEngine([StyleRule()]).run(html_elements)
 
 
-def find_tag_violations(html_elements):
-    violations = []
-    for elem in html_elements:
-        hits = elem.get_elements_by_name("script")
-        for _ in hits:
+def find_tag_violations(html_elements, allowlists=None):
+    return HtmlRuleEngine([TagRule(allowlists)]).run(html_elements)
+
+
+def find_source_violations(html_elements, allowlists=None):
+    return HtmlRuleEngine([SourceRule(allowlists)]).run(html_elements)
+
+
+def find_nested_ib_violations(html_elements):
+    return HtmlRuleEngine([NestedIbRule()]).run(html_elements)
+
+
+def find_ib_uuid_violations(html_elements, uuids_populated):
+    return HtmlRuleEngine([IbUuidRule(uuids_populated)]).run(html_elements)
+
+
+def find_table_violations(html_elements):
+    return HtmlRuleEngine([TableRule()]).run(html_elements)
+
+
+class StyleRule(HtmlRule):
+    name = "style"
+    attributes = ("style",)
+
+    def start(self, html_elem):
+        self.violations = []
+
+    def visit(self, html_elem, node):
+        attr = node.attrib["style"]
+        if attr not in VALID_STYLES and attr != "":
+            self.violations.append(Violation(STYLE_VIOLATION,
+                                             html_elem.location,
+                                             attr))
+
+    def finish(self, html_elem):
+        return self.violations
+
+
+class TagRule(HtmlRule):
+    name = "tag"
+    tags = ("script", "iframe", "a")
+
+    def __init__(self, allowlists=None):
+        if allowlists is None:
+            allowlists = default_allowlists()
+        self.allowlists = allowlists
+
+    def start(self, html_elem):
+        self.hits = {tag: [] for tag in self.tags}
+
+    def visit(self, html_elem, node):
+        self.hits[node.tag].append(node)
+
+    def finish(self, html_elem):
+        # Report scripts, then iframes, then links
+        violations = []
+        for _ in self.hits["script"]:
             violations.append(Violation(SCRIPT_VIOLATION,
-                                        elem.location))
-        hits = elem.get_elements_by_name("iframe")
-        for hit in hits:
+                                        html_elem.location))
+        for hit in self.hits["iframe"]:
             link = hit.attrib['src']
-            if len([prefix for prefix in VALID_IFRAME_PREFIXES
-                    if (prefix in link)]) == 0:
+            if not self.allowlists.iframe.allows(link):
                 violations.append(Violation(IFRAME_VIOLATION,
-                                            elem.location,
+                                            html_elem.location,
+                                            link))
+        for hit in self.hits["a"]:
+            link = hit.attrib.get("href")
+            if link is not None and not self.allowlists.href.allows(link):
+                violations.append(Violation(HREF_VIOLATION,
+                                            html_elem.location,
                                             link))
-        hits = elem.get_elements_by_name("a")
-        for hit in hits:
-            if "href" in hit.attrib.keys():
-                link = hit.attrib["href"]
-                prefix_match = [
-                    pfx for pfx in VALID_HREF_PREFIXES if (pfx in link)
-                ]
-                if len(prefix_match) == 0 and link not in VALID_HREF_VALUES:
-                    violations.append(Violation(HREF_VIOLATION,
-                                                elem.location,
-                                                link))
 
             if hit.attrib.get("target") != "_blank":
                 violations.append(Violation(
                     LINK_TARGET_VIOLATION,
-                    elem.location,
+                    html_elem.location,
                     link
                 ))
-    return violations
+        return violations
 
 
-def find_source_violations(html_elements):
-    violations = []
-    for elem in html_elements:
-        links = elem.get_attribute_values('src', exception='iframe')
-        for link in links:
-            if len([prefix for prefix in VALID_PREFIXES if (prefix in link)]) \
-                    > 0:    # check if link contains a valid prefix
-                continue
-            elif "@@PLUGINFILE@@" in link:
-                violations.append(Violation(MOODLE_VIOLATION,
-                                            elem.location,
-                                            link))
-            else:
-                violations.append(Violation(SOURCE_VIOLATION,
-                                            elem.location,
-                                            link))
-    return violations
+class SourceRule(HtmlRule):
+    name = "source"
+    attributes = ("src",)
 
+    def __init__(self, allowlists=None):
+        if allowlists is None:
+            allowlists = default_allowlists()
+        self.allowlists = allowlists
 
-def find_nested_ib_violations(html_elements):
+    def start(self, html_elem):
+        self.violations = []
+
+    def visit(self, html_elem, node):
+        if node.tag == "iframe":
+            return
+        link = node.attrib["src"]
+        if self.allowlists.source.allows(link):
+            return
+        elif "@@PLUGINFILE@@" in link:
+            self.violations.append(Violation(MOODLE_VIOLATION,
+                                             html_elem.location,
+                                             link))
+        else:
+            self.violations.append(Violation(SOURCE_VIOLATION,
+                                             html_elem.location,
+                                             link))
+
+    def finish(self, html_elem):
+        return self.violations
+
+
+class NestedIbRule(HtmlRule):
+    name = "nested_ib"
+    class_substrings = (IB_CLASS_PREFIX,)
+
+    def start(self, html_elem):
+        self.violations = []
+
+    def visit(self, html_elem, node):
+        if self.is_unnestable_ib_component(node) and \
+                not html_elem.element_is_fragment(node):
+            self.violations.append(Violation(
+                NESTED_IB_VIOLATION,
+                html_elem.location,
+                node.attrib["class"]
+            ))
+
+    def finish(self, html_elem):
+        return self.violations
+
+    @staticmethod
     def is_unnestable_ib_component(etree_elem):
         """Helper function that looks at the class string for an element
         and determines if it's an unnestable component. This function avoids
@@ -336,181 +1253,212 @@ def find_nested_ib_violations(html_elements):
 
         return True
 
-    violations = []
 
-    for elem in html_elements:
-        maybe_ibs = \
-            elem.get_elements_with_string_in_class(
-                IB_CLASS_PREFIX
-            )
-        maybe_broken_ibs = filter(is_unnestable_ib_component, maybe_ibs)
-        for ib in maybe_broken_ibs:
-            if not elem.element_is_fragment(ib):
-                violations.append(Violation(
-                    NESTED_IB_VIOLATION,
-                    elem.location,
-                    ib.attrib["class"]
-                ))
-
-    return violations
-
-
-def find_ib_uuid_violations(html_elements, uuids_populated):
-
-    need_ids = [
+class IbUuidRule(HtmlRule):
+    name = "ib_uuid"
+    NEED_IDS = [
         "os-raise-ib-input",
         "os-raise-ib-pset",
         "os-raise-ib-pset-problem"
     ]
-    violations = []
-    uuid_to_location = {}
-    for elem in html_elements:
-        maybe_ids = elem.get_elements_with_exact_class(need_ids)
-        for ib in maybe_ids:
-            if "data-content-id" not in ib.attrib.keys():
-                if uuids_populated:
+    tags = ("div",)
+
+    def __init__(self, uuids_populated):
+        self.uuids_populated = uuids_populated
+        self.uuid_to_location = {}
+
+    def start(self, html_elem):
+        self.hits = {class_name: [] for class_name in self.NEED_IDS}
+
+    def visit(self, html_elem, node):
+        hits = self.hits.get(node.get("class"))
+        if hits is not None:
+            hits.append(node)
+
+    def finish(self, html_elem):
+        return self.check_content_ids(
+            html_elem.location, self.content_ids()
+        )
+
+    def content_ids(self):
+        """Return the data-content-id of each block found in the element
+        (None where it is missing). Blocks are grouped by class so that the
+        first occurrence of a duplicated UUID is found in the same order as
+        before.
+        """
+        return [
+            ib.attrib.get("data-content-id")
+            for class_name in self.NEED_IDS
+            for ib in self.hits[class_name]
+        ]
+
+    def check_content_ids(self, location, content_ids):
+        violations = []
+        for uuid in content_ids:
+            if uuid is None:
+                if self.uuids_populated:
                     violations.append(Violation(
                         MISSING_IB_UUID_VIOLATION,
-                        elem.location,
+                        location,
                         None
                     ))
+            elif uuid in self.uuid_to_location.keys():
+                double_location = \
+                    location + " and " + self.uuid_to_location[uuid]
+                violations.append(Violation(
+                    DUPLICATE_IB_UUID_VIOLATION,
+                    double_location,
+                    uuid
+                ))
             else:
-                uuid = ib.attrib["data-content-id"]
-                if uuid in uuid_to_location.keys():
-                    double_location = \
-                        elem.location + " and " + uuid_to_location[uuid]
+                self.uuid_to_location[uuid] = location
+                # Confirm UUID is valid
+                if not utils.validate_uuid4(uuid):
                     violations.append(Violation(
-                        DUPLICATE_IB_UUID_VIOLATION,
-                        double_location,
+                        INVALID_IB_UUID_VIOLATION,
+                        location,
                         uuid
                     ))
-                else:
-                    uuid_to_location[uuid] = elem.location
-                    # Confirm UUID is valid
-                    if not utils.validate_uuid4(uuid):
-                        violations.append(Violation(
-                            INVALID_IB_UUID_VIOLATION,
-                            elem.location,
-                            uuid
-                        ))
-    return violations
+        return violations
 
 
-def find_table_violations(html_elements):
-    def find_invalid_table_attributes(table, elem_location):
-        violations = []
+class IbContentIdRule(IbUuidRule):
+    """Collects interactive block UUIDs without checking them so that the
+    checks, which depend on every element seen before, can be run centrally
+    when elements are validated in parallel
+    """
+    def __init__(self):
+        super().__init__(uuids_populated=False)
 
-        ALLOWED_ELEM_ATTRS = [('table', 'class'), ('th', 'scope')]
+    def finish(self, html_elem):
+        # The UUIDs are read with content_ids() once the element is done
+        return []
 
-        for elem in table.xpath('self::table | .//caption |'
-                                './/thead | .//tbody | .//th | .//td | .//tr'):
-            if elem.tag == 'table' and 'class' not in elem.attrib.keys():
-                msg = f"{elem.tag} is missing a class attribute"
-                violations.append(Violation(TABLE_VIOLATION + msg,
-                                            elem_location))
 
-            for attrib in elem.attrib.keys():
-                if (elem.tag, attrib) not in ALLOWED_ELEM_ATTRS:
-                    msg = f"{elem.tag} has invalid attribute {attrib}"
-                    violations.append(Violation(TABLE_VIOLATION + msg,
-                                                elem_location))
+class TableRule(HtmlRule):
+    name = "table"
+    tags = ("table",)
 
-        return violations
+    def start(self, html_elem):
+        self.violations = []
 
-    def find_invalid_table_children_violations(table, elem_location):
-        violations = []
-        table_children = [elem.tag for elem in table.getchildren()]
-        ALLOWED_CHILDREN = [
-            'caption', 'thead', 'tbody'
-        ]
-        if 'thead' not in table_children:
-            msg = 'thead missing in table'
-            violations.append(Violation(TABLE_VIOLATION + msg, elem_location))
-        if 'tbody' not in table_children:
-            msg = 'tbody missing in table'
-            violations.append(Violation(TABLE_VIOLATION + msg, elem_location))
-
-        for child in table_children:
-            if child not in ALLOWED_CHILDREN:
-                msg = f"{child} is not allowed as direct child of table"
-                violations.append(Violation(TABLE_VIOLATION + msg,
-                                            elem_location))
-        return violations
+    def visit(self, html_elem, table):
+        elem_location = html_elem.location
+        self.violations += find_invalid_table_attributes(table, elem_location)
+        self.violations += find_invalid_table_children_violations(
+            table, elem_location
+        )
+        self.violations += find_table_th_violations(table, elem_location)
+        self.violations += find_invalid_table_element_violations(
+            table, elem_location
+        )
 
-    def find_invalid_table_element_violations(table, elem_location):
-        violations = []
-        for elem in table.xpath('./tbody/*'):
-            if elem.tag not in ['tr']:
-                msg = f"{elem.tag} is not allowed as child of tbody"
-                violations.append(Violation(TABLE_VIOLATION + msg,
-                                            elem_location))
+    def finish(self, html_elem):
+        return self.violations
 
-        for elem in table.xpath('./thead/*'):
-            if elem.tag not in ['tr']:
-                msg = f"{elem.tag} is not allowed as child of thead"
-                violations.append(Violation(TABLE_VIOLATION + msg,
-                                            elem_location))
 
-        for elem in table.xpath('./thead/tr/*') + table.xpath('./tbody/tr/*'):
-            if elem.tag not in ['td', 'th']:
-                msg = f"{elem.tag} is not allowed as child of tr"
+def find_invalid_table_attributes(table, elem_location):
+    violations = []
+
+    ALLOWED_ELEM_ATTRS = [('table', 'class'), ('th', 'scope')]
+
+    for elem in table.xpath('self::table | .//caption |'
+                            './/thead | .//tbody | .//th | .//td | .//tr'):
+        if elem.tag == 'table' and 'class' not in elem.attrib.keys():
+            msg = f"{elem.tag} is missing a class attribute"
+            violations.append(Violation(TABLE_VIOLATION + msg,
+                                        elem_location))
+
+        for attrib in elem.attrib.keys():
+            if (elem.tag, attrib) not in ALLOWED_ELEM_ATTRS:
+                msg = f"{elem.tag} has invalid attribute {attrib}"
                 violations.append(Violation(TABLE_VIOLATION + msg,
                                             elem_location))
 
-        return violations
+    return violations
 
-    def find_table_th_violations(table, elem_location):
-        violations = []
 
-        th_in_tbody = table.xpath('./tbody/tr/th')
-        th_in_thead = table.xpath('./thead/tr/th')
+def find_invalid_table_children_violations(table, elem_location):
+    violations = []
+    table_children = [elem.tag for elem in table.getchildren()]
+    ALLOWED_CHILDREN = [
+        'caption', 'thead', 'tbody'
+    ]
+    if 'thead' not in table_children:
+        msg = 'thead missing in table'
+        violations.append(Violation(TABLE_VIOLATION + msg, elem_location))
+    if 'tbody' not in table_children:
+        msg = 'tbody missing in table'
+        violations.append(Violation(TABLE_VIOLATION + msg, elem_location))
+
+    for child in table_children:
+        if child not in ALLOWED_CHILDREN:
+            msg = f"{child} is not allowed as direct child of table"
+            violations.append(Violation(TABLE_VIOLATION + msg,
+                                        elem_location))
+    return violations
 
-        if table.get('class') == 'os-raise-doubleheadertable':
-            if not (len(th_in_tbody) > 0 and len(th_in_thead) > 0):
-                msg = "doubleheadertable requires th in both thead and tbody"
-                violations.append(Violation(TABLE_VIOLATION + msg,
-                                            elem_location))
-        else:
-            if not (len(th_in_tbody) > 0 or len(th_in_thead) > 0):
-                msg = "th is required in either thead or tbody"
-                violations.append(Violation(TABLE_VIOLATION + msg,
-                                            elem_location))
 
-        for th in th_in_tbody:
-            scope = th.get('scope')
-            if scope != 'row':
-                msg = 'must include scope attribute in tbody th with value row'
-                violations.append(Violation(TABLE_VIOLATION + msg,
-                                            elem_location))
+def find_invalid_table_element_violations(table, elem_location):
+    violations = []
+    for elem in table.xpath('./tbody/*'):
+        if elem.tag not in ['tr']:
+            msg = f"{elem.tag} is not allowed as child of tbody"
+            violations.append(Violation(TABLE_VIOLATION + msg,
+                                        elem_location))
+
+    for elem in table.xpath('./thead/*'):
+        if elem.tag not in ['tr']:
+            msg = f"{elem.tag} is not allowed as child of thead"
+            violations.append(Violation(TABLE_VIOLATION + msg,
+                                        elem_location))
+
+    for elem in table.xpath('./thead/tr/*') + table.xpath('./tbody/tr/*'):
+        if elem.tag not in ['td', 'th']:
+            msg = f"{elem.tag} is not allowed as child of tr"
+            violations.append(Violation(TABLE_VIOLATION + msg,
+                                        elem_location))
+
+    return violations
 
-        for th in th_in_thead:
-            scope = th.get('scope')
-            if scope != 'col':
-                msg = 'must include scope attribute in thead th with value col'
-                violations.append(Violation(TABLE_VIOLATION + msg,
-                                            elem_location))
-        return violations
 
+def find_table_th_violations(table, elem_location):
     violations = []
 
-    for elem in html_elements:
-        tables = elem.get_elements_by_name('table')
-        for table in tables:
-            elem_location = elem.location
-
-            violations += find_invalid_table_attributes(table, elem_location)
-            violations += find_invalid_table_children_violations(table,
-                                                                 elem_location)
-            violations += find_table_th_violations(table, elem_location)
-            violations += find_invalid_table_element_violations(table,
-                                                                elem_location)
+    th_in_tbody = table.xpath('./tbody/tr/th')
+    th_in_thead = table.xpath('./thead/tr/th')
+
+    if table.get('class') == 'os-raise-doubleheadertable':
+        if not (len(th_in_tbody) > 0 and len(th_in_thead) > 0):
+            msg = "doubleheadertable requires th in both thead and tbody"
+            violations.append(Violation(TABLE_VIOLATION + msg,
+                                        elem_location))
+    else:
+        if not (len(th_in_tbody) > 0 or len(th_in_thead) > 0):
+            msg = "th is required in either thead or tbody"
+            violations.append(Violation(TABLE_VIOLATION + msg,
+                                        elem_location))
+
+    for th in th_in_tbody:
+        scope = th.get('scope')
+        if scope != 'row':
+            msg = 'must include scope attribute in tbody th with value row'
+            violations.append(Violation(TABLE_VIOLATION + msg,
+                                        elem_location))
+
+    for th in th_in_thead:
+        scope = th.get('scope')
+        if scope != 'col':
+            msg = 'must include scope attribute in thead th with value col'
+            violations.append(Violation(TABLE_VIOLATION + msg,
+                                        elem_location))
     return violations
 
 
 def main():
     parser = argparse.ArgumentParser(description='')
     parser.add_argument('mbz_path', type=str,
-                        help='relative path to unzipped mbz')
+                        help='relative path to unzipped mbz or .mbz file')
     parser.add_argument('output_file', type=str,
                         help='Path to a file where flags will be outputted')
     parser.add_argument('mode', choices=['mbz', 'html'])
@@ -531,7 +1479,115 @@ def main():
         help="Include uuids violations"
     )
 
+    parser.add_argument(
+        '--jobs',
+        type=int,
+        default=1,
+        help="Number of worker processes used to validate html"
+    )
+
+    parser.add_argument(
+        '--cache',
+        type=str,
+        help="Path to a file caching per-file results between runs "
+             "(html mode only)"
+    )
+
+    parser.add_argument(
+        '--allowlist-config',
+        type=str,
+        help="Path to a JSON file with url allowlists replacing the defaults"
+    )
+
+    parser.add_argument(
+        '--strict-urls',
+        action='store_true',
+        help="Require urls to start with an allowed prefix rather than "
+             "contain one"
+    )
+
+    parser.add_argument(
+        '--profile',
+        type=str,
+        help="Path to a JSON file where the time spent in each rule is "
+             "reported"
+    )
+
+    parser.add_argument(
+        '--watch',
+        action='store_true',
+        help="Keep running and rewrite the output whenever an html file "
+             "changes (html mode only)"
+    )
+
+    parser.add_argument(
+        '--uuid-registry',
+        type=str,
+        help="Path to a SQLite database of the UUIDs used by other courses "
+             "to check for duplicates, this course's UUIDs are then added "
+             "(mbz mode only)"
+    )
+
+    parser.add_argument(
+        '--course',
+        type=str,
+        help="Name the course is registered under in the UUID registry, "
+             "defaults to the name of mbz_path"
+    )
+
+    parser.add_argument(
+        '--max-violations',
+        type=int,
+        help="Stop validating once this many violations have been found"
+    )
+
+    parser.add_argument(
+        '--rule-cap',
+        action='append',
+        default=[],
+        metavar='RULE=N',
+        help="Report at most N violations from a rule, may be repeated. "
+             f"Rules are {', '.join(RULE_NAMES)}"
+    )
+
+    parser.add_argument(
+        '--fail-fast',
+        action='store_true',
+        help="Stop at the first violation, same as --max-violations 1"
+    )
+
+    parser.add_argument(
+        '--format',
+        choices=sorted(VIOLATION_WRITERS),
+        default='csv',
+        help="Output format, violations are written as they are found"
+    )
+
     args = parser.parse_args()
+    if args.watch and args.mode != "html":
+        parser.error("--watch is only supported in html mode")
+    if args.watch:
+        for option, used in [
+            ("--cache", args.cache is not None),
+            ("--profile", args.profile is not None),
+            ("--max-violations", args.max_violations is not None),
+            ("--rule-cap", bool(args.rule_cap)),
+            ("--fail-fast", args.fail_fast)
+        ]:
+            if used:
+                parser.error(f"--watch can't be used with {option}")
+    if args.uuid_registry and args.mode != "mbz":
+        parser.error("--uuid-registry is only supported in mbz mode")
+    rule_caps = {}
+    for rule_cap in args.rule_cap:
+        rule, _, cap = rule_cap.partition("=")
+        if rule not in RULE_NAMES or not cap.isdigit():
+            parser.error(f"Invalid --rule-cap {rule_cap}")
+        rule_caps[rule] = int(cap)
+    max_violations = 1 if args.fail_fast else args.max_violations
+    budget = None
+    if max_violations is not None or rule_caps:
+        budget = ViolationBudget(max_violations, rule_caps)
 
     mbz_path = Path(args.mbz_path).resolve(strict=True)
     output_file = Path(args.output_file)
@@ -543,17 +1599,54 @@ def main():
     if not output_file.exists():
         output_file.parent.mkdir(parents=True, exist_ok=True)
 
-    violations = []
+    allowlists = load_allowlists(args.allowlist_config, args.strict_urls)
+    profiler = RuleProfiler() if args.profile else None
+
+    if args.watch:
+        watcher = HtmlWatcher(mbz_path, include_styles, uuids_populated,
+                              args.jobs, allowlists)
+        try:
+            for violations, changed in watcher.watch():
+                count = write_violations(violations, output_file,
+                                         args.format, mbz_path)
+                print(f"{len(changed)} file(s) changed, found {count} "
+                      f"violations")
+                for file_path, message in watcher.errors.items():
+                    print(f"Could not validate {file_path}, will retry: "
+                          f"{message}")
+        except KeyboardInterrupt:
+            pass
+        return
+
     if mode == "html":
-        violations = validate_html(mbz_path, include_styles, uuids_populated)
+        violations = iter_html_violations(mbz_path, include_styles,
+                                          uuids_populated, args.jobs,
+                                          args.cache, allowlists, profiler,
+                                          budget)
+        count = write_violations(violations, output_file, args.format,
+                                 mbz_path)
     elif mode == "mbz":
-        violations = validate_mbz(mbz_path, include_styles,
-                                  include_questionbank, uuids_populated)
-    with open(output_file, 'w') as f:
-        w = DictWriter(f, ['issue', 'location', 'link'])
-        w.writeheader()
-        for violation in violations:
-            w.writerow(violation.toDict())
+        uuid_registry = None
+        if args.uuid_registry:
+            uuid_registry = UuidRegistry(args.uuid_registry)
+        try:
+            violations = iter_mbz_violations(mbz_path, include_styles,
+                                             include_questionbank,
+                                             uuids_populated, args.jobs,
+                                             allowlists, profiler,
+                                             uuid_registry, args.course,
+                                             budget)
+            count = write_violations(violations, output_file, args.format,
+                                     mbz_path)
+        finally:
+            if uuid_registry is not None:
+                uuid_registry.close()
+    if profiler is not None:
+        profiler.save(args.profile)
+    if budget is not None and count > 0:
+        # A budget is used to gate builds, so report failure in the exit
+        # status
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,61 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+
+
+def content_hash(content):
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+class ValidationCache:
+    """An on-disk cache of per-file validation results. Entries are keyed
+    by file and are only used if the hash of the file content matches. The
+    whole cache is discarded if the rule set fingerprint changes.
+    """
+    def __init__(self, cache_path, rules_fingerprint):
+        self.cache_path = Path(cache_path)
+        self.rules_fingerprint = rules_fingerprint
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._current_entries = {}
+        if self.cache_path.exists():
+            with open(self.cache_path) as f:
+                data = json.load(f)
+            if data.get("rules") == rules_fingerprint:
+                self._entries = data["files"]
+
+    def get(self, key, content):
+        """Return the cached result for a file or None if the file has
+        changed since it was cached
+        """
+        entry = self._entries.get(key)
+        if entry is None or entry["hash"] != content_hash(content):
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._current_entries[key] = entry
+        return entry["result"]
+
+    def set(self, key, content, result):
+        self._current_entries[key] = {
+            "hash": content_hash(content),
+            "result": result
+        }
+
+    def save(self):
+        """Write the entries used or set since the cache was loaded, which
+        drops files that no longer exist
+        """
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.cache_path.with_name(self.cache_path.name + ".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(
+                {
+                    "rules": self.rules_fingerprint,
+                    "files": self._current_entries
+                },
+                f
+            )
+        os.replace(tmp_path, self.cache_path)
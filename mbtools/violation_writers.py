@@ -0,0 +1,147 @@
+import json
+import re
+from csv import DictWriter
+from pathlib import Path
+from urllib.parse import quote
+
+VIOLATION_FIELDS = ["issue", "location", "link"]
+
+SARIF_SCHEMA = "https://json.schemastore.org/sarif-2.1.0.json"
+SARIF_VERSION = "2.1.0"
+SARIF_TOOL_NAME = "validate-mbz-html"
+
+
+class CsvViolationWriter:
+    def __init__(self, f):
+        self._writer = DictWriter(f, VIOLATION_FIELDS)
+        self._writer.writeheader()
+
+    def write(self, violation):
+        self._writer.writerow(violation.toDict())
+
+    def close(self):
+        pass
+
+
+class JsonLinesViolationWriter:
+    def __init__(self, f):
+        self._file = f
+
+    def write(self, violation):
+        row = violation.toDict()
+        # Some locations are paths, e.g. the question bank's
+        row["location"] = str(row["location"])
+        self._file.write(json.dumps(row) + "\n")
+
+    def close(self):
+        pass
+
+
+class SarifViolationWriter:
+    """Writes violations as a SARIF log for code scanning tools. Results are
+    written one per line as they arrive and the rule descriptions, which are
+    only known at the end, follow them when the writer is closed.
+
+    Locations that are files get a physical location with a URI relative to
+    base_path where possible. Others, such as activity names in mbz mode,
+    are written as logical locations.
+    """
+    def __init__(self, f, base_path=None):
+        self._file = f
+        self._base_path = None if base_path is None else Path(base_path)
+        self._rules = {}
+        self._locations = {}
+        self._results = 0
+        self._file.write(
+            '{"$schema": ' + json.dumps(SARIF_SCHEMA) + ', '
+            '"version": ' + json.dumps(SARIF_VERSION) + ', '
+            '"runs": [{"results": [\n'
+        )
+
+    def write(self, violation):
+        level, rule_id, description = sarif_rule(violation.issue)
+        self._rules.setdefault(rule_id, description)
+        message = violation.issue
+        if violation.link is not None:
+            message += f" ({violation.link})"
+        result = {
+            "ruleId": rule_id,
+            "level": level,
+            "message": {"text": message},
+            "locations": [self._location(str(violation.location))]
+        }
+        if violation.link is not None:
+            result["properties"] = {"link": violation.link}
+        separator = ",\n" if self._results > 0 else ""
+        self._file.write(separator + json.dumps(result))
+        self._results += 1
+
+    def close(self):
+        driver = {
+            "name": SARIF_TOOL_NAME,
+            "rules": [
+                {"id": rule_id, "shortDescription": {"text": description}}
+                for rule_id, description in self._rules.items()
+            ]
+        }
+        self._file.write(
+            '\n], "tool": {"driver": ' + json.dumps(driver) + '}}]}\n'
+        )
+
+    def _location(self, location):
+        sarif_location = self._locations.get(location)
+        if sarif_location is None:
+            sarif_location = self._locations[location] = \
+                self._sarif_location(location)
+        return sarif_location
+
+    def _sarif_location(self, location):
+        path = Path(location)
+        if self._base_path is not None and not path.is_absolute():
+            path = self._base_path / path
+        if not path.is_file():
+            return {"logicalLocations": [{"fullyQualifiedName": location}]}
+        if self._base_path is not None and path.is_relative_to(
+            self._base_path
+        ):
+            uri = quote(path.relative_to(self._base_path).as_posix())
+        else:
+            uri = path.resolve().as_uri()
+        return {"physicalLocation": {"artifactLocation": {"uri": uri}}}
+
+
+def sarif_rule(issue):
+    """Split an issue such as "ERROR: Table violation: th is required" into
+    a SARIF level, a stable rule id and the rule description
+    """
+    level, _, description = issue.partition(": ")
+    level = "error" if level == "ERROR" else "warning"
+    description = description.split(": ")[0]
+    rule_id = re.sub(r"[^a-z0-9]+", "-", description.lower()).strip("-")
+    return level, rule_id, description
+
+
+VIOLATION_WRITERS = {
+    "csv": CsvViolationWriter,
+    "jsonl": JsonLinesViolationWriter,
+    "sarif": SarifViolationWriter
+}
+
+
+def write_violations(violations, output_file, output_format="csv",
+                     base_path=None):
+    """Write violations to output_file as they are produced and return how
+    many were written. The file is line buffered so a long run can be
+    followed with tail -f.
+    """
+    count = 0
+    with open(output_file, "w", buffering=1) as f:
+        if output_format == "sarif":
+            writer = SarifViolationWriter(f, base_path)
+        else:
+            writer = VIOLATION_WRITERS[output_format](f)
+        for violation in violations:
+            writer.write(violation)
+            count += 1
+        writer.close()
+    return count
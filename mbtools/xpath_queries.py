@@ -0,0 +1,82 @@
+import json
+import threading
+import time
+from lxml import etree
+
+# Registry of compiled queries keyed by XPath expression
+QUERIES = {}
+
+
+class XPathQuery:
+    """A compiled XPath expression along with usage statistics. Values
+    should be passed in as XPath variables (e.g. $name) rather than
+    interpolated into the expression so that a query is only compiled once
+    and arbitrary strings can't break its quoting. Queries are run from the
+    threads MoodleBackup loads activities with, so the statistics are
+    updated under a lock.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.compiled = etree.XPath(path)
+        self.hits = 0
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+
+    def __call__(self, elem, **variables):
+        start = time.perf_counter()
+        try:
+            return self.compiled(elem, **variables)
+        finally:
+            seconds = time.perf_counter() - start
+            with self._lock:
+                self.hits += 1
+                self.seconds += seconds
+
+    def stats(self):
+        with self._lock:
+            return {
+                "query": self.path,
+                "hits": self.hits,
+                "seconds": self.seconds
+            }
+
+    def reset(self):
+        with self._lock:
+            self.hits = 0
+            self.seconds = 0.0
+
+
+def get_query(path):
+    """Return the compiled query for an XPath expression, compiling and
+    registering it on first use
+    """
+    query = QUERIES.get(path)
+    if query is None:
+        query = QUERIES.setdefault(path, XPathQuery(path))
+    return query
+
+
+def xpath(elem, path, **variables):
+    """Evaluate a registered XPath expression against an element or tree
+    with the given XPath variables
+    """
+    return get_query(path)(elem, **variables)
+
+
+def query_stats():
+    """Return hit counts and cumulative time for each registered query,
+    sorted with the most expensive queries first
+    """
+    stats = [query.stats() for query in list(QUERIES.values())]
+    stats.sort(key=lambda item: item["seconds"], reverse=True)
+    return stats
+
+
+def dump_query_stats(output_file):
+    with open(output_file, "w") as f:
+        json.dump(query_stats(), f, indent=2)
+
+
+def reset_query_stats():
+    for query in list(QUERIES.values()):
+        query.reset()
@@ -3,9 +3,12 @@ import botocore.stub
 import boto3
 import os
 import json
+import hashlib
+import magic
 from mbtools import copy_resources_s3
 from bs4 import BeautifulSoup
 import datetime
+import threading
 
 test_dir = 'test_content/'
 nested_dir = 'test_content/nested'
@@ -57,6 +60,57 @@ def test_resource_hashes(practice_filesystem):
             )
 
 
+def test_resource_hashes_workers(practice_filesystem):
+    serial = copy_resources_s3.resource_hashes(
+        practice_filesystem[test_dir], workers=1
+    )
+    parallel = copy_resources_s3.resource_hashes(
+        practice_filesystem[test_dir], workers=4
+    )
+    assert [(key, value['path'], value['mime_type'])
+            for key, value in parallel[0].items()] == \
+        [(key, value['path'], value['mime_type'])
+         for key, value in serial[0].items()]
+    assert [(d['path'], d['sha1']) for d in parallel[1]] == \
+        [(d['path'], d['sha1']) for d in serial[1]]
+
+
+def test_hash_resource(tmp_path, mocker):
+    mocker.patch.object(copy_resources_s3, 'magic_bytes_max',
+                        return_value=4)
+    mocker.patch.object(copy_resources_s3, 'HASH_BUFFER_SIZE', 4)
+    path = tmp_path / 'example.json'
+    data = json.dumps({'json_data': 'x' * 100}).encode()
+    path.write_bytes(data)
+    empty_path = tmp_path / 'empty'
+    empty_path.write_bytes(b'')
+
+    assert copy_resources_s3.hash_resource(str(path)) == (
+        hashlib.sha1(data).hexdigest(),
+        copy_resources_s3.get_buffer_mime_type(data[:4])
+    )
+    assert copy_resources_s3.hash_resource(str(empty_path)) == (
+        hashlib.sha1(b'').hexdigest(),
+        copy_resources_s3.get_mime_type(str(empty_path))
+    )
+
+
+def test_magic_bytes_max():
+    assert copy_resources_s3.magic_bytes_max() == \
+        magic.Magic().getparam(magic.MAGIC_PARAM_BYTES_MAX)
+
+
+def test_hash_resource_sniffs_past_first_block(tmp_path, mocker):
+    # libmagic finds this mime type from data after the first hash block
+    mocker.patch.object(copy_resources_s3, 'HASH_BUFFER_SIZE', 4)
+    path = tmp_path / 'example.json'
+    path.write_text(json.dumps({'json_data': 'x' * 100}))
+    assert copy_resources_s3.get_buffer_mime_type(path.read_bytes()[:4]) \
+        != 'application/json'
+    assert copy_resources_s3.hash_resource(str(path))[1] == \
+        'application/json'
+
+
 def test_get_mime_type(practice_filesystem):
     assert os.path.exists(practice_filesystem[f1])
     assert (copy_resources_s3.get_mime_type(practice_filesystem[f1]) ==
@@ -128,7 +182,7 @@ def test_upload_resources(practice_filesystem, mocker):
                          )
 
     stubber.activate()
-    mocker.patch('boto3.client', lambda service: s3_client)
+    mocker.patch('boto3.client', lambda service, **kwargs: s3_client)
     url_prefix = 'https://domain.org/prefix/s3'
     resource_dir = practice_filesystem[test_dir]
     index_path = practice_filesystem[index_file]
@@ -187,3 +241,200 @@ def test_upload_resources(practice_filesystem, mocker):
 
     for value in sha_map_data:
         assert value in sha_data_from_index
+
+
+class ConcurrentS3Client:
+    """A thread-safe stand-in for an s3 client where uploads wait until
+    another upload is running at the same time"""
+
+    def __init__(self, existing):
+        self.existing = existing
+        self.uploaded = []
+        self.lock = threading.Lock()
+        self.barrier = threading.Barrier(2, timeout=5)
+
+    def head_object(self, Bucket, Key):
+        if Key in self.existing:
+            return {'LastModified': self.existing[Key]}
+        raise botocore.exceptions.ClientError(
+            {'Error': {'Code': '404'}}, 'HeadObject'
+        )
+
+    def upload_file(self, path, Bucket, Key, ExtraArgs):
+        self.barrier.wait()
+        with self.lock:
+            self.uploaded.append(Key)
+
+
+def test_add_new_resources_to_s3_concurrency(practice_filesystem, mocker,
+                                             capsys):
+    s3_dir = 'resources'
+    sha1_map, _ = copy_resources_s3.resource_hashes(
+        practice_filesystem[test_dir]
+    )
+    hash_keys = list(sha1_map)
+    last_modified = datetime.datetime(2023, 9, 1, 12, 0, 0)
+    s3_client = ConcurrentS3Client(
+        {s3_dir + '/' + hash_keys[2]: last_modified}
+    )
+    create_client = mocker.patch('boto3.client', return_value=s3_client)
+
+    existing_timestamps = copy_resources_s3.add_new_resources_to_s3(
+        'test-bucket', s3_dir, hash_keys, sha1_map, concurrency=4
+    )
+
+    assert existing_timestamps == {hash_keys[2]: last_modified}
+    assert sorted(s3_client.uploaded) == sorted(
+        s3_dir + '/' + hash_key for hash_key in hash_keys[:2]
+    )
+    assert create_client.call_count == 1
+    config = create_client.call_args.kwargs['config']
+    assert config.max_pool_connections == 10
+    output = capsys.readouterr().out
+    assert f"with sha {hash_keys[2]} already exists" in output
+    assert output.endswith("Uploaded 2 files to test-bucket\n")
+
+
+def test_add_new_resources_to_s3_list_existing(practice_filesystem, mocker):
+    s3_dir = 'resources'
+    bucket_name = 'test-bucket'
+    sha1_map, _ = copy_resources_s3.resource_hashes(
+        practice_filesystem[test_dir]
+    )
+    hash_keys = list(sha1_map)
+    time1 = datetime.datetime(2023, 9, 1, 12, 0, 0)
+    time2 = datetime.datetime(2023, 9, 2, 12, 0, 0)
+    s3_client = boto3.client('s3')
+    stubber = botocore.stub.Stubber(s3_client)
+
+    stubber.add_response(
+        'list_objects_v2',
+        {
+            'Contents': [
+                {'Key': s3_dir + '/' + hash_keys[2], 'LastModified': time1},
+                {'Key': s3_dir + '/other', 'LastModified': time1}
+            ],
+            'IsTruncated': True,
+            'NextContinuationToken': 'page2'
+        },
+        expected_params={'Bucket': bucket_name, 'Prefix': s3_dir + '/'}
+    )
+    stubber.add_response(
+        'list_objects_v2',
+        {
+            'Contents': [
+                {'Key': s3_dir + '/' + hash_keys[0], 'LastModified': time2}
+            ],
+            'IsTruncated': False
+        },
+        expected_params={
+            'Bucket': bucket_name,
+            'Prefix': s3_dir + '/',
+            'ContinuationToken': 'page2'
+        }
+    )
+    stubber.add_response('put_object', {},
+                         expected_params={
+                            'Body': botocore.stub.ANY,
+                            'Bucket': bucket_name,
+                            'Key': s3_dir + '/' + hash_keys[1],
+                            'ContentType': 'application/json'
+                          }
+                         )
+    stubber.activate()
+    mocker.patch('boto3.client', lambda service, **kwargs: s3_client)
+
+    existing_timestamps = copy_resources_s3.add_new_resources_to_s3(
+        bucket_name, s3_dir, hash_keys, sha1_map, list_existing=True
+    )
+
+    stubber.assert_no_pending_responses()
+    assert existing_timestamps == {
+        hash_keys[0]: time2,
+        hash_keys[2]: time1
+    }
+
+
+def test_resource_hashes_manifest(practice_filesystem, tmp_path, mocker):
+    resource_dir = practice_filesystem[test_dir]
+    manifest_path = tmp_path / 'manifest.json'
+    expected = copy_resources_s3.resource_hashes(resource_dir)
+
+    first = copy_resources_s3.resource_hashes(resource_dir, manifest_path)
+    assert manifest_path.exists()
+    hash_resource = mocker.spy(copy_resources_s3, 'hash_resource')
+
+    # Unchanged files reuse the manifest
+    second = copy_resources_s3.resource_hashes(resource_dir, manifest_path)
+    assert hash_resource.call_count == 0
+    for result in [first, second]:
+        assert list(result[0]) == list(expected[0])
+        assert [d['sha1'] for d in result[1]] == \
+            [d['sha1'] for d in expected[1]]
+
+    # Only the changed file is hashed again
+    with open(practice_filesystem[f1], 'w') as f:
+        json.dump({'txt_data': 3}, f)
+    sha1_map, _ = copy_resources_s3.resource_hashes(
+        resource_dir, manifest_path
+    )
+    assert hash_resource.call_args_list == [
+        mocker.call(practice_filesystem[f1])
+    ]
+    assert len(sha1_map) == 3
+    assert set(sha1_map) != set(expected[0])
+
+    # verify rehashes everything
+    hash_resource.reset_mock()
+    copy_resources_s3.resource_hashes(resource_dir, manifest_path,
+                                      verify=True)
+    assert hash_resource.call_count == 4
+
+
+def test_verify_requires_manifest(practice_filesystem, mocker):
+    mocker.patch(
+        "sys.argv",
+        ["", practice_filesystem[test_dir], "bucket", "resources",
+         "https://domain.org", practice_filesystem[index_file], "--verify"]
+    )
+    with pytest.raises(SystemExit):
+        copy_resources_s3.main()
+
+
+def test_upload_resources_overlaps_hashing(practice_filesystem, mocker):
+    uploaded = threading.Event()
+    hash_resource = copy_resources_s3.hash_resource
+    hashed = []
+
+    def slow_hash_resource(full_path):
+        # Only the first file can be hashed before an upload has finished
+        if hashed:
+            assert uploaded.wait(timeout=5)
+        hashed.append(full_path)
+        return hash_resource(full_path)
+
+    class S3Client:
+        def head_object(self, Bucket, Key):
+            raise botocore.exceptions.ClientError(
+                {'Error': {'Code': '404'}}, 'HeadObject'
+            )
+
+        def upload_file(self, path, Bucket, Key, ExtraArgs):
+            uploaded.set()
+
+    expected = copy_resources_s3.resource_hashes(
+        practice_filesystem[test_dir]
+    )
+    mocker.patch.object(copy_resources_s3, 'hash_resource',
+                        slow_hash_resource)
+    mocker.patch('boto3.client', return_value=S3Client())
+
+    sha1_map, duplicates = copy_resources_s3.upload_resources(
+        practice_filesystem[test_dir], 'test-bucket', 'resources',
+        hash_workers=1
+    )
+    assert len(hashed) == 4
+    assert [(key, value['path']) for key, value in sha1_map.items()] == \
+        [(key, value['path']) for key, value in expected[0].items()]
+    assert [(d['path'], d['sha1']) for d in duplicates] == \
+        [(d['path'], d['sha1']) for d in expected[1]]
@@ -0,0 +1,90 @@
+from pathlib import Path
+import pytest
+from bs4 import BeautifulSoup
+from lxml import etree, html
+from mbtools import html_serializer
+from mbtools.models import MoodleHtmlElement
+
+DATA_PATH = Path(__file__).parent / "data"
+
+CORPUS = [
+    "<p>Simple</p>",
+    "<p>One</p><p>Two</p>",
+    "<p>One</p>\n\n  <p>Two</p>\n",
+    "<div><br><br/><img src='a.png'></div>",
+    "<p>&amp; &lt; &gt; &quot; &apos; &nbsp;</p>",
+    "<p class='a' id='b' data-z='1' data-a='2'>Sorted attributes</p>",
+    "<p title='say \"hi\"'>Double quotes</p>",
+    "<p title=\"it's\">Single quote</p>",
+    "<p title=\"it's &quot;both&quot;\">Both quotes</p>",
+    "<!-- only a comment -->",
+    "<p>Text<!-- comment -->tail</p>",
+    "<?php echo 1 ?><p>PI</p>",
+    "<script>var x = '<p>' + \"&amp;\";</script>",
+    "<style></style><script> </script>",
+    "<pre>\n  a\n\n  b  </pre>",
+    "<pre><code>  x  </code>   </pre>",
+    "<table><tr><td></td></tr></table>",
+    "<p> </p><p>   </p>",
+    "<p>\r\n</p><p>\r</p>",
+    "<p>Ünïcödé façade — “smart” ‘quotes’ • bullet ∞</p>",
+    "<div class=''>Empty class</div><a rel=''>Empty rel</a>",
+    "<input value=''><option selected>x</option>",
+    "<p>trailing text</p> tail",
+    "<iframe src='https://player.vimeo.com/video/1'></iframe>",
+]
+
+
+def reference_html_fragments_to_string(fragments):
+    """The original lxml -> BeautifulSoup round trip"""
+    html_content = b''.join(
+        [etree.tostring(fragment) for fragment in fragments])
+    return BeautifulSoup(
+        html_content,
+        "html.parser"
+    ).encode(formatter="html5").decode('utf-8')
+
+
+def corpus_documents():
+    documents = list(CORPUS)
+    documents.append(
+        (DATA_PATH / "html_serializer/corpus.html").read_text()
+    )
+    for path in sorted(DATA_PATH.rglob("*.html")):
+        documents.append(path.read_text())
+    return documents
+
+
+def parse_fragments(content):
+    parent = etree.Element("content")
+    parent.text = content
+    return MoodleHtmlElement(parent, "").etree_fragments
+
+
+@pytest.mark.parametrize("content", corpus_documents())
+def test_serializer_matches_reference(content):
+    assert html_serializer.serialize_fragments(parse_fragments(content)) == \
+        reference_html_fragments_to_string(parse_fragments(content))
+
+
+def test_serializer_matches_reference_after_modification():
+    fragments = parse_fragments(
+        (DATA_PATH / "html_serializer/corpus.html").read_text()
+    )
+    for elem in fragments[0].xpath("//*"):
+        elem.attrib["data-added"] = "é & \"x\" 'y' <z>"
+        elem.attrib.pop("style", None)
+    new_elem = html.Element("span")
+    new_elem.text = "  "
+    fragments[0].append(new_elem)
+
+    assert html_serializer.serialize_fragments(fragments) == \
+        reference_html_fragments_to_string(fragments)
+
+
+def test_serializer_output_format():
+    fragments = parse_fragments(
+        "<div class=' a  b '><br><img src='x' alt=''><p></p></div>"
+    )
+    assert html_serializer.serialize_fragments(fragments) == \
+        '<div class="a b"><br><img alt src="x"><p></p></div>'
@@ -0,0 +1,167 @@
+import csv
+import gc
+import pytest
+import shutil
+import tarfile
+from pathlib import Path
+from lxml import etree
+from mbtools import generate_quiz_csv, mbz_archive, validate_mbz_html
+from mbtools.generate_mbz_toc import parse_toc
+from mbtools.models import MoodleBackup, MoodleCourseSession, \
+    MoodleQuestionBank
+
+
+def build_course(tmp_path, mbz_builder, page_builder, quiz_builder):
+    mbz_path = tmp_path / "mbz"
+    mbz_builder(
+        mbz_path,
+        activities=[
+            page_builder(
+                id=1,
+                name="Page 1",
+                html_content=(
+                    '<div data-content-id='
+                    '"8fd0a5a4-0c56-4d5c-9f5f-2f5a6d1c5b1e">'
+                    '<p style="color: red">Styled</p></div>'
+                )
+            ),
+            quiz_builder(
+                id=2,
+                name="Quiz 1",
+                questions=[
+                    {"id": 1, "slot": 1, "page": 1, "questionid": 1}
+                ]
+            )
+        ],
+        questionbank_questions=[
+            {
+                "id": 1,
+                "idnumber": 1234,
+                "html_content": '<p style="color: red">Q1</p>',
+                "answers": [
+                    {"id": 1, "grade": 1, "html_content": "<p>A1</p>"}
+                ]
+            }
+        ]
+    )
+    files_path = mbz_path / "files/ab"
+    files_path.mkdir(parents=True)
+    (files_path / "abcdef").write_bytes(b"binary payload")
+    return mbz_path
+
+
+@pytest.fixture(params=["gztar", "zip"])
+def mbz_paths(
+    request, tmp_path, mbz_builder, page_builder, quiz_builder
+):
+    mbz_path = build_course(tmp_path, mbz_builder, page_builder, quiz_builder)
+    archive_path = Path(shutil.make_archive(
+        tmp_path / "course", request.param, root_dir=mbz_path
+    )).rename(tmp_path / "course.mbz")
+    return mbz_path, archive_path
+
+
+def violation_rows(violations, mbz_path):
+    return [
+        (violation.issue, str(violation.location).replace(str(mbz_path), ""))
+        for violation in violations
+    ]
+
+
+def test_validate_archive_matches_directory(mbz_paths):
+    mbz_path, archive_path = mbz_paths
+    expected = validate_mbz_html.validate_mbz(
+        mbz_path, include_questionbank=True
+    )
+    actual = validate_mbz_html.validate_mbz(
+        archive_path, include_questionbank=True
+    )
+    assert len(expected) > 0
+    assert violation_rows(actual, archive_path) == \
+        violation_rows(expected, mbz_path)
+
+
+def test_archive_models(mbz_paths):
+    mbz_path, archive_path = mbz_paths
+    backup = MoodleBackup(archive_path)
+    assert [act.name for act in backup.activities()] == ["Page 1", "Quiz 1"]
+    assert parse_toc(archive_path) == parse_toc(mbz_path)
+
+    # Streaming the question bank reads from the archive member
+    question_bank = MoodleQuestionBank(archive_path)
+    records = question_bank.latest_question_records()
+    assert [record.id_number for record in records] == ["1234"]
+    assert question_bank._etree is None
+
+    session = MoodleCourseSession()
+    assert session.question_bank(archive_path).questions[0].id_number == \
+        "1234"
+
+
+def test_archive_index_skips_file_payload(mbz_paths):
+    _, archive_path = mbz_paths
+    archive = mbz_archive.open_archive(archive_path)
+    assert "files/ab/abcdef" in archive
+    assert "moodle_backup.xml" in archive
+    assert "activities/page_1/page.xml" in archive
+    assert "files/ab/abcdef" not in archive._spooled
+    assert mbz_archive.open_archive(archive_path) is archive
+
+    with pytest.raises(FileNotFoundError):
+        mbz_archive.parse(archive_path / "activities/missing.xml")
+
+
+def test_tar_members_are_spooled_to_disk(
+    tmp_path, mbz_builder, page_builder, quiz_builder
+):
+    mbz_path = build_course(tmp_path, mbz_builder, page_builder, quiz_builder)
+    archive_path = Path(shutil.make_archive(
+        tmp_path / "course", "gztar", root_dir=mbz_path
+    ))
+    archive = mbz_archive.MbzArchive(archive_path)
+    spool_dir = Path(archive._spool_dir.name)
+    assert sorted(archive._spooled) == sorted(
+        path.relative_to(mbz_path).as_posix()
+        for path in mbz_path.rglob("*.xml")
+    )
+    with archive.open("questions.xml") as f:
+        assert f.read() == (mbz_path / "questions.xml").read_bytes()
+    with archive.open("moodle_backup.xml") as f:
+        # Parsed trees have no URL to be saved back to
+        assert etree.parse(f).docinfo.URL is None
+
+    del archive
+    gc.collect()
+    assert not spool_dir.exists()
+
+
+def test_tar_member_names_are_normalized(tmp_path):
+    (tmp_path / "moodle_backup.xml").write_text("<moodle_backup/>")
+    archive_path = tmp_path / "course.mbz"
+    with tarfile.open(archive_path, "w:gz") as tar:
+        tar.add(tmp_path / "moodle_backup.xml", "./moodle_backup.xml")
+
+    tree = mbz_archive.parse(archive_path / "moodle_backup.xml")
+    assert tree.getroot().tag == "moodle_backup"
+
+
+def test_generate_quiz_csv_from_archive(mbz_paths, tmp_path):
+    _, archive_path = mbz_paths
+    output_path = tmp_path / "outputs"
+    output_path.mkdir()
+    generate_quiz_csv.generate_quiz_data(archive_path, output_path)
+
+    with open(output_path / "quiz_questions.csv") as f:
+        assert list(csv.reader(f)) == [
+            ["quiz_name", "question_number", "question_id"],
+            ["Quiz 1", "1", "1234"]
+        ]
+
+
+def test_archive_backup_cannot_be_saved(mbz_paths):
+    _, archive_path = mbz_paths
+    backup = MoodleBackup(archive_path)
+    for elem in backup.activities()[0].html_elements():
+        elem.remove_attr("style")
+    with pytest.raises(Exception, match="Cannot save changes to archive"):
+        backup.save()
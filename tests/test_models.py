@@ -1,7 +1,10 @@
+import gc
 import pytest
-from lxml import etree
-from mbtools.models import MoodleHtmlElement, MoodleLessonPage, \
-    MoodleQuestionBank, MoodleQuiz
+from lxml import etree, html
+from mbtools import utils
+from mbtools.models import MoodleBackup, MoodleCourseSession, \
+    MoodleHtmlElement, MoodleLessonPage, \
+    MoodleQuestionBank, MoodleQuiz, ModifiedTrees
 
 
 def test_answerformat_filter(tmp_path):
@@ -545,3 +548,383 @@ def test_find_multianswer_child_question(tmp_path):
     assert "123" in results
     assert "124" in results
     assert "125" in results
+
+
+def test_questionbank_index_lookups(tmp_path):
+    questionbank_xml = """
+<?xml version="1.0" encoding="UTF-8"?>
+<question_categories>
+  <question_category id="1">
+    <question_bank_entries>
+      <question_bank_entry id="1">
+        <idnumber>1234</idnumber>
+        <question_version>
+          <question_versions>
+            <version>1</version>
+            <questions>
+              <question id="question1v1">
+                <qtype></qtype>
+              </question>
+            </questions>
+          </question_versions>
+          <question_versions>
+            <version>2</version>
+            <questions>
+              <question id="question1v2">
+                <qtype></qtype>
+              </question>
+            </questions>
+          </question_versions>
+        </question_version>
+     </question_bank_entry>
+      <question_bank_entry id="2">
+        <idnumber>1235</idnumber>
+        <question_version>
+          <question_versions>
+            <version>1</version>
+            <questions>
+              <question id="question2v1">
+                <qtype></qtype>
+              </question>
+            </questions>
+          </question_versions>
+        </question_version>
+     </question_bank_entry>
+    </question_bank_entries>
+  </question_category>
+</question_categories>
+    """
+
+    (tmp_path / "questions.xml").write_text(questionbank_xml.strip())
+    questionbank = MoodleQuestionBank(tmp_path)
+
+    assert questionbank.get_entry_id_by_question_id("question1v1") == "1"
+    assert questionbank.get_entry_id_by_question_id("question1v2") == "1"
+    assert questionbank.get_entry_id_by_question_id("question2v1") == "2"
+    assert questionbank.get_question_by_entry("1", "1").id == "question1v1"
+    assert [q.id for q in questionbank.latest_questions] == \
+        ["question1v2", "question2v1"]
+
+    with pytest.raises(Exception):
+        questionbank.get_question_by_entry("3", "$@NULL@$")
+
+    # Lookups should reflect entries removed from the tree
+    questionbank.delete_unused_question_bank_entries(["2"])
+    assert [q.id for q in questionbank.latest_questions] == ["question2v1"]
+    with pytest.raises(Exception):
+        questionbank.get_question_by_entry("1", "1")
+
+
+def test_questionbank_streaming_records(tmp_path, mbz_builder):
+    mbz_builder(
+        tmp_path,
+        activities=[],
+        questionbank_questions=[
+            {
+                "id": 11,
+                "idnumber": 1234,
+                "html_content": "<p>Question 1</p>",
+                "answers": [
+                    {
+                        "id": 1,
+                        "grade": "1.0000000",
+                        "html_content": "<p>Answer 1</p>"
+                    }
+                ]
+            },
+            {
+                "id": 22,
+                "idnumber": 1235,
+                "html_content": "<p>Question 2</p>"
+            }
+        ]
+    )
+    questionbank = MoodleQuestionBank(tmp_path)
+
+    records = list(questionbank.iter_question_records())
+    latest_records = list(questionbank.latest_question_records())
+    latest_questions = questionbank.latest_questions
+
+    assert len(records) == 2
+    assert len(latest_records) == 2
+    for record, question in zip(latest_records, latest_questions):
+        assert record.id == question.id
+        assert record.version == question.version
+        assert record.id_number == question.id_number
+        assert record.question_type == question.question_type
+        assert record.question_bank_entry_id == \
+            question.question_bank_entry_id
+        assert record.text == question.text
+        assert record.location == question.location
+        assert [elem.tostring() for elem in record.html_elements()] == \
+            [elem.tostring() for elem in question.html_elements()]
+
+    answer = latest_records[0].multichoice_answers()[0]
+    assert answer.grade == 1.0
+    assert answer.text == "<p>Answer 1</p>"
+
+    by_entry = questionbank.question_records_by_entry(
+        [("11", "1"), ("22", "$@NULL@$")]
+    )
+    assert by_entry[("11", "1")].id == "questionid11"
+    assert by_entry[("22", "$@NULL@$")].id == "questionid22"
+
+    with pytest.raises(Exception):
+        questionbank.question_records_by_entry([("11", "2")])
+
+
+def test_html_element_parses_fragments_lazily(mocker):
+    fragments_fromstring = mocker.spy(html, "fragments_fromstring")
+    parent = etree.fromstring("<content></content>")
+    parent.text = "<p>Content</p>"
+    elem = MoodleHtmlElement(parent, "")
+    assert fragments_fromstring.call_count == 0
+
+    content = elem.replace_content_tag()
+    assert content["content"] == "<p>Content</p>"
+    assert fragments_fromstring.call_count == 0
+
+    assert elem.etree_fragments[0].attrib["data-content-id"] == \
+        content["uuid"]
+    assert elem.unnested_content == []
+    assert elem.replace_content_tag() is None
+    assert fragments_fromstring.call_count == 1
+
+
+def test_course_session_shares_parsed_files(
+    tmp_path, mbz_builder, page_builder, quiz_builder
+):
+    page = page_builder(id=1, name="Page", html_content="<p>Page</p>")
+    quiz = quiz_builder(
+        id=2,
+        name="Quiz",
+        questions=[
+            {"id": "31", "slot": 1, "page": 1, "questionid": "11"}
+        ]
+    )
+    mbz_builder(
+        tmp_path,
+        activities=[page, quiz],
+        questionbank_questions=[
+            {"id": 11, "idnumber": 1234, "html_content": "<p>Q</p>"}
+        ]
+    )
+
+    session = MoodleCourseSession()
+    backup = session.moodle_backup(tmp_path)
+    assert session.moodle_backup(tmp_path) is backup
+    assert session.question_bank(tmp_path) is backup.q_bank
+
+    activities = backup.activities()
+    assert [id(act) for act in backup.activities()] == \
+        [id(act) for act in activities]
+    assert backup.quizzes()[0] is activities[1]
+    assert session.parse(tmp_path / "activities/page_1/page.xml") is \
+        activities[0].etree
+
+    # Without a session each backup parses its own files
+    assert MoodleBackup(tmp_path).activities()[0].etree is not \
+        activities[0].etree
+
+
+def test_backup_parallel_activity_loading_order(
+    tmp_path, mbz_builder, page_builder, lesson_builder
+):
+    activities = []
+    names = []
+    for idx in range(1, 13):
+        names.append(f"Lesson {idx}" if idx % 3 == 0 else f"Page {idx}")
+        if idx % 3 == 0:
+            activities.append(lesson_builder(
+                id=idx,
+                name=f"Lesson {idx}",
+                pages=[{"id": "1", "title": "Page", "html_content": "<p/>"}]
+            ))
+        else:
+            activities.append(page_builder(
+                id=idx, name=f"Page {idx}", html_content="<p></p>"
+            ))
+    mbz_builder(tmp_path, activities=activities)
+
+    serial = MoodleBackup(tmp_path, workers=1).activities()
+    parallel = MoodleBackup(tmp_path, workers=4).activities()
+    assert [act.name for act in serial] == names
+    assert [act.name for act in parallel] == [act.name for act in serial]
+
+    session = MoodleCourseSession(workers=4)
+    backup = session.moodle_backup(tmp_path)
+    assert backup.workers == 4
+    assert [act.name for act in backup.activities()] == \
+        [act.name for act in serial]
+
+
+def test_question_models_are_compact(tmp_path, mbz_builder):
+    mbz_builder(
+        tmp_path,
+        activities=[],
+        questionbank_questions=[
+            {
+                "id": 1,
+                "idnumber": 1,
+                "html_content": "<p>Q1</p>",
+                "answers": [
+                    {"id": 1, "grade": 1, "html_content": "<p>A1</p>"}
+                ]
+            },
+            {
+                "id": 2,
+                "idnumber": 2,
+                "html_content": "<p>Q2</p>",
+                "answers": []
+            }
+        ]
+    )
+    question_bank = MoodleQuestionBank(tmp_path)
+    questions = question_bank.questions
+    records = list(question_bank.iter_question_records())
+    elements = questions[0].html_elements()
+
+    for obj in questions + records + elements:
+        assert not hasattr(obj, "__dict__")
+    with pytest.raises(AttributeError):
+        questions[0].unexpected = True
+
+    # Repeated strings are shared between objects
+    assert questions[0].question_type is questions[1].question_type
+    assert records[0].question_type is records[1].question_type
+    assert questions[0].version is records[1].version
+    assert elements[0].location is elements[1].location
+
+
+def test_backup_save_writes_modified_files_once(
+    tmp_path, mbz_builder, page_builder, lesson_builder, quiz_builder,
+    mocker
+):
+    mbz_builder(
+        tmp_path,
+        activities=[
+            page_builder(
+                id=1, name="Page 1",
+                html_content='<p style="color: red">Styled</p>'
+            ),
+            page_builder(
+                id=2, name="Page 2", html_content='<p>Plain</p>'
+            ),
+            lesson_builder(
+                id=3,
+                name="Lesson 1",
+                pages=[
+                    {
+                        "id": 1, "title": "Page 1",
+                        "html_content": '<p style="color: red">1</p>'
+                    },
+                    {
+                        "id": 2, "title": "Page 2",
+                        "html_content": '<p style="color: red">2</p>'
+                    }
+                ]
+            ),
+            quiz_builder(
+                id=4,
+                name="Quiz 1",
+                questions=[
+                    {"id": 1, "slot": 1, "page": 1, "questionid": 1}
+                ]
+            )
+        ],
+        questionbank_questions=[
+            {
+                "id": 1,
+                "idnumber": 1,
+                "html_content": '<p>Q1</p>',
+                "answers": []
+            }
+        ]
+    )
+    write_etree = mocker.spy(utils, "write_etree")
+    backup = MoodleBackup(tmp_path)
+    for activity in backup.activities():
+        for elem in activity.html_elements():
+            elem.remove_attr("style")
+
+    # Rewriting content with itself doesn't count as a modification
+    quiz_elem = backup.quizzes()[0].html_elements()[0]
+    quiz_elem.update_html()
+
+    saved = backup.save()
+    assert saved == [
+        tmp_path / "activities/lesson_3/lesson.xml",
+        tmp_path / "activities/page_1/page.xml"
+    ]
+    assert sorted(
+        call.args[0] for call in write_etree.call_args_list
+    ) == [str(path) for path in saved]
+    assert "style" not in \
+        (tmp_path / "activities/lesson_3/lesson.xml").read_text()
+
+    # Nothing is written again until there are new changes
+    assert backup.save() == []
+    assert backup.q_bank.save() == []
+    backup.q_bank.inject_question_uuids()
+    assert backup.q_bank.save() == [tmp_path / "questions.xml"]
+
+
+def test_backup_save_only_writes_its_own_changes(
+    tmp_path, mbz_builder, page_builder, mocker
+):
+    mbz_builder(
+        tmp_path,
+        activities=[
+            page_builder(
+                id=1, name="Page 1",
+                html_content='<p style="color: red">Styled</p>'
+            ),
+            page_builder(
+                id=2, name="Page 2",
+                html_content='<p style="color: red">Styled</p>'
+            )
+        ],
+        questionbank_questions=[
+            {"id": 1, "idnumber": 1234, "html_content": "<p>Q1</p>"}
+        ]
+    )
+    backup = MoodleBackup(tmp_path)
+    other_backup = MoodleBackup(tmp_path)
+    for elem in backup.activities()[0].html_elements():
+        elem.remove_attr("style")
+    for elem in other_backup.activities()[1].html_elements():
+        elem.remove_attr("style")
+    other_backup.q_bank.inject_question_uuids()
+
+    assert backup.save() == [tmp_path / "activities/page_1/page.xml"]
+    assert backup.q_bank.save() == []
+    assert other_backup.save() == [
+        tmp_path / "activities/page_2/page.xml",
+        tmp_path / "questions.xml"
+    ]
+
+
+def test_unsaved_changes_are_freed_with_backup(
+    tmp_path, mbz_builder, page_builder
+):
+    mbz_builder(tmp_path, activities=[
+        page_builder(
+            id=1, name="Page 1",
+            html_content='<p style="color: red">Styled</p>'
+        )
+    ])
+
+    def live_trackers():
+        gc.collect()
+        return sum(
+            isinstance(obj, ModifiedTrees) for obj in gc.get_objects()
+        )
+
+    trackers = live_trackers()
+    backup = MoodleBackup(tmp_path)
+    for elem in backup.activities()[0].html_elements():
+        elem.remove_attr("style")
+    assert live_trackers() == trackers + 1
+    del backup, elem
+    assert live_trackers() == trackers
+    assert MoodleBackup(tmp_path).save() == []
@@ -52,6 +52,37 @@ def test_remove_styles_from_main(
         assert ('style' not in file)
 
 
+def test_remove_styles_leaves_question_bank_alone(
+    tmp_path, mbz_builder, page_builder, quiz_builder
+):
+    content_with_styles = '<p style="color: blue">Text</p>'
+    page = page_builder(2, "Page", content_with_styles)
+    quiz = quiz_builder(
+        id=1,
+        name="Quiz",
+        questions=[
+            {"id": "31", "slot": 1, "page": 1, "questionid": "11"}
+        ]
+    )
+    mbz_builder(
+        tmp_path,
+        activities=[page, quiz],
+        questionbank_questions=[
+            {"id": 11, "idnumber": 1234, "html_content": content_with_styles}
+        ]
+    )
+    questions_xml = (tmp_path / "questions.xml").read_bytes()
+    quiz_xml = (tmp_path / "activities/quiz_1/quiz.xml").read_bytes()
+
+    remove_styles.remove_styles(tmp_path)
+
+    assert "style" not in \
+        (tmp_path / "activities/page_2/page.xml").read_text()
+    assert (tmp_path / "questions.xml").read_bytes() == questions_xml
+    assert (tmp_path / "activities/quiz_1/quiz.xml").read_bytes() == \
+        quiz_xml
+
+
 def test_styles_removed_from_html():
     location = "here"
     parent = etree.fromstring("<content></content>")
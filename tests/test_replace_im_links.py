@@ -445,3 +445,52 @@ def test_replace_im_resources_html_overlapping_filenames(
     assert len(resources) == 2
     for r in resources:
         assert new_prefix in r
+
+
+def test_replace_im_links_mbz_writes_only_modified_files(
+    tmp_path, mbz_builder, page_builder, mocker
+):
+    media_json = [
+        {
+            'mime_type': 'application/json',
+            'sha1': 'dc330ae2bc1d0b2edac442ed3f8245647cf5c0c0',
+            'original_filename': 'abcd.json',
+            's3_key': 'resources/dc330ae2bc1d0b2edac442ed3f8245647cf5c0c0'
+        }
+    ]
+    media_path = tmp_path / "media.json"
+    media_path.write_text(json.dumps(media_json))
+
+    mbz_path = tmp_path / "mbz"
+    mbz_builder(
+        mbz_path,
+        activities=[
+            page_builder(
+                id=1,
+                name="Page 1",
+                html_content=f'<img src="{IM_PREFIX}abcd.json">'
+            ),
+            page_builder(
+                id=2,
+                name="Page 2",
+                html_content='<p>Nothing to replace</p>'
+            ),
+            page_builder(
+                id=3,
+                name="Page 3",
+                html_content='<p>Nothing to replace</p>'
+            )
+        ]
+    )
+    write_etree = mocker.spy(utils, "write_etree")
+    mocker.patch(
+        "sys.argv",
+        ["", f"{mbz_path}", f"{media_path}", "k12", "mbz"]
+    )
+
+    replace_im_links.main()
+
+    written = [call.args[0] for call in write_etree.call_args_list]
+    assert written == [str(mbz_path / "activities/page_1/page.xml")]
+    assert collect_resources_from_mbz(mbz_path) == \
+        ["k12/resources/dc330ae2bc1d0b2edac442ed3f8245647cf5c0c0"]
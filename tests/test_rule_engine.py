@@ -0,0 +1,100 @@
+from lxml import etree
+from mbtools.models import MoodleHtmlElement
+from mbtools.rule_engine import HtmlRule, HtmlRuleEngine
+from mbtools.rule_profiler import RuleProfiler
+
+
+class RecordingRule(HtmlRule):
+    def __init__(self, name, tags=(), attributes=(), class_substrings=()):
+        self.name = name
+        self.tags = tags
+        self.attributes = attributes
+        self.class_substrings = class_substrings
+        self.calls = []
+
+    def start(self, html_elem):
+        self.visited = []
+
+    def visit(self, html_elem, node):
+        self.visited.append(node.get("id"))
+
+    def finish(self, html_elem):
+        self.calls.append(self.visited)
+        return [(self.name, html_elem.location, node_id)
+                for node_id in self.visited]
+
+
+def html_element(content, location):
+    parent = etree.Element("content")
+    parent.text = content
+    return MoodleHtmlElement(parent, location)
+
+
+def test_rules_dispatched_by_tag_attribute_and_class():
+    by_tag = RecordingRule("tag", tags=("a",))
+    by_attribute = RecordingRule("attribute", attributes=("style",))
+    by_class = RecordingRule("class", class_substrings=("os-raise-ib-",))
+    combined = RecordingRule(
+        "combined", tags=("p",), attributes=("style",)
+    )
+    engine = HtmlRuleEngine([by_tag, by_attribute, by_class, combined])
+
+    elements = [
+        html_element(
+            '<p id="1" style="color: red">'
+            '<a id="2" class="os-raise-ib-cta">link</a></p>'
+            '<div id="3" class="x os-raise-ib-pset"></div>',
+            "first"
+        ),
+        html_element('<a id="4" style="">link</a>', "second")
+    ]
+    violations = engine.run(elements)
+
+    # Violations are grouped by rule, then by element
+    assert violations == [
+        ("tag", "first", "2"),
+        ("tag", "second", "4"),
+        ("attribute", "first", "1"),
+        ("attribute", "second", "4"),
+        ("class", "first", "2"),
+        ("class", "first", "3"),
+        ("combined", "first", "1"),
+        ("combined", "second", "4"),
+    ]
+    # A rule matching a node through several selectors sees it once
+    assert combined.calls == [["1"], ["4"]]
+
+
+def test_rules_see_every_fragment():
+    rule = RecordingRule("tag", tags=("p",))
+    element = html_element(
+        '<p id="1"></p><!-- comment --><div><p id="2"></p></div>'
+        '<p id="3"></p>',
+        "here"
+    )
+    HtmlRuleEngine([rule]).run([element])
+    assert rule.calls == [["1", "2", "3"]]
+
+
+def test_profiled_run_matches_unprofiled():
+    elements = [
+        html_element('<a id="1"></a><p id="2" style="x"></p>', "first"),
+        html_element('<p id="3"><a id="4"></a></p>', "second")
+    ]
+
+    def rules():
+        return [
+            RecordingRule("tag", tags=("a",)),
+            RecordingRule("attribute", attributes=("style",))
+        ]
+
+    profiler = RuleProfiler()
+    expected = HtmlRuleEngine(rules()).run_by_rule(elements)
+    assert HtmlRuleEngine(rules(), profiler).run_by_rule(elements) == \
+        expected
+    report = profiler.report()["rules"]
+    assert report["tag"]["elements"] == 2
+    assert report["tag"]["nodes"] == 2
+    assert report["tag"]["violations"] == 2
+    assert report["attribute"]["nodes"] == 1
+    assert [slow["location"] for slow in report["tag"]["slowest"]] != []
@@ -0,0 +1,47 @@
+import json
+from mbtools.rule_profiler import RuleProfiler
+
+
+def test_record_keeps_slowest_locations():
+    profiler = RuleProfiler(slowest=2)
+    for idx, seconds in enumerate([0.3, 0.1, 0.5, 0.2]):
+        profiler.record("style", f"loc{idx}", seconds, violations=idx,
+                        nodes=2)
+    report = profiler.report()["rules"]["style"]
+    assert report["seconds"] == 0.3 + 0.1 + 0.5 + 0.2
+    assert report["elements"] == 4
+    assert report["nodes"] == 8
+    assert report["violations"] == 6
+    assert report["slowest"] == [
+        {"location": "loc2", "seconds": 0.5},
+        {"location": "loc0", "seconds": 0.3}
+    ]
+
+
+def test_merge():
+    profiler = RuleProfiler(slowest=2)
+    profiler.record("style", "a", 0.1)
+    other = RuleProfiler(slowest=2)
+    other.record("style", "b", 0.3, violations=1)
+    other.record("tag", "c", 0.2)
+    profiler.merge(other)
+    rules = profiler.report()["rules"]
+    assert list(rules) == ["style", "tag"]
+    assert rules["style"]["elements"] == 2
+    assert rules["style"]["violations"] == 1
+    assert [slow["location"] for slow in rules["style"]["slowest"]] == \
+        ["b", "a"]
+
+
+def test_call_and_iter_profiled(tmp_path):
+    profiler = RuleProfiler()
+    assert profiler.call("unnested", "a", lambda x: [x, x], 1) == [1, 1]
+    assert list(profiler.iter_profiled("qbank", "b", iter("xyz"))) == \
+        ["x", "y", "z"]
+    report_path = tmp_path / "profile.json"
+    profiler.save(report_path)
+    with open(report_path) as f:
+        rules = json.load(f)["rules"]
+    assert rules["unnested"]["violations"] == 2
+    assert rules["qbank"]["violations"] == 3
+    assert rules["qbank"]["elements"] == 1
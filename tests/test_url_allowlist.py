@@ -0,0 +1,90 @@
+import json
+from mbtools.url_allowlist import UrlAllowlist, UrlAllowlists
+import pytest
+
+
+def test_allowlist_matches_prefix_anywhere():
+    allowlist = UrlAllowlist(["https://a.org", "https://a.org/b", "https://c"])
+    assert allowlist.allows("https://a.org/page")
+    assert allowlist.allows("https://c.org")
+    assert allowlist.allows("https://x.org/?next=https://a.org")
+    assert not allowlist.allows("https://b.org")
+    assert not allowlist.allows("http://a.org")
+
+
+def test_allowlist_strict_requires_prefix():
+    allowlist = UrlAllowlist(["https://a.org", "https://c"], strict=True)
+    assert allowlist.allows("https://a.org/page")
+    assert allowlist.allows("https://c.org")
+    assert not allowlist.allows("https://x.org/?next=https://a.org")
+
+
+def test_allowlist_values_match_exactly():
+    allowlist = UrlAllowlist(["https://a.org/b"], ["https://a.org/"])
+    assert allowlist.allows("https://a.org/")
+    assert allowlist.allows("https://a.org/b/c")
+    assert not allowlist.allows("https://a.org/c")
+
+
+def test_allowlist_escapes_special_characters():
+    allowlist = UrlAllowlist(["https://a.org/?q=(1)"])
+    assert allowlist.allows("https://a.org/?q=(1)")
+    assert not allowlist.allows("https://aXorg/q=1")
+
+
+def test_empty_allowlist_allows_nothing():
+    allowlist = UrlAllowlist([])
+    assert not allowlist.allows("")
+    assert not allowlist.allows("https://a.org")
+
+
+def test_allowlists_from_file(tmp_path):
+    config_path = tmp_path / "allowlists.json"
+    config_path.write_text(json.dumps({
+        "iframe_prefixes": ["https://video.org"],
+        "strict": True
+    }))
+    defaults = {
+        "source_prefixes": ["https://a.org"],
+        "iframe_prefixes": ["https://b.org"],
+        "href_prefixes": ["https://c.org"],
+        "href_values": ["https://d.org/"]
+    }
+    allowlists = UrlAllowlists.from_file(config_path, defaults)
+    assert allowlists.iframe.prefixes == ["https://video.org"]
+    assert allowlists.source.prefixes == ["https://a.org"]
+    assert allowlists.href.allows("https://d.org/")
+    assert not allowlists.source.allows("x https://a.org")
+    assert allowlists.config()["href"] == {
+        "prefixes": ["https://c.org"],
+        "values": ["https://d.org/"],
+        "strict": True
+    }
+
+
+@pytest.mark.parametrize("file_strict, strict, expected", [
+    (None, False, False),
+    (None, True, True),
+    (True, False, True),
+    (False, True, True),
+    (False, False, False)
+])
+def test_allowlists_from_file_strict(tmp_path, file_strict, strict,
+                                     expected):
+    config = {}
+    if file_strict is not None:
+        config["strict"] = file_strict
+    config_path = tmp_path / "allowlists.json"
+    config_path.write_text(json.dumps(config))
+    allowlists = UrlAllowlists.from_file(config_path, {
+        "source_prefixes": [], "iframe_prefixes": [], "href_prefixes": [],
+        "href_values": []
+    }, strict)
+    assert allowlists.source.strict is expected
+
+
+def test_allowlists_from_file_unknown_key(tmp_path):
+    config_path = tmp_path / "allowlists.json"
+    config_path.write_text(json.dumps({"iframe": ["https://video.org"]}))
+    with pytest.raises(Exception, match="Unknown allowlist keys"):
+        UrlAllowlists.from_file(config_path, {})
@@ -1,4 +1,5 @@
 from mbtools import utils
+from mbtools.models import MoodleCourseSession
 
 
 def test_parse_backup_activities(
@@ -212,3 +213,27 @@ def test_find_question_html(tmp_path, mbz_builder):
         qb_question3_match1_question,
         qb_question3_match2_question
     ]) == set(html)
+
+
+def test_question_html_changes_are_saved(tmp_path, mbz_builder):
+    mbz_builder(
+        tmp_path,
+        activities=[],
+        questionbank_questions=[
+            {
+                "id": 1,
+                "idnumber": 1234,
+                "html_content": '<p style="color: blue">Question</p>'
+            }
+        ]
+    )
+    session = MoodleCourseSession()
+    html_elements = utils.parse_question_bank_latest_for_html(
+        tmp_path, session
+    )
+    for elem in html_elements:
+        elem.remove_attr("style")
+
+    assert session.question_bank(tmp_path).save() == \
+        [tmp_path / "questions.xml"]
+    assert "style" not in (tmp_path / "questions.xml").read_text()
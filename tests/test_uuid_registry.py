@@ -0,0 +1,39 @@
+from mbtools.uuid_registry import UuidRegistry
+
+
+def test_find_duplicates_across_courses(tmp_path):
+    db_path = tmp_path / "uuids.db"
+    with UuidRegistry(db_path) as registry:
+        registry.replace_course("course-a", [
+            ("uuid-1", "ib", "a/page.xml"),
+            ("uuid-2", "question", "a/questions.xml")
+        ])
+        registry.replace_course("course-b", [
+            ("uuid-1", "content", "b/page.xml")
+        ])
+
+    with UuidRegistry(db_path) as registry:
+        assert registry.courses() == ["course-a", "course-b"]
+        records = [
+            ("uuid-3", "ib", "c/page.xml"),
+            ("uuid-2", "question", "c/questions.xml"),
+            ("uuid-1", "ib", "c/lesson.xml")
+        ]
+        assert registry.find_duplicates("course-c", records) == [
+            (1, "course-a", "question", "a/questions.xml"),
+            (2, "course-a", "ib", "a/page.xml"),
+            (2, "course-b", "content", "b/page.xml")
+        ]
+        # A course doesn't collide with its own earlier records
+        assert registry.find_duplicates("course-a", [
+            ("uuid-2", "question", "a/questions.xml")
+        ]) == []
+
+
+def test_replace_course(tmp_path):
+    with UuidRegistry(tmp_path / "uuids.db") as registry:
+        registry.replace_course("course-a", [("uuid-1", "ib", "a")])
+        registry.replace_course("course-a", [("uuid-2", "ib", "a")])
+        assert registry.find_duplicates(
+            "course-b", [("uuid-1", "ib", "b"), ("uuid-2", "ib", "b")]
+        ) == [(1, "course-a", "ib", "a")]
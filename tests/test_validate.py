@@ -1,8 +1,12 @@
 import csv
+import gc
+import json
 import os
 from lxml import etree
 from mbtools import validate_mbz_html
-from mbtools.models import MoodleHtmlElement
+from mbtools.models import MoodleBackup, MoodleHtmlElement, MoodlePage
+from mbtools.rule_profiler import RuleProfiler
+from mbtools.uuid_registry import UuidRegistry
 from pathlib import Path
 import pytest
 
@@ -1380,3 +1384,838 @@ def test_extracted_corruption(
     assert violations[1].link == "26d5d10b-1ce2-4dcc-960f-43c424c93628"
     assert violations[2].location == "Page 3"
     assert violations[2].link == "26d5d10b-1ce2-4dcc-960f-43c424c93627"
+
+
+def test_validate_mbz_parses_each_file_once(
+    tmp_path, mbz_builder, page_builder, lesson_builder, quiz_builder,
+    mocker
+):
+    page = page_builder(id=1, name="Page", html_content="<p>Page</p>")
+    lesson = lesson_builder(
+        id=2,
+        name="Lesson",
+        pages=[{"id": "1", "title": "Page", "html_content": "<p>L</p>"}]
+    )
+    quiz = quiz_builder(
+        id=3,
+        name="Quiz",
+        questions=[
+            {"id": "31", "slot": 1, "page": 1, "questionid": "11"}
+        ]
+    )
+    mbz_builder(
+        tmp_path,
+        activities=[page, lesson, quiz],
+        questionbank_questions=[
+            {"id": 11, "idnumber": 1234, "html_content": "<p>Q</p>"}
+        ]
+    )
+
+    parse = mocker.spy(etree, "parse")
+    iterparse = mocker.spy(etree, "iterparse")
+    validate_mbz_html.validate_mbz(tmp_path, include_questionbank=True)
+
+    parsed_files = [str(call.args[0]) for call in parse.call_args_list]
+    assert len(parsed_files) == len(set(parsed_files))
+    # The question bank is streamed once rather than parsed into a tree
+    assert str(tmp_path / "questions.xml") not in parsed_files
+    streamed_files = [
+        call.args[0].name for call in iterparse.call_args_list
+    ]
+    assert streamed_files == [str(tmp_path / "questions.xml")]
+
+
+def test_validate_mbz_parses_each_element_once(
+    tmp_path, mbz_builder, page_builder, lesson_builder, mocker
+):
+    content = '<div class="os-raise-content" data-content-id="' \
+        '0c6fd0be-6bd2-4ff1-9db0-6d0a0d0fbc9b"></div>'
+    page = page_builder(id=1, name="Page", html_content=content)
+    lesson = lesson_builder(
+        id=2,
+        name="Lesson",
+        pages=[{
+            "id": "1",
+            "title": "Page",
+            "html_content": content,
+            "answers": [{
+                "id": 11,
+                "html_content": "<p>Answer</p>",
+                "response": "<p>Response</p>"
+            }]
+        }]
+    )
+    mbz_builder(tmp_path, activities=[page, lesson])
+
+    parse_fragments = mocker.spy(MoodleHtmlElement, "_parse_fragments")
+    violations = validate_mbz_html.validate_mbz(tmp_path)
+
+    assert [v.issue for v in violations] == \
+        [validate_mbz_html.DUPLICATE_CONTENT_UUID_VIOLATION]
+    parsed = [call.args[0].location for call in parse_fragments.call_args_list]
+    assert len(parsed) == 4
+    assert len(set(parsed)) == 4
+
+
+def test_validate_mbz_releases_activity_trees(
+    tmp_path, mbz_builder, page_builder, mocker
+):
+    pages = [
+        page_builder(id=i, name=f"Page {i}", html_content="<p>Page</p>")
+        for i in range(1, 4)
+    ]
+    mbz_builder(tmp_path, activities=pages)
+
+    live_pages = []
+    original = MoodleBackup.iter_activities
+
+    def iter_activities(backup):
+        for activity in original(backup):
+            yield activity
+            # Only the activity the caller has just finished with is alive
+            gc.collect()
+            live_pages.append(sum(
+                isinstance(obj, MoodlePage) for obj in gc.get_objects()
+            ))
+
+    mocker.patch.object(MoodleBackup, "iter_activities", iter_activities)
+    validate_mbz_html.validate_mbz(tmp_path)
+    assert live_pages == [1, 1, 1]
+
+
+def test_validate_mbz_jobs_match_serial(
+    tmp_path, mbz_builder, page_builder, quiz_builder
+):
+    page = page_builder(
+        id=1, name="Page", html_content='<p style="color: red">Page</p>'
+    )
+    quiz = quiz_builder(
+        id=2,
+        name="Quiz",
+        questions=[
+            {"id": "31", "slot": 1, "page": 1, "questionid": "11"}
+        ]
+    )
+    mbz_builder(
+        tmp_path,
+        activities=[page, quiz],
+        questionbank_questions=[
+            {"id": 11, "idnumber": 1234, "html_content": "<table></table>"},
+            {"id": 12, "idnumber": 1234, "html_content": "<script></script>"}
+        ]
+    )
+
+    serial = validate_mbz_html.validate_mbz(
+        tmp_path, include_styles=True, include_questionbank=True
+    )
+    parallel = validate_mbz_html.validate_mbz(
+        tmp_path, include_styles=True, include_questionbank=True, jobs=2
+    )
+    assert serial
+    assert [v.toDict() for v in parallel] == [v.toDict() for v in serial]
+
+
+def test_run_html_validations_orders_violations_by_rule():
+    parent = etree.fromstring("<content></content>")
+    parent.text = (
+        '<div><script>x</script>'
+        '<img src="http://example.com/a.png">'
+        '<p style="color: red">text</p>'
+        '<a>no href</a>'
+        '<table><tr><td>1</td></tr></table></div>'
+    )
+    elem = MoodleHtmlElement(parent, "here")
+    violations = validate_mbz_html.run_html_validations([elem], True, False)
+    assert [(violation.issue, violation.link) for violation in violations] \
+        == [
+            (validate_mbz_html.STYLE_VIOLATION, "color: red"),
+            (validate_mbz_html.TABLE_VIOLATION +
+             "table is missing a class attribute", None),
+            (validate_mbz_html.TABLE_VIOLATION + "thead missing in table",
+             None),
+            (validate_mbz_html.TABLE_VIOLATION + "tbody missing in table",
+             None),
+            (validate_mbz_html.TABLE_VIOLATION +
+             "tr is not allowed as direct child of table", None),
+            (validate_mbz_html.TABLE_VIOLATION +
+             "th is required in either thead or tbody", None),
+            (validate_mbz_html.SOURCE_VIOLATION, "http://example.com/a.png"),
+            (validate_mbz_html.SCRIPT_VIOLATION, None),
+            (validate_mbz_html.LINK_TARGET_VIOLATION, None),
+        ]
+
+
+def test_validate_html_jobs_matches_serial(tmp_path, mocker):
+    html_path = tmp_path / "html"
+    html_path.mkdir()
+    contents = [
+        '<p style="color: red">Styled</p><script>x</script>',
+        '<div class="os-raise-ib-pset" '
+        'data-content-id="8fd0a5a4-0c56-4d5c-9f5f-2f5a6d1c5b1e"></div>',
+        '<div><div class="os-raise-ib-input" '
+        'data-content-id="8fd0a5a4-0c56-4d5c-9f5f-2f5a6d1c5b1e"></div></div>',
+        '<img src="http://example.com/a.png"><a href="link">link</a>',
+        '<table class="os-raise-doubleheadertable"><tbody><tr><td>1</td>'
+        '</tr></tbody></table>',
+        '<div class="os-raise-ib-input" data-content-id="bad"></div>',
+        '<div class="os-raise-ib-pset-problem"></div>',
+        '<iframe src="https://example.com"></iframe>',
+    ]
+    for idx, content in enumerate(contents * 2):
+        (html_path / f"{idx}.html").write_text(content)
+
+    outputs = []
+    for jobs in ["1", "3"]:
+        output_path = tmp_path / f"output_{jobs}.csv"
+        mocker.patch(
+            "sys.argv",
+            ["", str(html_path), str(output_path), "html",
+             "--uuids-populated", "--jobs", jobs]
+        )
+        validate_mbz_html.main()
+        outputs.append(output_path.read_text())
+
+    assert len(outputs[0].splitlines()) > len(contents)
+    assert outputs[0] == outputs[1]
+
+
+def test_run_html_validations_jobs_unnested():
+    elements = []
+    for idx, content in enumerate(
+        ['<p>Nested</p>', 'Unnested <p>text</p>', '<p style="a">x</p>',
+         '<p>Nested</p> tail']
+    ):
+        parent = etree.fromstring("<content></content>")
+        parent.text = content
+        elements.append(MoodleHtmlElement(parent, f"location {idx}"))
+
+    violations = validate_mbz_html.run_html_validations(
+        elements, True, False, jobs=2
+    )
+    assert [(v.issue, v.location, v.link) for v in violations] == [
+        (validate_mbz_html.UNNESTED_VIOLATION, "location 1", "Unnested "),
+        (validate_mbz_html.UNNESTED_VIOLATION, "location 3", " tail"),
+    ]
+
+
+def test_validate_html_cache(tmp_path, mocker):
+    html_path = tmp_path / "html"
+    html_path.mkdir()
+    cache_path = tmp_path / "cache/validation.json"
+    uuid = "8fd0a5a4-0c56-4d5c-9f5f-2f5a6d1c5b1e"
+    (html_path / "1.html").write_text(
+        f'<div class="os-raise-ib-pset" data-content-id="{uuid}"></div>'
+    )
+    (html_path / "2.html").write_text('<p style="color: red">Styled</p>')
+    (html_path / "3.html").write_text('<p>Valid</p>')
+
+    def validate(**kwargs):
+        return [
+            (v.issue, v.location, v.link)
+            for v in validate_mbz_html.validate_html(html_path, **kwargs)
+        ]
+
+    validate_element = mocker.spy(validate_mbz_html, "validate_element")
+    assert validate(cache_path=cache_path) == validate()
+    assert cache_path.exists()
+
+    # Unchanged files are not parsed again
+    validate_element.reset_mock()
+    assert validate(cache_path=cache_path) == validate()
+    validate_element.reset_mock()
+    validate(cache_path=cache_path)
+    assert validate_element.call_count == 0
+
+    # A changed file is revalidated and cross-file UUID checks use the
+    # cached UUIDs of the other files
+    (html_path / "3.html").write_text(
+        f'<div class="os-raise-ib-input" data-content-id="{uuid}"></div>'
+    )
+    validate_element.reset_mock()
+    cached = validate(cache_path=cache_path)
+    assert [call.args[0].location for call in
+            validate_element.call_args_list] == [str(html_path / "3.html")]
+    assert cached == validate()
+    assert validate_mbz_html.DUPLICATE_IB_UUID_VIOLATION in \
+        [issue for issue, _, _ in cached]
+
+    # Results depend on the rule set, so changing it invalidates the cache
+    expected = validate(include_styles=False)
+    validate_element.reset_mock()
+    assert validate(cache_path=cache_path, include_styles=False) == expected
+    assert validate_element.call_count == 3
+
+
+@pytest.mark.parametrize("cache", [False, True])
+def test_validate_html_releases_elements(tmp_path, mocker, cache):
+    html_path = tmp_path / "html"
+    html_path.mkdir()
+    for idx in range(4):
+        (html_path / f"{idx}.html").write_text(
+            f'<p style="color: red">{idx}</p>'
+        )
+
+    live_elements = []
+    original = validate_mbz_html.read_html_file
+
+    def read_html_file(file_path):
+        gc.collect()
+        live_elements.append(sum(
+            isinstance(obj, MoodleHtmlElement) for obj in gc.get_objects()
+        ))
+        return original(file_path)
+
+    mocker.patch.object(validate_mbz_html, "read_html_file", read_html_file)
+    violations = validate_mbz_html.iter_html_violations(
+        html_path, cache_path=tmp_path / "cache.json" if cache else None
+    )
+    assert len(list(violations)) == 4
+    # At most the element read before is alive when a file is read
+    assert len(live_elements) == 4
+    assert max(live_elements) <= 1
+
+
+def test_validate_html_allowlist_config(tmp_path, mocker):
+    html_path = tmp_path / "html"
+    html_path.mkdir()
+    (html_path / "1.html").write_text(
+        '<img src="https://example.org/a.png">'
+        '<iframe src="https://www.youtube-nocookie.com/embed/1"></iframe>'
+        '<a href="https://tracker.org/?u=https://openstax.org/k12" '
+        'target="_blank">Link</a>'
+    )
+    config_path = tmp_path / "allowlists.json"
+    config_path.write_text(
+        '{"source_prefixes": ["https://example.org/"]}'
+    )
+    output_filepath = tmp_path / "test_output.csv"
+
+    def run(*args):
+        mocker.patch(
+            "sys.argv",
+            ["", str(html_path), str(output_filepath), "html", *args]
+        )
+        validate_mbz_html.main()
+        reader = csv.DictReader(open(output_filepath))
+        return [(row["issue"], row["link"]) for row in reader]
+
+    assert run() == [
+        (validate_mbz_html.SOURCE_VIOLATION, "https://example.org/a.png")
+    ]
+    assert run("--allowlist-config", str(config_path)) == []
+    assert run("--allowlist-config", str(config_path), "--strict-urls") == [
+        (validate_mbz_html.HREF_VIOLATION,
+         "https://tracker.org/?u=https://openstax.org/k12")
+    ]
+
+
+@pytest.mark.parametrize("output_format", ["csv", "jsonl", "sarif"])
+def test_validate_mbz_output_formats(tmp_path, mocker, mbz_builder,
+                                     page_builder, output_format):
+    mbz_builder(
+        tmp_path,
+        activities=[
+            page_builder(
+                id=1, name="Page",
+                html_content='<p style="color: red">Styled</p>'
+            )
+        ],
+        questionbank_questions=[
+            {"id": 11, "idnumber": 1234, "html_content": "<p>Q</p>"}
+        ]
+    )
+    output_file = tmp_path / f"output.{output_format}"
+    mocker.patch(
+        "sys.argv",
+        ["", str(tmp_path), str(output_file), "mbz", "--format",
+         output_format]
+    )
+    validate_mbz_html.main()
+
+    with open(output_file) as f:
+        if output_format == "csv":
+            issues = [row["issue"] for row in csv.DictReader(f)]
+        elif output_format == "jsonl":
+            issues = [json.loads(line)["issue"] for line in f]
+        else:
+            issues = [
+                result["message"]["text"].split(" (")[0]
+                for result in json.load(f)["runs"][0]["results"]
+            ]
+    assert issues == [
+        validate_mbz_html.STYLE_VIOLATION,
+        validate_mbz_html.INVALID_QBANK_UUID_VIOLATION
+    ]
+
+
+def test_validate_mbz_profile(tmp_path, mocker, mbz_builder, page_builder):
+    mbz_builder(tmp_path / "mbz", activities=[
+        page_builder(
+            id=1, name="Page",
+            html_content='<p style="color: red">Styled</p>'
+        ),
+        page_builder(id=2, name="Page", html_content="<p>Valid</p>")
+    ])
+    profile_path = tmp_path / "profile.json"
+    mocker.patch(
+        "sys.argv",
+        ["", str(tmp_path / "mbz"), str(tmp_path / "output.csv"), "mbz",
+         "--profile", str(profile_path)]
+    )
+    validate_mbz_html.main()
+
+    with open(profile_path) as f:
+        rules = json.load(f)["rules"]
+    assert set(rules) == {
+        "unnested", "style", "table", "source", "tag", "nested_ib",
+        "ib_uuid", "qbank_uuid", "extracted_uuid", "extracted_corruption"
+    }
+    assert rules["style"]["elements"] == 2
+    assert rules["style"]["violations"] == 1
+    assert rules["style"]["nodes"] == 1
+    assert len(rules["style"]["slowest"]) == 2
+
+
+def test_validate_html_profile_jobs(tmp_path):
+    html_path = tmp_path / "html"
+    html_path.mkdir()
+    uuid = "8fd0a5a4-0c56-4d5c-9f5f-2f5a6d1c5b1e"
+    for idx in range(4):
+        (html_path / f"{idx}.html").write_text(
+            f'<div class="os-raise-ib-pset" data-content-id="{uuid}">'
+            '<script>x</script></div>'
+        )
+
+    def profile(jobs):
+        profiler = RuleProfiler()
+        validate_mbz_html.validate_html(
+            html_path, jobs=jobs, profiler=profiler
+        )
+        return {
+            rule: (stats["elements"], stats["nodes"], stats["violations"])
+            for rule, stats in profiler.report()["rules"].items()
+        }
+
+    serial = profile(1)
+    assert serial["tag"] == (4, 4, 4)
+    assert serial["ib_uuid"] == (4, 4, 3)
+    assert profile(2) == serial
+
+
+def test_html_watcher(tmp_path, mocker):
+    html_path = tmp_path / "html"
+    html_path.mkdir()
+    uuid = "8fd0a5a4-0c56-4d5c-9f5f-2f5a6d1c5b1e"
+    (html_path / "1.html").write_text(
+        f'<div class="os-raise-ib-pset" data-content-id="{uuid}"></div>'
+    )
+    (html_path / "2.html").write_text('<p style="color: red">Styled</p>')
+    (html_path / "3.html").write_text('<p>Valid</p>')
+
+    def rows(violations):
+        return [(v.issue, v.location, v.link) for v in violations]
+
+    def expected():
+        return rows(validate_mbz_html.validate_html(html_path))
+
+    watcher = validate_mbz_html.HtmlWatcher(html_path)
+    read_html_file = mocker.spy(validate_mbz_html, "read_html_file")
+    violations, changed = watcher.validate()
+    assert rows(violations) == expected()
+    assert len(changed) == 3
+
+    read_html_file.reset_mock()
+    violations, changed = watcher.validate()
+    assert changed == []
+    assert read_html_file.call_count == 0
+
+    # Only the edited file is parsed again and the duplicate UUID is found
+    # using the stored UUIDs of the other files
+    (html_path / "3.html").write_text(
+        f'<div class="os-raise-ib-input" data-content-id="{uuid}"></div>'
+    )
+    read_html_file.reset_mock()
+    violations, changed = watcher.validate()
+    assert changed == [html_path / "3.html"]
+    assert [call.args[0] for call in read_html_file.call_args_list] == \
+        [html_path / "3.html"]
+    assert rows(violations) == expected()
+    assert validate_mbz_html.DUPLICATE_IB_UUID_VIOLATION in \
+        [issue for issue, _, _ in rows(violations)]
+
+    (html_path / "1.html").unlink()
+    violations, changed = watcher.validate()
+    assert changed == [html_path / "1.html"]
+    assert rows(violations) == expected()
+
+
+def test_validate_html_watch(tmp_path, mocker):
+    html_path = tmp_path / "html"
+    html_path.mkdir()
+    (html_path / "1.html").write_text('<p>Valid</p>')
+    output_path = tmp_path / "output.csv"
+
+    def edit(interval):
+        # Edit the file after the first poll and stop after the second
+        if sleep.call_count > 1:
+            raise KeyboardInterrupt
+        (html_path / "1.html").write_text('<p style="a">Styled</p>')
+
+    sleep = mocker.patch("time.sleep", side_effect=edit)
+    mocker.patch(
+        "sys.argv",
+        ["", str(html_path), str(output_path), "html", "--watch"]
+    )
+    writes = mocker.spy(validate_mbz_html, "write_violations")
+    validate_mbz_html.main()
+
+    assert writes.call_count == 2
+    rows = list(csv.DictReader(open(output_path)))
+    assert [row["issue"] for row in rows] == \
+        [validate_mbz_html.STYLE_VIOLATION]
+
+
+def test_validate_watch_requires_html_mode(tmp_path, mocker):
+    mocker.patch(
+        "sys.argv",
+        ["", str(tmp_path), str(tmp_path / "output.csv"), "mbz", "--watch"]
+    )
+    with pytest.raises(SystemExit):
+        validate_mbz_html.main()
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_html_watcher_file_errors(tmp_path, jobs):
+    html_path = tmp_path / "html"
+    html_path.mkdir()
+    (html_path / "1.html").write_text('<p style="color: red">Styled</p>')
+    (html_path / "2.html").write_text("")
+
+    watcher = validate_mbz_html.HtmlWatcher(html_path, jobs=jobs)
+    violations, changed = watcher.validate()
+    assert [v.location for v in violations] == [str(html_path / "1.html")]
+    assert sorted(changed) == [html_path / "1.html", html_path / "2.html"]
+    assert list(watcher.errors) == [html_path / "2.html"]
+    assert watcher.errors[html_path / "2.html"].startswith("IndexError")
+
+    # The file is retried but the same error isn't reported again
+    violations, changed = watcher.validate()
+    assert changed == []
+    assert list(watcher.errors) == [html_path / "2.html"]
+
+    (html_path / "2.html").write_text('<p style="color: red">Saved</p>')
+    violations, changed = watcher.validate()
+    assert changed == [html_path / "2.html"]
+    assert watcher.errors == {}
+    assert len(violations) == 2
+
+
+def test_html_watcher_file_removed_while_listing(tmp_path, mocker):
+    html_path = tmp_path / "html"
+    html_path.mkdir()
+    (html_path / "1.html").write_text('<p style="color: red">Styled</p>')
+    missing = html_path / "2.html"
+    mocker.patch.object(
+        Path, "rglob", lambda self, pattern: iter([html_path / "1.html",
+                                                   missing])
+    )
+    watcher = validate_mbz_html.HtmlWatcher(html_path)
+    violations, changed = watcher.validate()
+    assert changed == [html_path / "1.html"]
+    assert len(violations) == 1
+    assert watcher.errors == {}
+
+
+@pytest.mark.parametrize("option", [
+    ["--cache", "cache.json"], ["--profile", "profile.json"],
+    ["--max-violations", "0"], ["--rule-cap", "style=1"], ["--fail-fast"]
+])
+def test_validate_watch_rejects_options(tmp_path, mocker, option):
+    mocker.patch(
+        "sys.argv",
+        ["", str(tmp_path), str(tmp_path / "output.csv"), "html",
+         "--watch"] + option
+    )
+    with pytest.raises(SystemExit) as exit_info:
+        validate_mbz_html.main()
+    assert exit_info.value.code == 2
+
+
+def test_validate_mbz_uuid_registry(tmp_path, mocker, mbz_builder,
+                                    page_builder):
+    ib_uuid = "8fd0a5a4-0c56-4d5c-9f5f-2f5a6d1c5b1e"
+    content_uuid = "0c6fd0be-6bd2-4ff1-9db0-6d0a0d0fbc9b"
+    question_uuid = "f79cdda5-8411-4f8b-8648-47fb0e74ecb1"
+    for course, page_uuid in [("course_a", "9a5e1d1c-8a0e-4ff1-8f3b-0b9d"
+                               "0e6f4b2a"), ("course_b", content_uuid)]:
+        mbz_builder(
+            tmp_path / course,
+            activities=[
+                page_builder(
+                    id=1, name="Blocks",
+                    html_content=f'<div class="os-raise-ib-pset" '
+                                 f'data-content-id="{ib_uuid}"></div>'
+                ),
+                page_builder(
+                    id=2, name="Page",
+                    html_content=f'<div class="os-raise-content" '
+                                 f'data-content-id="{page_uuid}"></div>'
+                )
+            ],
+            questionbank_questions=[{
+                "id": 1, "idnumber": question_uuid, "html_content": "<p>Q</p>"
+            }]
+        )
+    registry_path = tmp_path / "uuids.db"
+
+    def validate(course):
+        output_path = tmp_path / f"{course}.csv"
+        mocker.patch(
+            "sys.argv",
+            ["", str(tmp_path / course), str(output_path), "mbz",
+             "--uuid-registry", str(registry_path)]
+        )
+        validate_mbz_html.main()
+        return [
+            (row["location"], row["link"])
+            for row in csv.DictReader(open(output_path))
+            if row["issue"] == validate_mbz_html.CROSS_COURSE_UUID_VIOLATION
+        ]
+
+    assert validate("course_a") == []
+    assert validate("course_b") == [
+        ("Blocks", f"ib uuid: {ib_uuid} also used by ib in course_a: "
+         "Blocks"),
+        (str(tmp_path / "course_b/questions.xml"),
+         f"question uuid: {question_uuid} also used by question in "
+         "course_a: questions.xml")
+    ]
+    # Revalidating a course doesn't report its own UUIDs
+    assert len(validate("course_a")) == 2
+    assert len(validate("course_b")) == 2
+
+
+def test_validate_mbz_uuid_registry_with_budget(tmp_path, mbz_builder,
+                                                page_builder):
+    ib_uuid = "8fd0a5a4-0c56-4d5c-9f5f-2f5a6d1c5b1e"
+    question_uuid = "f79cdda5-8411-4f8b-8648-47fb0e74ecb1"
+    mbz_builder(
+        tmp_path / "course",
+        activities=[
+            page_builder(id=1, name="Unnested", html_content="Unnested"),
+            page_builder(
+                id=2, name="Blocks",
+                html_content=f'<div class="os-raise-ib-pset" '
+                             f'data-content-id="{ib_uuid}"></div>'
+            )
+        ],
+        questionbank_questions=[{
+            "id": 1, "idnumber": question_uuid, "html_content": "<p>Q</p>"
+        }]
+    )
+
+    with UuidRegistry(tmp_path / "uuids.db") as registry:
+        violations = validate_mbz_html.iter_mbz_violations(
+            tmp_path / "course", include_questionbank=True,
+            uuid_registry=registry,
+            budget=validate_mbz_html.ViolationBudget(max_violations=1)
+        )
+        # Registering the course doesn't depend on the violations being
+        # consumed
+        next(violations, None)
+        violations.close()
+        assert registry.courses() == ["course"]
+        assert registry.find_duplicates("other", [
+            (ib_uuid, "ib", "Blocks"),
+            (question_uuid, "question", "questions.xml")
+        ]) == [
+            (0, "course", "ib", "Blocks"),
+            (1, "course", "question", "questions.xml")
+        ]
+
+
+def test_violation_budget():
+    budget = validate_mbz_html.ViolationBudget(3, {"style": 1, "table": 0})
+
+    def violation(issue):
+        return validate_mbz_html.Violation(issue, "here")
+
+    assert budget.accept(violation(validate_mbz_html.STYLE_VIOLATION))
+    assert not budget.accept(violation(validate_mbz_html.STYLE_VIOLATION))
+    assert not budget.accept(
+        violation(validate_mbz_html.TABLE_VIOLATION + "th is required")
+    )
+    assert budget.accept(violation(validate_mbz_html.SCRIPT_VIOLATION))
+    assert not budget.exhausted
+
+    pulled = []
+
+    def produce():
+        for issue in [validate_mbz_html.HREF_VIOLATION,
+                      validate_mbz_html.IFRAME_VIOLATION]:
+            pulled.append(issue)
+            yield violation(issue)
+
+    assert [v.issue for v in budget.filter(produce())] == \
+        [validate_mbz_html.HREF_VIOLATION]
+    assert budget.exhausted
+    assert pulled == [validate_mbz_html.HREF_VIOLATION]
+
+
+def test_validate_mbz_fail_fast(tmp_path, mocker, mbz_builder,
+                                page_builder):
+    mbz_builder(
+        tmp_path / "mbz",
+        activities=[
+            page_builder(id=1, name="Page 1",
+                         html_content='<p style="color: red">Styled</p>'),
+            page_builder(id=2, name="Page 2", html_content="Unnested"),
+            page_builder(id=3, name="Page 3", html_content="Unnested")
+        ],
+        questionbank_questions=[{
+            "id": 1, "idnumber": "bad", "html_content": "<script></script>"
+        }]
+    )
+    output_path = tmp_path / "output.csv"
+    mocker.patch(
+        "sys.argv",
+        ["", str(tmp_path / "mbz"), str(output_path), "mbz", "--fail-fast"]
+    )
+    page_init = mocker.spy(MoodlePage, "__init__")
+    question_records = mocker.spy(
+        validate_mbz_html.utils.models.MoodleQuestionBank,
+        "iter_entry_versions"
+    )
+    with pytest.raises(SystemExit) as exit_info:
+        validate_mbz_html.main()
+    assert exit_info.value.code == 1
+    rows = list(csv.DictReader(open(output_path)))
+    assert [(row["issue"], row["location"]) for row in rows] == \
+        [(validate_mbz_html.UNNESTED_VIOLATION, "Page 2")]
+    # The remaining activities and the question bank are never loaded
+    assert page_init.call_count == 2
+    assert question_records.call_count == 0
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+@pytest.mark.parametrize("unnested", [False, True])
+@pytest.mark.parametrize("max_violations", [1, 2, 3, 4, 100])
+def test_validate_mbz_budget_is_prefix(tmp_path, mbz_builder, page_builder,
+                                       quiz_builder, unnested,
+                                       max_violations, jobs):
+    activities = [
+        page_builder(id=idx, name=f"Page {idx}",
+                     html_content='<p style="color: red">Styled</p>'
+                                  '<table></table>')
+        for idx in range(1, 4)
+    ]
+    # The quiz's question is checked after the pages that follow it
+    activities.insert(1, quiz_builder(
+        id=5,
+        name="Quiz",
+        questions=[{"id": "31", "slot": 1, "page": 1, "questionid": "11"}]
+    ))
+    question_html = "<p>Question</p>"
+    if unnested:
+        question_html = "Unnested question"
+        activities.append(page_builder(id=4, name="Page 4",
+                                       html_content="Unnested"))
+    mbz_builder(
+        tmp_path,
+        activities=activities,
+        questionbank_questions=[
+            {"id": 11, "idnumber": 1234, "html_content": question_html}
+        ]
+    )
+
+    expected = validate_mbz_html.validate_mbz(tmp_path)
+    budget = validate_mbz_html.ViolationBudget(max_violations)
+    violations = validate_mbz_html.validate_mbz(tmp_path, jobs=jobs,
+                                                budget=budget)
+    assert [v.toDict() for v in violations] == \
+        [v.toDict() for v in expected[:max_violations]]
+
+
+def test_validate_mbz_budget_releases_activity_trees(
+    tmp_path, mbz_builder, page_builder, mocker
+):
+    pages = [
+        page_builder(id=i, name=f"Page {i}",
+                     html_content='<p style="color: red">Page</p>')
+        for i in range(1, 4)
+    ]
+    mbz_builder(tmp_path, activities=pages)
+
+    live_pages = []
+    original = MoodleBackup.iter_activities
+
+    def iter_activities(backup):
+        for activity in original(backup):
+            yield activity
+            gc.collect()
+            live_pages.append(sum(
+                isinstance(obj, MoodlePage) for obj in gc.get_objects()
+            ))
+
+    mocker.patch.object(MoodleBackup, "iter_activities", iter_activities)
+    budget = validate_mbz_html.ViolationBudget(rule_caps={"style": 1})
+    violations = validate_mbz_html.validate_mbz(tmp_path, budget=budget)
+    assert [v.location for v in violations] == ["Page 1"]
+    assert live_pages == [1, 1, 1]
+
+
+def test_validate_mbz_budget_clean(tmp_path, mocker, mbz_builder,
+                                   page_builder):
+    mbz_builder(tmp_path / "mbz", activities=[
+        page_builder(id=1, name="Page", html_content="<p>Valid</p>")
+    ])
+    output_path = tmp_path / "output.csv"
+    mocker.patch(
+        "sys.argv",
+        ["", str(tmp_path / "mbz"), str(output_path), "mbz", "--fail-fast"]
+    )
+    validate_mbz_html.main()
+    assert list(csv.DictReader(open(output_path))) == []
+
+
+def test_validate_mbz_rule_caps(tmp_path, mbz_builder, page_builder):
+    mbz_builder(tmp_path, activities=[
+        page_builder(id=idx, name=f"Page {idx}",
+                     html_content='<p style="a">x</p><script></script>')
+        for idx in range(1, 4)
+    ])
+    budget = validate_mbz_html.ViolationBudget(rule_caps={"style": 1})
+    violations = validate_mbz_html.validate_mbz(tmp_path, budget=budget)
+    assert [(v.issue, v.location) for v in violations] == [
+        (validate_mbz_html.STYLE_VIOLATION, "Page 1"),
+        (validate_mbz_html.SCRIPT_VIOLATION, "Page 1"),
+        (validate_mbz_html.SCRIPT_VIOLATION, "Page 2"),
+        (validate_mbz_html.SCRIPT_VIOLATION, "Page 3")
+    ]
+
+
+def test_validate_html_max_violations(tmp_path, mocker):
+    html_path = tmp_path / "html"
+    html_path.mkdir()
+    for idx in range(4):
+        (html_path / f"{idx}.html").write_text('<p style="a">x</p>')
+    output_path = tmp_path / "output.csv"
+    mocker.patch(
+        "sys.argv",
+        ["", str(html_path), str(output_path), "html", "--max-violations",
+         "2", "--rule-cap", "tag=0"]
+    )
+    with pytest.raises(SystemExit):
+        validate_mbz_html.main()
+    assert len(list(csv.DictReader(open(output_path)))) == 2
+
+
+def test_validate_invalid_rule_cap(tmp_path, mocker):
+    mocker.patch(
+        "sys.argv",
+        ["", str(tmp_path), str(tmp_path / "output.csv"), "html",
+         "--rule-cap", "styles=1"]
+    )
+    with pytest.raises(SystemExit) as exit_info:
+        validate_mbz_html.main()
+    assert exit_info.value.code == 2
@@ -0,0 +1,130 @@
+import csv
+import json
+from mbtools.validate_mbz_html import Violation, TABLE_VIOLATION, \
+    STYLE_VIOLATION
+from mbtools.violation_writers import write_violations, sarif_rule
+import pytest
+
+
+@pytest.fixture
+def violations(tmp_path):
+    return [
+        Violation(STYLE_VIOLATION, str(tmp_path / "a/page.xml"), "color: red"),
+        Violation(TABLE_VIOLATION + "th is required in either thead or "
+                  "tbody", str(tmp_path / "b/page.xml")),
+        Violation(STYLE_VIOLATION, "elsewhere.xml", "left: 0")
+    ]
+
+
+def test_write_violations_csv(tmp_path, violations):
+    output_file = tmp_path / "out.csv"
+    assert write_violations(violations, output_file) == 3
+    rows = list(csv.DictReader(open(output_file)))
+    assert rows == [
+        {"issue": v.issue, "location": v.location, "link": v.link or ""}
+        for v in violations
+    ]
+
+
+def test_write_violations_jsonl(tmp_path, violations):
+    output_file = tmp_path / "out.jsonl"
+    write_violations(violations, output_file, "jsonl")
+    with open(output_file) as f:
+        rows = [json.loads(line) for line in f]
+    assert rows == [v.toDict() for v in violations]
+
+
+def test_write_violations_sarif(tmp_path, violations):
+    for path in ["a/page.xml", "b/page.xml"]:
+        (tmp_path / path).parent.mkdir()
+        (tmp_path / path).touch()
+    output_file = tmp_path / "out.sarif"
+    write_violations(violations, output_file, "sarif", tmp_path)
+    with open(output_file) as f:
+        sarif = json.load(f)
+    assert sarif["version"] == "2.1.0"
+    [run] = sarif["runs"]
+    assert run["tool"]["driver"]["rules"] == [
+        {"id": "uses-in-line-styles",
+         "shortDescription": {"text": "Uses In-Line Styles"}},
+        {"id": "table-violation",
+         "shortDescription": {"text": "Table violation"}}
+    ]
+    results = run["results"]
+    assert [result["ruleId"] for result in results] == [
+        "uses-in-line-styles", "table-violation", "uses-in-line-styles"
+    ]
+    assert [
+        result["locations"][0]["physicalLocation"]["artifactLocation"]["uri"]
+        for result in results[:2]
+    ] == ["a/page.xml", "b/page.xml"]
+    assert results[2]["locations"] == [
+        {"logicalLocations": [{"fullyQualifiedName": "elsewhere.xml"}]}
+    ]
+    assert results[0]["level"] == "error"
+    assert results[0]["message"]["text"] == \
+        STYLE_VIOLATION + " (color: red)"
+    assert results[0]["properties"] == {"link": "color: red"}
+    assert "properties" not in results[1]
+
+
+def test_write_violations_sarif_locations(tmp_path):
+    file_path = tmp_path / "html files" / "page #1.html"
+    file_path.parent.mkdir()
+    file_path.touch()
+    other_path = tmp_path.parent / f"{tmp_path.name}-other.html"
+    other_path.touch()
+    label = "Lesson (page: P1): Answer Value"
+    output_file = tmp_path / "out.sarif"
+    write_violations([
+        Violation(STYLE_VIOLATION, str(file_path)),
+        Violation(STYLE_VIOLATION, file_path),
+        Violation(STYLE_VIOLATION, str(other_path)),
+        Violation(STYLE_VIOLATION, label)
+    ], output_file, "sarif", tmp_path)
+    with open(output_file) as f:
+        results = json.load(f)["runs"][0]["results"]
+    assert [result["locations"] for result in results] == [
+        [{"physicalLocation": {
+            "artifactLocation": {"uri": "html%20files/page%20%231.html"}
+        }}],
+        [{"physicalLocation": {
+            "artifactLocation": {"uri": "html%20files/page%20%231.html"}
+        }}],
+        [{"physicalLocation": {
+            "artifactLocation": {"uri": other_path.as_uri()}
+        }}],
+        [{"logicalLocations": [{"fullyQualifiedName": label}]}]
+    ]
+
+
+def test_write_violations_sarif_empty(tmp_path):
+    output_file = tmp_path / "out.sarif"
+    write_violations([], output_file, "sarif")
+    with open(output_file) as f:
+        sarif = json.load(f)
+    assert sarif["runs"][0]["results"] == []
+    assert sarif["runs"][0]["tool"]["driver"]["rules"] == []
+
+
+@pytest.mark.parametrize("output_format", ["csv", "jsonl"])
+def test_write_violations_streams(tmp_path, violations, output_format):
+    output_file = tmp_path / "out"
+
+    def produce():
+        for violation in violations:
+            yield violation
+            # Earlier violations are on disk before the next is produced
+            with open(output_file) as f:
+                assert f.read().count(violation.location) == 1
+
+    write_violations(produce(), output_file, output_format)
+
+
+def test_sarif_rule():
+    assert sarif_rule("ERROR: Use of <script> element") == (
+        "error", "use-of-script-element", "Use of <script> element"
+    )
+    assert sarif_rule("WARNING: Something odd: detail") == (
+        "warning", "something-odd", "Something odd"
+    )
@@ -0,0 +1,74 @@
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from lxml import etree
+from mbtools import xpath_queries
+from mbtools.models import MoodleHtmlElement, MoodleBackup
+
+
+def test_query_registry_compiles_once():
+    tree = etree.fromstring("<root><a>1</a><a>2</a></root>")
+    xpath_queries.reset_query_stats()
+
+    assert len(xpath_queries.xpath(tree, "//a")) == 2
+    query = xpath_queries.get_query("//a")
+    assert xpath_queries.get_query("//a") is query
+    assert xpath_queries.xpath(tree, "//a[text()=$value]", value="2")[0] \
+        .text == "2"
+
+    xpath_queries.xpath(tree, "//a")
+    assert query.hits == 2
+    assert query.seconds > 0
+
+
+def test_query_stats_counted_across_threads(mocker):
+    tree = etree.fromstring("<root><a>1</a></root>")
+    query = xpath_queries.XPathQuery("//a")
+    # Make every call yield the GIL so that unlocked updates would be lost
+    mocker.patch.object(xpath_queries.time, "perf_counter",
+                        side_effect=lambda: time.sleep(0) or 1.0)
+
+    def run_queries(_):
+        for _ in range(200):
+            query(tree)
+
+    with ThreadPoolExecutor(8) as executor:
+        list(executor.map(run_queries, range(8)))
+    assert query.stats()["hits"] == 1600
+
+    query.reset()
+    assert query.stats() == {"query": "//a", "hits": 0, "seconds": 0.0}
+
+
+def test_query_stats_dump(tmp_path):
+    tree = etree.fromstring("<root><a>1</a></root>")
+    xpath_queries.reset_query_stats()
+    xpath_queries.xpath(tree, "//a")
+
+    output_file = tmp_path / "stats.json"
+    xpath_queries.dump_query_stats(output_file)
+    stats = json.loads(output_file.read_text())
+    stats_by_query = {item["query"]: item for item in stats}
+    assert stats_by_query["//a"]["hits"] == 1
+    assert all(
+        item["hits"] == 0 for item in stats if item["query"] != "//a"
+    )
+
+
+def test_query_variables_are_not_interpolated(tmp_path, mbz_builder,
+                                              page_builder):
+    parent = etree.fromstring("<content></content>")
+    parent.text = """<div class="it's"><p class='say "hi"'></p></div>"""
+    elem = MoodleHtmlElement(parent, "")
+
+    assert len(elem.get_elements_with_string_in_class("it's")) == 1
+    assert len(elem.get_elements_with_string_in_class('"hi"')) == 1
+    assert len(elem.get_elements_with_exact_class(["it's"])) == 1
+
+    page = page_builder(id=1, name="Page", html_content="<p></p>",
+                        section_id="it's")
+    mbz_builder(tmp_path, activities=[page],
+                sections=[{"id": "it's", "title": "Quoted"}])
+    backup = MoodleBackup(tmp_path)
+    assert len(backup.activities("it's")) == 1
+    assert len(backup.activities("other")) == 0